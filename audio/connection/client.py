@@ -16,9 +16,16 @@ from atsume.bot import initialize_atsume
 from audio.data.discord_packet import request_ip, opcode_0_identify, get_ip_response, opcode_3_heartbeat, \
     opcode_1_select, RTPHeader, opcode_5_speaking
 from audio.connection.process_bridge import AbstractCommunicationBridge, TCPSocketBridge
+from audio.connection.sender import PacketSender
+from audio.data.audio import AudioConfig
 from audio.data.encrypt import select_mode, AudioEncryption
+from audio.processing.async_file import DownloadMemory
+from audio.processing.loudness import LoudnessAnalyzer
 from audio.processing.manager import AudioManager
+from audio.processing.pcm_cache import PCMCache
+from audio.processing.process import PrepareBudget
 from audio.utils.background_tasks import BackgroundTasks
+from audio.utils.usage import process_usage
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -26,11 +33,12 @@ logging.basicConfig(level=logging.INFO)
 
 def process_runtime(channel_id: snowflakes.Snowflake, endpoint: str, guild_id: snowflakes.Snowflake, session_id: str,
                     token: str, user_id: snowflakes.Snowflake,
-                    manager_port: int) -> None:
+                    manager_port: int, heartbeat_interval: typing.Optional[float] = None) -> None:
     try:
         settings_module = os.environ["ATSUME_SETTINGS_MODULE"]
         initialize_atsume(settings_module)
-        connection = VoiceConnectionProcess(channel_id, endpoint, guild_id, session_id, token, user_id, manager_port)
+        connection = VoiceConnectionProcess(channel_id, endpoint, guild_id, session_id, token, user_id, manager_port,
+                                            bot_heartbeat=heartbeat_interval)
         asyncio.get_event_loop().run_until_complete(connection.start())
     except KeyboardInterrupt:
         pass
@@ -40,10 +48,33 @@ def process_runtime(channel_id: snowflakes.Snowflake, endpoint: str, guild_id: s
 
 class VoiceConnectionProcess(BackgroundTasks):
     def __init__(self, channel_id: snowflakes.Snowflake, endpoint: str, guild_id: snowflakes.Snowflake, session_id: str,
-                 token: str, user_id: snowflakes.Snowflake, manager_port: int, *args, **kwargs) -> None:
+                 token: str, user_id: snowflakes.Snowflake, manager_port: int, *args,
+                 bridge: typing.Optional[AbstractCommunicationBridge] = None,
+                 pcm_cache: typing.Optional[PCMCache] = None, loudness: typing.Optional[LoudnessAnalyzer] = None,
+                 prepare_budget: typing.Optional[PrepareBudget] = None,
+                 download_memory: typing.Optional[DownloadMemory] = None,
+                 sender: typing.Optional[PacketSender] = None, config: typing.Optional[AudioConfig] = None,
+                 bot_heartbeat: typing.Optional[float] = None, **kwargs) -> None:
+        """
+        :param bridge: Connection to the bot, if we're sharing one with other guilds in a worker
+        :param pcm_cache: Shared with other guilds in a worker
+        :param loudness: Shared with other guilds in a worker
+        :param prepare_budget: Shared with other guilds in a worker
+        :param download_memory: Shared with other guilds in a worker
+        :param sender: Packet sender thread shared with other guilds in a worker
+        :param config: The config a worker made its shared objects with
+        :param bot_heartbeat: Seconds between telling the bot this process is alive, if it's a process of its own
+        """
         super().__init__()
         # Basic information for the connection
-        self.manager_connection: AbstractCommunicationBridge = TCPSocketBridge(port=manager_port)
+        self.manager_connection: AbstractCommunicationBridge = bridge or TCPSocketBridge(port=manager_port)
+        self.bot_heartbeat = bot_heartbeat
+        self._pcm_cache = pcm_cache
+        self._loudness = loudness
+        self._prepare_budget = prepare_budget
+        self._download_memory = download_memory
+        self._sender = sender
+        self._config = config
         self.gateway: typing.Optional[aiohttp.ClientWebSocketResponse] = None
         self.voice_socket: typing.Optional[asyncio_dgram.DatagramClient] = None
         self.session: typing.Optional[aiohttp.ClientSession] = None
@@ -88,12 +119,14 @@ class VoiceConnectionProcess(BackgroundTasks):
         self._gateway_receive_task: typing.Optional[asyncio.Task] = None
         self._voice_receive_task: typing.Optional[asyncio.Task] = None
         self._heartbeat_task: typing.Optional[asyncio.Task] = None
+        self._bot_heartbeat_task: typing.Optional[asyncio.Task] = None
         self._audio_task: typing.Optional[asyncio.Task] = None
 
     async def start(self) -> None:
         # Start the gateway connection
         self.session = aiohttp.ClientSession()
-        self.audio = AudioManager(self)
+        self.audio = AudioManager(self, self._pcm_cache, self._loudness, self._prepare_budget,
+                                  self._download_memory, self._sender, self._config)
         logger.info(f"Starting the voice gateway connection to {self.endpoint}...")
         self.gateway = await self.session.ws_connect(f"{self.endpoint}?v=8")
 
@@ -136,6 +169,8 @@ class VoiceConnectionProcess(BackgroundTasks):
         await self.manager_connection.open()
         await self.manager_connection.write(str(self.guild_id).encode())
         self._manager_pipe_task = asyncio.Task(self.manager_pipe_task())
+        if self.bot_heartbeat:
+            self._bot_heartbeat_task = asyncio.Task(self.bot_heartbeat_task())
 
         # Wait until we receive the stop event, which only fires after clean up completes
         await self._stop_event.wait()
@@ -163,6 +198,9 @@ class VoiceConnectionProcess(BackgroundTasks):
             if self._heartbeat_task:
                 self._heartbeat_task.cancel()
                 self._heartbeat_task = None
+            if self._bot_heartbeat_task:
+                self._bot_heartbeat_task.cancel()
+                self._bot_heartbeat_task = None
             if self.session:
                 if not self.session.closed:
                     # I don't know why this error happens, but it complains if we don't end the session
@@ -179,6 +217,8 @@ class VoiceConnectionProcess(BackgroundTasks):
             if self.voice_socket:
                 self.voice_socket.close()
                 self.voice_socket = None
+            if self.audio:
+                await self.audio.close()
             # Close the infinite wait to fully exit the asyncio loop
             self._stop_event.set()
         except:
@@ -219,6 +259,17 @@ class VoiceConnectionProcess(BackgroundTasks):
         except:
             traceback.print_exc()
 
+    async def bot_heartbeat_task(self) -> None:
+        """Tell the bot's supervisor we're alive and what we're using"""
+        try:
+            while not self._stop and self.manager_connection.is_alive:
+                await self.manager_connection.write(json.dumps({"heartbeat": process_usage()}).encode())
+                await asyncio.sleep(self.bot_heartbeat)
+        except asyncio.CancelledError:
+            pass
+        except:
+            traceback.print_exc()
+
     async def process_pipe_task(self) -> None:
         # Todo: remove this over the new bridge stuff
         try:
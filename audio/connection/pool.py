@@ -0,0 +1,280 @@
+import asyncio
+import logging
+import traceback
+import typing
+
+from audio.connection.process_bridge import AbstractCommunicationBridge, MultiplexedBridge
+from audio.connection.supervisor import ProcessSupervisor, SupervisedProcess
+from audio.connection.worker import warm_runtime, worker_runtime
+from audio.utils.background_tasks import BackgroundTasks
+from audio.utils.json import json
+
+logger = logging.getLogger(__name__)
+
+WORKER_GROUP = "voice-worker"
+WARM_GROUP = "voice-warm"
+
+
+class WorkerHandle(BackgroundTasks):
+    """The bot's side of one multi-guild worker process"""
+    def __init__(self, pool: "WorkerPool", worker_id: int, process: SupervisedProcess) -> None:
+        super().__init__()
+        self.pool = pool
+        self.worker_id = worker_id
+        self.process = process
+        self.job = process.job
+        self.bridge: typing.Optional[MultiplexedBridge] = None
+        self.sessions: dict[int, asyncio.Future] = {}  # Guild to a future that finishes when its session does
+        self.playing = 0  # Sessions playing audio at the last heartbeat
+        self._connected = asyncio.Event()
+        self._read_task: typing.Optional[asyncio.Task] = None
+        self.start_background_task(self.job_end())
+
+    @property
+    def load(self) -> tuple[int, int]:
+        """Sessions playing audio cost a lot more than idle ones, so count them first"""
+        return self.playing, len(self.sessions)
+
+    @property
+    def is_alive(self) -> bool:
+        return not self.job.done()
+
+    async def set_connection(self, connection: AbstractCommunicationBridge) -> None:
+        self.bridge = MultiplexedBridge(connection)
+        self._read_task = asyncio.Task(self.read_task())
+        self._connected.set()
+
+    async def start_session(self, guild_id: int, session: dict[str, typing.Any]) -> asyncio.Future:
+        """Start a guild's voice session on this worker. The returned future finishes when the session does."""
+        ended = asyncio.get_running_loop().create_future()
+        ended.add_done_callback(lambda future: self._session_done(guild_id, future))
+        self.sessions[guild_id] = ended
+        connected = asyncio.ensure_future(self._connected.wait())
+        await asyncio.wait([connected, self.job], return_when=asyncio.FIRST_COMPLETED)
+        if not self._connected.is_set():
+            # The worker died before it got going, job_end has ended the session already
+            connected.cancel()
+            return ended
+        await self.send_control({"command": "start", "guild_id": guild_id, **session})
+        return ended
+
+    def _session_done(self, guild_id: int, future: asyncio.Future) -> None:
+        if self.sessions.get(guild_id) is future:
+            del self.sessions[guild_id]
+        if future.cancelled() and self.bridge and self.bridge.is_alive:
+            # The bot gave up on it, make sure the worker does too
+            self.start_background_task(self.send_control({"command": "stop", "guild_id": guild_id}))
+
+    async def read_task(self) -> None:
+        assert self.bridge is not None
+        try:
+            while self.bridge.is_alive:
+                guild_id, data = await self.bridge.receive()
+                if guild_id == MultiplexedBridge.CONTROL:
+                    self.receive_control(json.loads(data))
+                elif not self.bridge.dispatch(guild_id, data):
+                    # The first message from a session is its guild, like a process of its own would send
+                    channel = self.bridge.channel(guild_id)
+                    await self.pool.attach(int(data.decode()), channel)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.warning(f"Lost the connection to voice worker {self.worker_id}")
+        except asyncio.CancelledError:
+            pass
+        except:
+            traceback.print_exc()
+
+    def receive_control(self, data: dict) -> None:
+        match data["event"]:
+            case "ended":
+                future = self.sessions.get(data["guild_id"])
+                if future and not future.done():
+                    future.set_result(None)
+            case "heartbeat":
+                self.playing = data["playing"]
+                self.process.heartbeat(data)
+            case _:
+                logger.error(f"Unknown worker event \"{data['event']}\"")
+
+    async def send_control(self, data: dict) -> None:
+        assert self.bridge is not None
+        await self.bridge.send(MultiplexedBridge.CONTROL, json.dumps(data))
+
+    async def job_end(self) -> None:
+        """Wait for the worker process to exit, then end all of its sessions"""
+        try:
+            code = await self.job
+            logger.warning(f"Voice worker {self.worker_id} exited with code {code}, "
+                           f"ending its {len(self.sessions)} sessions")
+        except asyncio.CancelledError:
+            pass
+        except:
+            traceback.print_exc()
+        for future in list(self.sessions.values()):
+            if not future.done():
+                future.set_result(None)
+        if self._read_task:
+            self._read_task.cancel()
+        if self.bridge:
+            await self.bridge.close()
+        self.pool.remove(self)
+
+
+class WorkerPool:
+    """
+    Runs guilds' voice sessions in a fixed number of worker processes, each hosting many of them.
+
+    New sessions go to the worker with the least load, workers are started as they're first needed and again if
+    they die, held off for a while if they've been crashing.
+    """
+    def __init__(self, size: int, manager_port: int,
+                 attach: typing.Callable[[int, AbstractCommunicationBridge], typing.Awaitable[None]],
+                 supervisor: ProcessSupervisor) -> None:
+        """
+        :param attach: Hands a guild's channel to its VoiceConnection once its session says hello
+        """
+        self.size = size
+        self.manager_port = manager_port
+        self.attach = attach
+        self.supervisor = supervisor
+        self.workers: dict[int, WorkerHandle] = {}
+        self._next_id = 1
+
+    def _spawn(self) -> WorkerHandle:
+        worker_id = self._next_id
+        self._next_id += 1
+        process = self.supervisor.spawn(f"voice-worker-{worker_id}", worker_runtime, worker_id, self.manager_port,
+                                        self.supervisor.config.heartbeat_interval, group=WORKER_GROUP)
+        worker = WorkerHandle(self, worker_id, process)
+        self.workers[worker_id] = worker
+        return worker
+
+    async def _pick(self) -> WorkerHandle:
+        while True:
+            workers = [worker for worker in self.workers.values() if worker.is_alive]
+            if len(workers) >= self.size:
+                return min(workers, key=lambda worker: worker.load)
+            delay = self.supervisor.restart_delay(WORKER_GROUP)
+            if delay <= 0:
+                # Fill the pool before doubling anyone up
+                return self._spawn()
+            if workers:
+                # Workers have been crashing, double up rather than wait
+                return min(workers, key=lambda worker: worker.load)
+            await asyncio.sleep(delay)
+
+    async def start_session(self, guild_id: int, session: dict[str, typing.Any]) -> asyncio.Future:
+        return await (await self._pick()).start_session(guild_id, session)
+
+    async def worker_connected(self, worker_id: int, connection: AbstractCommunicationBridge) -> None:
+        worker = self.workers.get(worker_id)
+        if worker is None:
+            logger.error(f"Unknown voice worker {worker_id} connected")
+            await connection.close()
+            return
+        logger.info(f"Voice worker {worker_id} connected")
+        await worker.set_connection(connection)
+
+    def remove(self, worker: WorkerHandle) -> None:
+        if self.workers.get(worker.worker_id) is worker:
+            del self.workers[worker.worker_id]
+
+
+class WarmPool(BackgroundTasks):
+    """
+    Keeps a few voice processes started and initialized ahead of time, so joining a channel doesn't have to wait
+    for a new interpreter to start up.
+
+    Each one connects to the bot and waits. A join hands its session to the one that's been waiting the longest,
+    and a replacement is started in the background.
+    """
+    def __init__(self, size: int, manager_port: int,
+                 attach: typing.Callable[[int, AbstractCommunicationBridge], typing.Awaitable[None]],
+                 supervisor: ProcessSupervisor) -> None:
+        """
+        :param size: How many idle processes to keep ready
+        :param attach: Hands a guild's bridge to its VoiceConnection once its session says hello
+        """
+        super().__init__()
+        self.size = size
+        self.manager_port = manager_port
+        self.attach = attach
+        self.supervisor = supervisor
+        self.starting: dict[int, SupervisedProcess] = {}
+        # Oldest first
+        self.idle: dict[int, tuple[SupervisedProcess, AbstractCommunicationBridge]] = {}
+        self._next_id = 1
+        self._fill_task: typing.Optional[asyncio.Task] = None
+
+    def fill(self) -> None:
+        """Start processes in the background until there are enough ready"""
+        if not self._fill_task or self._fill_task.done():
+            self._fill_task = asyncio.Task(self.fill_task())
+
+    async def fill_task(self) -> None:
+        try:
+            while len(self.starting) + len(self.idle) < self.size:
+                await self.supervisor.wait_to_start(WARM_GROUP)
+                if len(self.starting) + len(self.idle) < self.size:
+                    self._spawn()
+        except asyncio.CancelledError:
+            pass
+        except:
+            traceback.print_exc()
+
+    def _spawn(self) -> None:
+        warm_id = self._next_id
+        self._next_id += 1
+        process = self.supervisor.spawn(f"voice-warm-{warm_id}", warm_runtime, warm_id, self.manager_port,
+                                        self.supervisor.config.heartbeat_interval, group=WARM_GROUP)
+        self.starting[warm_id] = process
+        process.job.add_done_callback(lambda _: self._exited(warm_id))
+
+    def _exited(self, warm_id: int) -> None:
+        # Once a process has been handed a session it isn't ours anymore
+        if self.starting.pop(warm_id, None) or self.idle.pop(warm_id, None):
+            logger.warning(f"Warm voice process {warm_id} exited before it was used")
+            self.fill()
+
+    async def worker_connected(self, warm_id: int, connection: AbstractCommunicationBridge) -> None:
+        process = self.starting.pop(warm_id, None)
+        if process is None:
+            logger.error(f"Unknown warm voice process {warm_id} connected")
+            await connection.close()
+            return
+        self.idle[warm_id] = (process, connection)
+        self.start_background_task(self.read_task(process, connection))
+        logger.info(f"Warm voice process {warm_id} is ready, {len(self.idle)} waiting")
+
+    async def read_task(self, process: SupervisedProcess, connection: AbstractCommunicationBridge) -> None:
+        """Take a warm process's heartbeats until it's given a session and that says hello as its guild"""
+        try:
+            while True:
+                data = await connection.read()
+                if data.startswith(b"{"):
+                    process.heartbeat(json.loads(data)["heartbeat"])
+                else:
+                    await self.attach(int(data.decode()), connection)
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            pass
+        except:
+            traceback.print_exc()
+
+    async def take(self, guild_id: int, session: dict[str, typing.Any]) -> typing.Optional[SupervisedProcess]:
+        """Hand a guild's voice session to a waiting process, if one's ready"""
+        try:
+            while self.idle:
+                warm_id = next(iter(self.idle))
+                process, connection = self.idle.pop(warm_id)
+                if not process.is_alive:
+                    continue
+                # From here on it's that guild's process, and its crashes are that guild's
+                process.name = process.group = f"voice-{guild_id}"
+                await connection.write(json.dumps({"guild_id": guild_id, **session}))
+                logger.info(f"Handed guild {guild_id} to warm voice process {warm_id}")
+                return process
+            return None
+        finally:
+            self.fill()
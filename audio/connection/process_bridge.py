@@ -10,11 +10,6 @@ logger = logging.getLogger(__name__)
 
 
 class AbstractCommunicationBridge(abc.ABC):
-    @classmethod
-    @abc.abstractmethod
-    def from_string(cls, connection_string: str) -> typing_extensions.Self:
-        pass
-
     @abc.abstractmethod
     async def read(self) -> bytes:
         pass
@@ -88,3 +83,94 @@ class TCPSocketBridge(AbstractCommunicationBridge):
     @property
     def is_alive(self):
         return self.writer is not None
+
+
+class MultiplexedBridge:
+    """
+    Carries messages for many guilds over one bridge, so a worker hosting many voice sessions needs only one
+    connection to the bot. Each message is prefixed with the guild it's for, guild 0 is for the worker itself.
+    """
+    CONTROL = 0
+    HEADER = struct.Struct('<Q')
+
+    def __init__(self, bridge: AbstractCommunicationBridge) -> None:
+        self.bridge = bridge
+        self.channels: dict[int, "MultiplexedChannel"] = {}
+
+    def channel(self, guild_id: int) -> "MultiplexedChannel":
+        if guild_id not in self.channels:
+            self.channels[guild_id] = MultiplexedChannel(self, guild_id)
+        return self.channels[guild_id]
+
+    async def send(self, guild_id: int, data: bytes) -> None:
+        await self.bridge.write(self.HEADER.pack(guild_id) + data)
+
+    async def receive(self) -> tuple[int, bytes]:
+        data = await self.bridge.read()
+        guild_id, = self.HEADER.unpack_from(data)
+        return guild_id, data[self.HEADER.size:]
+
+    def dispatch(self, guild_id: int, data: bytes) -> bool:
+        """Hand a received message to its guild's channel, if it has one open"""
+        channel = self.channels.get(guild_id)
+        if channel is None:
+            return False
+        channel.feed(data)
+        return True
+
+    async def close(self) -> None:
+        for channel in list(self.channels.values()):
+            await channel.close()
+        await self.bridge.close()
+
+    @property
+    def is_alive(self) -> bool:
+        return self.bridge.is_alive
+
+
+class MultiplexedChannel(AbstractCommunicationBridge):
+    """One guild's messages on a MultiplexedBridge, used just like a bridge of its own"""
+    def __init__(self, bridge: MultiplexedBridge, guild_id: int) -> None:
+        self.bridge = bridge
+        self.guild_id = guild_id
+        self._messages: asyncio.Queue[typing.Optional[bytes]] = asyncio.Queue()
+        self._closed = False
+
+    def feed(self, data: bytes) -> None:
+        self._messages.put_nowait(data)
+
+    async def read(self) -> bytes:
+        data = await self._messages.get()
+        if data is None:
+            raise ConnectionResetError(f"Channel for guild {self.guild_id} was closed")
+        return data
+
+    async def write(self, data: bytes) -> None:
+        if self._closed:
+            raise Exception("Attempted to send data on a closed channel")
+        if isinstance(data, str):
+            data = data.encode()
+        await self.bridge.send(self.guild_id, data)
+
+    async def open(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self.bridge.channels.get(self.guild_id) is self:
+            del self.bridge.channels[self.guild_id]
+        # Wake up anything waiting to read
+        self._messages.put_nowait(None)
+
+    async def read_loop(self) -> typing.AsyncIterator[bytes]:
+        while self.is_alive:
+            yield await self.read()
+
+    def __str__(self):
+        return f"{self.__class__.__name__}({self.guild_id}, {self.bridge.bridge})"
+
+    @property
+    def is_alive(self):
+        return not self._closed and self.bridge.is_alive
@@ -0,0 +1,193 @@
+import asyncio
+import ctypes
+import ctypes.util
+import heapq
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+import typing
+
+if typing.TYPE_CHECKING:
+    from audio.processing.pacing import FramePacer
+
+logger = logging.getLogger(__name__)
+
+CLOCK_MONOTONIC = 1
+TIMER_ABSTIME = 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _load_clock_nanosleep() -> typing.Optional[typing.Callable]:
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        clock_nanosleep = libc.clock_nanosleep
+    except (OSError, AttributeError, TypeError):
+        return None
+    clock_nanosleep.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(_Timespec), ctypes.POINTER(_Timespec)]
+    clock_nanosleep.restype = ctypes.c_int
+    return clock_nanosleep
+
+
+_clock_nanosleep = _load_clock_nanosleep()
+
+
+def sleep_until(deadline: int) -> None:
+    """Sleep until a time on the monotonic clock, in nanoseconds"""
+    if _clock_nanosleep is not None:
+        # An absolute sleep wakes up on time however long it took us to get here
+        spec = _Timespec(deadline // 1_000_000_000, deadline % 1_000_000_000)
+        if _clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, ctypes.byref(spec), None) == 0:
+            return
+    remaining = deadline - time.monotonic_ns()
+    if remaining > 0:
+        time.sleep(remaining / 1e9)
+
+
+class SenderStream:
+    """One guild's packets, queued on the process's PacketSender"""
+    def __init__(self, sender: "PacketSender", sock: socket.socket, pacer: "FramePacer", max_queued: int) -> None:
+        self.sender = sender
+        self.socket = socket.socket(fileno=os.dup(sock.fileno()))
+        self.socket.setblocking(True)
+        self.pacer = pacer
+        self.max_queued = max_queued
+        self.queued = 0  # Only changed with the sender's lock held
+        self.closed = False
+        self._loop = asyncio.get_running_loop()
+        self._space = asyncio.Event()
+
+    async def send(self, deadline: int, packet: bytes) -> None:
+        """Queue a packet to go out at deadline, in monotonic nanoseconds, waiting if we have too many queued"""
+        while self.queued >= self.max_queued and not self.closed:
+            self._space.clear()
+            await self._space.wait()
+        if not self.closed:
+            self.sender._put(deadline, self, packet)
+
+    def close(self) -> None:
+        """Drop anything still queued, the sender closes our socket once it's done with it"""
+        self.closed = True
+        self.sender._close_stream(self)
+        self._space.set()
+
+    def _sent(self) -> None:
+        try:
+            self._loop.call_soon_threadsafe(self._space.set)
+        except RuntimeError:
+            # The loop closed under us
+            pass
+
+
+class PacketSender(threading.Thread):
+    """
+    Sends voice packets from a thread of its own, each at its deadline.
+
+    The playback loop shares the worker's event loop with FFmpeg pipes, the gateway, the bridge and everything
+    else, so a slow callback can hold up a packet. Here the loop only queues encrypted packets along with when
+    they're due, a few frames ahead, and this thread sleeps until each one's deadline and sends it, so packets go
+    out on time however busy the loop is.
+
+    There's one of these per process, every guild playing in it gets a stream with its own copy of its voice socket
+    and queues onto the same thread, which sends whichever packet is due first. Receiving stays on the loop.
+    """
+    PRECISE_SLEEP = 2_000_000  # Nanoseconds before a deadline to stop waiting for new packets and sleep exactly
+
+    def __init__(self) -> None:
+        super().__init__(name="PacketSender", daemon=True)
+        self._queue: list[tuple[int, int, SenderStream, bytes]] = []  # Heap ordered by deadline
+        self._order = itertools.count()
+        self._streams: set[SenderStream] = set()
+        self._closing: list[SenderStream] = []
+        self._condition = threading.Condition()
+        self._running = True
+
+    def stream(self, sock: socket.socket, pacer: "FramePacer", max_queued: int = 3) -> SenderStream:
+        """Start sending a guild's packets on its voice socket, starting the thread if it isn't running yet"""
+        with self._condition:
+            stream = SenderStream(self, sock, pacer, max_queued)
+            self._streams.add(stream)
+        if not self.is_alive() and self._running:
+            self.start()
+        return stream
+
+    def _put(self, deadline: int, stream: SenderStream, packet: bytes) -> None:
+        with self._condition:
+            heapq.heappush(self._queue, (deadline, next(self._order), stream, packet))
+            stream.queued += 1
+            self._condition.notify()
+
+    def _close_stream(self, stream: SenderStream) -> None:
+        with self._condition:
+            if stream not in self._streams:
+                return
+            self._streams.discard(stream)
+            self._queue = [entry for entry in self._queue if entry[2] is not stream]
+            heapq.heapify(self._queue)
+            stream.queued = 0
+            # The thread might be sending on it right now, so it closes the socket itself
+            self._closing.append(stream)
+            self._condition.notify()
+
+    def _next(self) -> typing.Optional[tuple[int, SenderStream, bytes]]:
+        with self._condition:
+            while True:
+                for stream in self._closing:
+                    stream.socket.close()
+                self._closing.clear()
+                if not self._running:
+                    return None
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+                wait = self._queue[0][0] - time.monotonic_ns() - self.PRECISE_SLEEP
+                if wait <= 0:
+                    break
+                # Another guild can queue a packet that's due sooner while we wait
+                self._condition.wait(wait / 1e9)
+            deadline, _, stream, packet = heapq.heappop(self._queue)
+            stream.queued -= 1
+        return deadline, stream, packet
+
+    def run(self) -> None:
+        try:
+            while (entry := self._next()) is not None:
+                deadline, stream, packet = entry
+                stream._sent()
+                sleep_until(deadline)
+                try:
+                    stream.socket.send(packet)
+                except OSError as e:
+                    logger.warning(f"Couldn't send a voice packet ({e})")
+                # Only this thread writes the lateness stats, the loop just reads them
+                stream.pacer.record(max(time.monotonic_ns() - deadline, 0) / 1e9)
+        except:
+            traceback.print_exc()
+        finally:
+            with self._condition:
+                for stream in self._streams | set(self._closing):
+                    stream.socket.close()
+                self._streams.clear()
+                self._closing.clear()
+                self._queue.clear()
+
+    def stop(self) -> None:
+        """Stop the thread, dropping anything still queued"""
+        with self._condition:
+            self._running = False
+            self._queue.clear()
+            self._condition.notify()
+            for stream in self._streams:
+                stream.queued = 0
+                stream._sent()
+            if not self.is_alive():
+                for stream in self._streams | set(self._closing):
+                    stream.socket.close()
+                self._streams.clear()
+                self._closing.clear()
@@ -5,7 +5,9 @@ import logging
 
 from hikari import snowflakes
 
-from audio.connection.process_bridge import TCPSocketBridge
+from audio.connection.pool import WarmPool, WorkerPool
+from audio.connection.process_bridge import AbstractCommunicationBridge, TCPSocketBridge
+from audio.connection.supervisor import ProcessSupervisor
 
 
 if typing.TYPE_CHECKING:
@@ -20,28 +22,56 @@ class VoiceManager:
     def __init__(self) -> None:
         self.server: typing.Optional[asyncio.Server] = None
         self.connections: typing.Dict[snowflakes.Snowflake, "VoiceConnection"] = {}
+        self.pool: typing.Optional[WorkerPool] = None
+        self.warm: typing.Optional[WarmPool] = None
+        self.supervisor = ProcessSupervisor()
 
     async def start_server(self) -> None:
         if not self.server:
             logger.info("Starting bridge server")
             self.server = await asyncio.start_server(self.client_connected, host="127.0.0.1", port=MANAGER_PORT)
 
+    def worker_pool(self, size: int) -> WorkerPool:
+        """Get the pool of multi-guild workers, starting it if it hasn't been"""
+        if not self.pool:
+            self.pool = WorkerPool(size, MANAGER_PORT, self.attach, self.supervisor)
+        return self.pool
+
+    def warm_pool(self, size: int) -> WarmPool:
+        """Get the pool of warm voice processes, starting it if it hasn't been"""
+        if not self.warm:
+            self.warm = WarmPool(size, MANAGER_PORT, self.attach, self.supervisor)
+        return self.warm
+
     async def add_listener(self, guild_id: snowflakes.Snowflake, connection: "VoiceConnection") -> None:
         self.connections[guild_id] = connection
 
     async def client_connected(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
         try:
             connection = TCPSocketBridge(reader=reader, writer=writer)
-            guild = await connection.read()
-            guild_id = int(guild.decode())
-            logger.info(f"Client process for guild {guild_id} connected")
-            await self.connections[snowflakes.Snowflake(guild_id)]._set_connection(connection)
+            hello = (await connection.read()).decode()
+            if hello.startswith("worker:"):
+                if not self.pool:
+                    raise Exception("A voice worker connected, but there's no worker pool")
+                await self.pool.worker_connected(int(hello.removeprefix("worker:")), connection)
+                return
+            if hello.startswith("warm:"):
+                if not self.warm:
+                    raise Exception("A warm voice process connected, but there's no warm pool")
+                await self.warm.worker_connected(int(hello.removeprefix("warm:")), connection)
+                return
+            logger.info(f"Client process for guild {hello} connected")
+            await self.attach(int(hello), connection)
         except:
             traceback.print_exc()
 
+    async def attach(self, guild_id: int, connection: AbstractCommunicationBridge) -> None:
+        """Hand a guild's bridge to its VoiceConnection"""
+        await self.connections[snowflakes.Snowflake(guild_id)]._set_connection(connection)
+
     async def remove_listener(self, guild_id):
         del self.connections[guild_id]
-        if len(self.connections) == 0 and self.server:
+        if len(self.connections) == 0 and self.server and not self.pool and not self.warm:
             logger.info("Last voice client closed, dropping bridge server")
             self.server.close()
             self.server = None
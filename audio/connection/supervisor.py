@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+import typing
+
+from audio.data.audio import SupervisorConfig
+
+logger = logging.getLogger(__name__)
+
+_CONTEXT = multiprocessing.get_context("spawn")
+
+
+class SupervisedProcess:
+    """A voice process, along with what its heartbeats have told us about it"""
+    def __init__(self, supervisor: "ProcessSupervisor", name: str, group: str, target: typing.Callable,
+                 args: tuple) -> None:
+        self.supervisor = supervisor
+        self.name = name
+        self.group = group
+        self.process = _CONTEXT.Process(target=target, args=args, name=name, daemon=True)
+        self.job: asyncio.Future = asyncio.get_running_loop().create_future()  # Finishes with the exit code
+        self.job.add_done_callback(self._job_done)
+        self.started = time.monotonic()
+        self.last_heartbeat: typing.Optional[float] = None
+        self.cpu = 0.0  # Seconds of CPU time used, as of the last heartbeat
+        self.cpu_percent = 0.0  # Of one core, between the last two heartbeats
+        self.rss = 0  # Bytes
+        self.hung = False  # Killed for not sending heartbeats
+        self._stopping = False  # Terminated because nothing's waiting for it anymore
+        self._poll_task: typing.Optional[asyncio.Task] = None
+
+    @property
+    def pid(self) -> typing.Optional[int]:
+        return self.process.pid
+
+    @property
+    def is_alive(self) -> bool:
+        return not self.job.done()
+
+    @property
+    def crashed(self) -> bool:
+        return self.hung or (self.process.exitcode not in (0, None) and not self._stopping)
+
+    def start(self) -> None:
+        self.process.start()
+        loop = asyncio.get_running_loop()
+        try:
+            # The sentinel becomes readable when the process exits
+            loop.add_reader(self.process.sentinel, self._exited)
+        except NotImplementedError:
+            self._poll_task = asyncio.Task(self._poll())
+
+    async def _poll(self) -> None:
+        try:
+            while self.process.is_alive():
+                await asyncio.sleep(0.5)
+            self._exited()
+        except asyncio.CancelledError:
+            pass
+
+    def _exited(self) -> None:
+        if self._poll_task is None:
+            asyncio.get_running_loop().remove_reader(self.process.sentinel)
+        self.process.join()
+        if not self.job.done():
+            self.job.set_result(self.process.exitcode)
+        self.supervisor._exited(self)
+
+    def _job_done(self, future: asyncio.Future) -> None:
+        if future.cancelled() and self.process.is_alive():
+            self._stopping = True
+            self.process.terminate()
+
+    def kill(self) -> None:
+        self.hung = True
+        self.process.kill()
+
+    def heartbeat(self, usage: dict[str, typing.Any]) -> None:
+        now = time.monotonic()
+        if self.last_heartbeat is not None and now > self.last_heartbeat:
+            self.cpu_percent = max(usage["cpu"] - self.cpu, 0) / (now - self.last_heartbeat) * 100
+        self.cpu = usage["cpu"]
+        self.rss = usage["rss"]
+        self.last_heartbeat = now
+
+    def stats(self) -> dict[str, typing.Any]:
+        now = time.monotonic()
+        return {
+            "name": self.name,
+            "pid": self.pid,
+            "uptime": now - self.started,
+            "last_heartbeat": now - self.last_heartbeat if self.last_heartbeat is not None else None,
+            "cpu": self.cpu,
+            "cpu_percent": self.cpu_percent,
+            "rss": self.rss,
+        }
+
+
+class ProcessSupervisor:
+    """
+    Starts voice processes and keeps an eye on them.
+
+    Every process is a multiprocessing Process of its own rather than a job on a shared pool, so one crashing only
+    ends the guilds it was playing for. Each process sends a heartbeat over its bridge with its CPU time and memory
+    use, and one that goes quiet for too long is assumed to be hung and is killed.
+
+    Processes are grouped by what they're for, and a group that crashes is held off from starting again for a
+    while, doubling each time it crashes in a row, so something that crashes on startup doesn't spin.
+    """
+    def __init__(self, config: typing.Optional[SupervisorConfig] = None) -> None:
+        self.config = config or SupervisorConfig()
+        self.processes: set[SupervisedProcess] = set()
+        self._crashes: dict[str, tuple[int, float]] = {}  # Group to crashes in a row and when it can start again
+        self._watchdog: typing.Optional[asyncio.Task] = None
+
+    def spawn(self, name: str, target: typing.Callable, *args: typing.Any,
+              group: typing.Optional[str] = None) -> SupervisedProcess:
+        process = SupervisedProcess(self, name, group or name, target, args)
+        process.start()
+        self.processes.add(process)
+        logger.info(f"Started voice process {name} ({process.pid})")
+        if not self._watchdog:
+            self._watchdog = asyncio.Task(self.watchdog_task())
+        return process
+
+    def restart_delay(self, group: str) -> float:
+        """Seconds until a group that crashed can be started again"""
+        _, until = self._crashes.get(group, (0, 0.0))
+        return max(until - time.monotonic(), 0)
+
+    async def wait_to_start(self, group: str) -> None:
+        delay = self.restart_delay(group)
+        if delay > 0:
+            logger.info(f"Holding off starting {group} for {delay:.1f}s after it crashed")
+            await asyncio.sleep(delay)
+
+    def _exited(self, process: SupervisedProcess) -> None:
+        self.processes.discard(process)
+        if not process.crashed:
+            self._crashes.pop(process.group, None)
+            return
+        reason = "hung" if process.hung else f"crashed with exit code {process.process.exitcode}"
+        logger.error(f"Voice process {process.name} ({process.pid}) {reason}")
+        crashes, _ = self._crashes.get(process.group, (0, 0.0))
+        if time.monotonic() - process.started >= self.config.stable_after:
+            crashes = 0
+        crashes += 1
+        delay = min(self.config.restart_backoff * 2 ** (crashes - 1), self.config.max_restart_backoff)
+        self._crashes[process.group] = (crashes, time.monotonic() + delay)
+
+    async def watchdog_task(self) -> None:
+        try:
+            while self.processes:
+                await asyncio.sleep(self.config.heartbeat_interval)
+                now = time.monotonic()
+                for process in list(self.processes):
+                    if process.hung or not process.is_alive:
+                        continue
+                    if process.last_heartbeat is None:
+                        quiet, limit = now - process.started, self.config.startup_timeout
+                    else:
+                        quiet, limit = now - process.last_heartbeat, self.config.heartbeat_timeout
+                    if quiet > limit:
+                        logger.error(f"Voice process {process.name} ({process.pid}) hasn't sent a heartbeat in "
+                                     f"{quiet:.0f}s, killing it")
+                        process.kill()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._watchdog = None
+
+    def stats(self) -> list[dict[str, typing.Any]]:
+        return [process.stats() for process in self.processes]
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import os
+import traceback
+import typing
+
+from hikari import snowflakes
+
+from atsume.bot import initialize_atsume
+
+from audio.connection.client import VoiceConnectionProcess
+from audio.connection.process_bridge import MultiplexedBridge, TCPSocketBridge
+from audio.connection.sender import PacketSender
+from audio.data.audio import default_audio_config
+from audio.processing.async_file import DownloadMemory
+from audio.processing.loudness import LoudnessAnalyzer
+from audio.processing.pcm_cache import PCMCache
+from audio.processing.process import PrepareBudget
+from audio.utils.background_tasks import BackgroundTasks
+from audio.utils.json import json
+from audio.utils.usage import process_usage
+
+logger = logging.getLogger(__name__)
+
+
+def worker_runtime(worker_id: int, manager_port: int, heartbeat_interval: float) -> None:
+    try:
+        settings_module = os.environ["ATSUME_SETTINGS_MODULE"]
+        initialize_atsume(settings_module)
+        asyncio.get_event_loop().run_until_complete(VoiceWorker(worker_id, manager_port, heartbeat_interval).run())
+    except KeyboardInterrupt:
+        pass
+    except:
+        traceback.print_exc()
+
+
+class VoiceWorker(BackgroundTasks):
+    """
+    Runs many guilds' voice sessions in one process, on one event loop.
+
+    Most sessions are idle most of the time, and an idle session only costs a few sleeping tasks, so this fits many
+    more on a host than a process each. All of the sessions share one bridge connection to the bot, with each
+    guild's messages kept apart by a MultiplexedBridge. They also share the PCM cache, loudness measurements and
+    memory budgets, and the thread that sends their voice packets.
+    """
+    def __init__(self, worker_id: int, manager_port: int, heartbeat_interval: float) -> None:
+        super().__init__()
+        self.worker_id = worker_id
+        self.heartbeat_interval = heartbeat_interval
+        self.bridge = MultiplexedBridge(TCPSocketBridge(port=manager_port))
+        self.sessions: dict[int, VoiceConnectionProcess] = {}
+        # Every session gets the same config, so they agree with the shared objects on budgets and settings
+        self.config = default_audio_config()
+        self.pcm_cache = PCMCache(self.config.pcm_cache)
+        self.loudness = LoudnessAnalyzer(self.config.loudness)
+        self.prepare_budget = PrepareBudget(self.config.prepare_budget)
+        self.download_memory = DownloadMemory(self.config.preload)
+        self.sender = PacketSender() if self.config.pacing.sender_thread else None
+
+    async def run(self) -> None:
+        await self.bridge.bridge.open()
+        await self.bridge.bridge.write(f"worker:{self.worker_id}".encode())
+        logger.info(f"Voice worker {self.worker_id} connected to the bot")
+        heartbeat_task = asyncio.Task(self.heartbeat_task())
+        try:
+            while self.bridge.is_alive:
+                guild_id, data = await self.bridge.receive()
+                if guild_id == MultiplexedBridge.CONTROL:
+                    await self.receive_control(json.loads(data))
+                elif not self.bridge.dispatch(guild_id, data):
+                    logger.warning(f"Got a message for guild {guild_id}, which has no session here")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info(f"Voice worker {self.worker_id} lost its connection to the bot, shutting down")
+        finally:
+            heartbeat_task.cancel()
+            for session in list(self.sessions.values()):
+                await session.stop()
+            if self.sender:
+                self.sender.stop()
+
+    async def receive_control(self, data: dict) -> None:
+        match data["command"]:
+            case "start":
+                guild_id = data["guild_id"]
+                if guild_id in self.sessions:
+                    logger.error(f"Asked to start a second session for guild {guild_id}")
+                    return
+                self.start_background_task(self.run_session(data))
+            case "stop":
+                session = self.sessions.get(data["guild_id"])
+                if session:
+                    await session.stop()
+            case _:
+                logger.error(f"Unknown worker command \"{data['command']}\"")
+
+    async def run_session(self, data: dict) -> None:
+        guild_id = data["guild_id"]
+        channel = self.bridge.channel(guild_id)
+        session = VoiceConnectionProcess(snowflakes.Snowflake(data["channel_id"]), data["endpoint"],
+                                         snowflakes.Snowflake(guild_id), data["session_id"], data["token"],
+                                         snowflakes.Snowflake(data["user_id"]), 0, bridge=channel,
+                                         pcm_cache=self.pcm_cache, loudness=self.loudness,
+                                         prepare_budget=self.prepare_budget,
+                                         download_memory=self.download_memory, sender=self.sender,
+                                         config=self.config)
+        self.sessions[guild_id] = session
+        logger.info(f"Starting a voice session for guild {guild_id}, {len(self.sessions)} on this worker")
+        try:
+            await session.start()
+        except:
+            traceback.print_exc()
+            await session.stop()
+        finally:
+            del self.sessions[guild_id]
+            await channel.close()
+            if self.bridge.is_alive:
+                await self.send_control({"event": "ended", "guild_id": guild_id})
+
+    async def heartbeat_task(self) -> None:
+        """Tell the bot we're alive, how busy we are and what we're using"""
+        try:
+            while True:
+                await self.send_control({"event": "heartbeat", **self.load(), **process_usage()})
+                await asyncio.sleep(self.heartbeat_interval)
+        except asyncio.CancelledError:
+            pass
+        except:
+            traceback.print_exc()
+
+    def load(self) -> dict[str, typing.Any]:
+        playing = sum(1 for session in self.sessions.values()
+                      if session.audio and session.audio.pipeline.active.is_set())
+        return {"sessions": len(self.sessions), "playing": playing}
+
+    async def send_control(self, data: dict) -> None:
+        await self.bridge.send(MultiplexedBridge.CONTROL, json.dumps(data))
+
+
+def warm_runtime(warm_id: int, manager_port: int, heartbeat_interval: float) -> None:
+    try:
+        settings_module = os.environ["ATSUME_SETTINGS_MODULE"]
+        initialize_atsume(settings_module)
+        asyncio.get_event_loop().run_until_complete(WarmProcess(warm_id, manager_port, heartbeat_interval).run())
+    except KeyboardInterrupt:
+        pass
+    except:
+        traceback.print_exc()
+
+
+class WarmProcess:
+    """
+    A voice process started before anyone needs it.
+
+    Starting a process from scratch means a new interpreter importing everything and initializing Atsume, which
+    takes a second or two before the voice handshake can even begin. A warm process has done all of that already
+    and is connected to the bot, so joining a channel only has to send it the session to run.
+    """
+    def __init__(self, warm_id: int, manager_port: int, heartbeat_interval: float) -> None:
+        self.warm_id = warm_id
+        self.heartbeat_interval = heartbeat_interval
+        self.bridge = TCPSocketBridge(port=manager_port)
+
+    async def run(self) -> None:
+        await self.bridge.open()
+        await self.bridge.write(f"warm:{self.warm_id}".encode())
+        heartbeat_task = asyncio.Task(self.heartbeat_task())
+        try:
+            data = json.loads(await self.bridge.read())
+            logger.info(f"Warm voice process {self.warm_id} was given guild {data['guild_id']}")
+            # The session says hello as its guild over our bridge, just like a process started for it would
+            session = VoiceConnectionProcess(snowflakes.Snowflake(data["channel_id"]), data["endpoint"],
+                                             snowflakes.Snowflake(data["guild_id"]), data["session_id"],
+                                             data["token"], snowflakes.Snowflake(data["user_id"]), 0,
+                                             bridge=self.bridge)
+            await session.start()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info(f"Warm voice process {self.warm_id} lost its connection to the bot, shutting down")
+        finally:
+            heartbeat_task.cancel()
+
+    async def heartbeat_task(self) -> None:
+        """Keeps going once we have a session, so it doesn't need heartbeats of its own"""
+        try:
+            while self.bridge.is_alive:
+                await self.bridge.write(json.dumps({"heartbeat": process_usage()}))
+                await asyncio.sleep(self.heartbeat_interval)
+        except asyncio.CancelledError:
+            pass
+        except:
+            traceback.print_exc()
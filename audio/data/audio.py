@@ -1,4 +1,5 @@
 import dataclasses
+import tempfile
 import typing
 from pathlib import Path
 from typing import TYPE_CHECKING
@@ -41,13 +42,117 @@ class AudioFile:
         return self._id
 
 
+@dataclasses.dataclass
+class EncoderProfile:
+    application: str = "audio"  # "audio", "voip" or "lowdelay"
+    bitrate: int = 128 * 1024
+    complexity: int = 10  # 0 to 10, higher is better quality and more CPU
+    fec: bool = True
+    packet_loss: int = 15  # Expected packet loss percentage for FEC to plan for
+    bandwidth: str = "full"  # "full", "superwide", "wide", "medium" or "narrow"
+    signal: str = "auto"  # "auto", "music" or "voice"
+
+
+@dataclasses.dataclass
+class EncoderGovernorConfig:
+    enabled: bool = True
+    interval: float = 1  # Seconds between decisions
+    high_load: float = 0.5  # Fraction of each 20ms frame spent rendering that makes us step quality down
+    low_load: float = 0.2  # Below this we can step quality back up
+    recover_after: float = 10  # Seconds the load has to stay low before stepping up
+
+
 @dataclasses.dataclass
 class AudioChannelConfig:
     name: str
-    priority: int = 5
+    priority: int = 5  # Lower numbers are higher priority and can duck the channels below them
+    duck_volume: float = 0.25  # Volume this channel drops to while a higher priority channel ducks it
+    duck_attack: float = 0.05  # Time constant in seconds to drop into the ducked volume
+    duck_release: float = 0.4  # Time constant in seconds to recover from the ducked volume
+    crossfade: float = 0  # Seconds to overlap the end of a track with the start of the next one
+    prepare_ahead: float = 10  # Seconds before a track ends to start buffering the next one
+    encoder: typing.Optional[EncoderProfile] = None  # Encoder profile to use while this is the only channel playing
+
+
+@dataclasses.dataclass
+class PCMCacheConfig:
+    memory_budget: int = 64 * 1024 * 1024  # Bytes of decoded clips to keep in memory
+    memory_max_seconds: float = 20  # Anything longer than this goes to the disk tier instead
+    memory_policy: str = "lru"  # How to pick what to evict from memory, "lru" or "lfu"
+    # Where to keep decoded tracks on disk, or None to only cache in memory
+    disk_path: typing.Optional[Path] = dataclasses.field(
+        default_factory=lambda: Path(tempfile.gettempdir()) / "beatrice" / "pcm")
+    disk_budget: int = 2 * 1024 * 1024 * 1024  # Bytes, least recently played tracks are deleted past this
+
+
+@dataclasses.dataclass
+class DownloadCacheConfig:
+    # Where downloads are kept, shared by every worker process, or None to only download into memory
+    path: typing.Optional[Path] = dataclasses.field(
+        default_factory=lambda: Path(tempfile.gettempdir()) / "beatrice" / "downloads")
+    budget: int = 4 * 1024 * 1024 * 1024  # Bytes, least recently played downloads are deleted past this
+
+
+@dataclasses.dataclass
+class PacingConfig:
+    # What to do when the playback loop falls behind, "burst" to send late frames back to back, "drop" to skip
+    # them or "stretch" to just carry on from where it is
+    catch_up: str = "burst"
+    max_catch_up: int = 5  # Most frames burst or drop make up for at once, anything later is stretched
+    # Send packets from a thread with absolute sleeps, so a busy event loop can't make them late. There's one thread
+    # per process, shared by every guild a worker is playing for
+    sender_thread: bool = False
+    sender_queue: int = 3  # Packets each guild gives the sender thread ahead of time
+
+
+@dataclasses.dataclass
+class PreloadConfig:
+    max_downloads: int = 3  # Prefetches at once, files that are about to play don't count towards it
+    urgent_within: float = 30  # Seconds, files playing sooner than this are never held back by prefetches
+    min_rate: int = 256 * 1024  # Bytes/s, another prefetch isn't started if the downloads would get less each
+    # Bytes of downloads every guild in the process holds in memory before they're spilled to disk
+    memory_budget: int = 64 * 1024 * 1024
+    spill_path: typing.Optional[Path] = None  # Where spilled downloads go, None for the system's temp directory
+    stall_timeout: float = 10  # Seconds an urgent download can go without data before prefetches stop waiting on it
+    read_timeout: float = 60  # Seconds without data before a download is dropped and resumed from where it got to
+
+
+@dataclasses.dataclass
+class SupervisorConfig:
+    heartbeat_interval: float = 2  # Seconds between each voice process telling the bot it's alive
+    heartbeat_timeout: float = 15  # A process that's been quiet this long is hung, and is killed
+    startup_timeout: float = 60  # Seconds a process has to send its first heartbeat
+    restart_backoff: float = 1  # Seconds to hold off restarting after a crash, doubling with each crash in a row
+    max_restart_backoff: float = 60
+    stable_after: float = 120  # Seconds a process has to stay up before its crashes are forgotten
+
+
+@dataclasses.dataclass
+class LoudnessConfig:
+    target: float = -24  # Integrated loudness in LUFS that files are brought to
+    true_peak: float = -2  # Highest true peak in dBTP a file can be raised to
+    max_gain: float = 12  # Most a quiet file can be boosted by in dB
+    tolerance: float = 1  # Files within this many dB of the target are left alone, so Opus can still pass through
+    path: typing.Optional[Path] = dataclasses.field(
+        default_factory=lambda: Path(tempfile.gettempdir()) / "beatrice" / "loudness")
+    max_analyses: int = 1  # FFmpeg processes measuring files at once
 
 
 @dataclasses.dataclass
 class AudioConfig:
     channels: list[AudioChannelConfig]
+    lookahead: float = 0.1  # Seconds of audio to mix and encode ahead of sending, between 0.06 and 0.5
+    render_block: int = 3  # Number of 20ms frames to mix at a time
+    speaking_hold: float = 0.5  # Seconds of continuous silence before we tell Discord we've stopped speaking
+    prepare_budget: int = 16 * 1024 * 1024  # Bytes every channel in the process can buffer next tracks with
+    encoder: EncoderProfile = dataclasses.field(default_factory=EncoderProfile)
+    governor: EncoderGovernorConfig = dataclasses.field(default_factory=EncoderGovernorConfig)
+    pcm_cache: PCMCacheConfig = dataclasses.field(default_factory=PCMCacheConfig)
+    loudness: LoudnessConfig = dataclasses.field(default_factory=LoudnessConfig)
+    download_cache: DownloadCacheConfig = dataclasses.field(default_factory=DownloadCacheConfig)
+    preload: PreloadConfig = dataclasses.field(default_factory=PreloadConfig)
+    pacing: PacingConfig = dataclasses.field(default_factory=PacingConfig)
+
 
+def default_audio_config() -> AudioConfig:
+    return AudioConfig([AudioChannelConfig("music", 2), AudioChannelConfig("sfx", 1)])
@@ -0,0 +1,315 @@
+import abc
+import dataclasses
+import struct
+import typing
+
+OGG_CAPTURE_PATTERN = b"OggS"
+EBML_MAGIC = b"\x1a\x45\xdf\xa3"
+
+# Matroska element IDs, with their length marker bits left in like they are in the stream
+EBML_HEADER = 0x1A45DFA3
+SEGMENT = 0x18538067
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+CODEC_ID = 0x86
+CODEC_PRIVATE = 0x63A2
+CLUSTER = 0x1F43B675
+BLOCK_GROUP = 0xA0
+BLOCK = 0xA1
+SIMPLE_BLOCK = 0xA3
+
+# Elements we step into instead of skipping over
+MATROSKA_MASTERS = {SEGMENT, TRACKS, TRACK_ENTRY, CLUSTER, BLOCK_GROUP}
+
+# Frame durations in tenths of a millisecond for each TOC config, from RFC 6716 section 3.1
+_OPUS_FRAME_DURATIONS = [100, 200, 400, 600] * 3 + [100, 200] * 2 + [25, 50, 100, 200] * 4
+
+
+class UnsupportedStreamError(Exception):
+    """The stream isn't Opus, or isn't laid out in a way we can demux"""
+
+
+@dataclasses.dataclass(frozen=True)
+class OpusPacket:
+    data: bytes
+    samples: int  # Duration of the packet in samples at 48kHz
+    unit_start: int  # Byte offset of the Ogg page or Matroska cluster this packet starts in
+    unit_samples: int  # Samples of audio in that page or cluster before this packet
+
+
+@dataclasses.dataclass(frozen=True)
+class OpusHead:
+    channels: int
+    pre_skip: int
+    input_sample_rate: int
+    output_gain: int
+    mapping_family: int
+
+    @classmethod
+    def parse(cls, data: bytes) -> "OpusHead":
+        if len(data) < 19 or data[:8] != b"OpusHead":
+            raise UnsupportedStreamError("Stream is not Opus")
+        channels, pre_skip, input_sample_rate, output_gain, mapping_family = struct.unpack_from("<BHIhB", data, 9)
+        return cls(channels, pre_skip, input_sample_rate, output_gain, mapping_family)
+
+
+def opus_packet_samples(packet: bytes) -> int:
+    """Get the duration of an Opus packet in samples at 48kHz from its TOC byte"""
+    if not packet:
+        return 0
+    toc = packet[0]
+    frame_samples = _OPUS_FRAME_DURATIONS[toc >> 3] * 48 // 10
+    match toc & 0x3:
+        case 0:
+            frames = 1
+        case 1 | 2:
+            frames = 2
+        case _:
+            frames = packet[1] & 0x3F if len(packet) > 1 else 0
+    return frame_samples * frames
+
+
+class OpusDemuxer(abc.ABC):
+    """
+    Incrementally pulls Opus packets out of a container as bytes of it arrive.
+
+    Packets remember which Ogg page or Matroska cluster they came from. Decoding can then pick up again from
+    that unit by feeding a decoder the header bytes followed by the stream from the unit's start.
+    """
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._offset = 0  # Stream offset of the start of _buffer
+        self.head: typing.Optional[OpusHead] = None
+        self.header_size: typing.Optional[int] = None  # Bytes of the stream before the first audio
+        self.unit_start = 0
+        self.unit_samples = 0
+
+    @staticmethod
+    def for_stream(start: bytes) -> typing.Optional["OpusDemuxer"]:
+        """Pick a demuxer for a stream based on its first few bytes"""
+        if start.startswith(OGG_CAPTURE_PATTERN):
+            return OggOpusDemuxer()
+        if start.startswith(EBML_MAGIC):
+            return MatroskaOpusDemuxer()
+        return None
+
+    @abc.abstractmethod
+    def feed(self, data: bytes) -> list[OpusPacket]:
+        pass
+
+    def _start_unit(self, offset: int) -> None:
+        self.unit_start = offset
+        self.unit_samples = 0
+
+    def _packet(self, data: bytes, unit_start: int, unit_samples: int) -> OpusPacket:
+        samples = opus_packet_samples(data)
+        if unit_start == self.unit_start:
+            self.unit_samples += samples
+        return OpusPacket(data, samples, unit_start, unit_samples)
+
+    def _consume(self, size: int) -> None:
+        del self._buffer[:size]
+        self._offset += size
+
+
+class OggOpusDemuxer(OpusDemuxer):
+    def __init__(self) -> None:
+        super().__init__()
+        self._serial: typing.Optional[int] = None
+        self._packet_data = bytearray()
+        self._packet_unit = (0, 0)  # Unit and position the packet being assembled started in
+        self._header_packets = 0
+
+    def feed(self, data: bytes) -> list[OpusPacket]:
+        self._buffer += data
+        packets: list[OpusPacket] = []
+        while len(self._buffer) >= 27:
+            if self._buffer[:4] != OGG_CAPTURE_PATTERN:
+                raise UnsupportedStreamError("Lost Ogg page sync")
+            segments = self._buffer[26]
+            if len(self._buffer) < 27 + segments:
+                break
+            lacing = self._buffer[27:27 + segments]
+            size = 27 + segments + sum(lacing)
+            if len(self._buffer) < size:
+                break
+            serial, = struct.unpack_from("<I", self._buffer, 14)
+            body = bytes(self._buffer[27 + segments:size])
+            page_start = self._offset
+            self._consume(size)
+            if self._serial is None:
+                self._serial = serial
+            elif serial != self._serial:
+                # Only the first logical stream is played
+                continue
+            self._read_page(page_start, page_start + size, lacing, body, packets)
+        return packets
+
+    def _read_page(self, page_start: int, page_end: int, lacing: bytearray, body: bytes,
+                   packets: list[OpusPacket]) -> None:
+        if self.header_size is not None:
+            self._start_unit(page_start)
+        position = 0
+        for lace in lacing:
+            if not self._packet_data:
+                self._packet_unit = (self.unit_start, self.unit_samples)
+            self._packet_data += body[position:position + lace]
+            position += lace
+            if lace == 255:
+                # The packet continues in the next segment
+                continue
+            data = bytes(self._packet_data)
+            self._packet_data.clear()
+            if self.header_size is not None:
+                packets.append(self._packet(data, *self._packet_unit))
+            elif self._header_packets == 0:
+                self.head = OpusHead.parse(data)
+                self._header_packets += 1
+            else:
+                # OpusTags, audio starts on the page after it ends
+                self.header_size = page_end
+                self._start_unit(page_end)
+
+
+def _read_vint(data: bytearray, position: int, keep_marker: bool = False) -> tuple[typing.Optional[int], int]:
+    """
+    Read an EBML variable length integer.
+
+    :return: The value (None if it didn't fit in the data, or -1 for an unknown size) and its length in bytes
+    """
+    if position >= len(data):
+        return None, 0
+    first = data[position]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise UnsupportedStreamError("Invalid EBML variable length integer")
+    if position + length > len(data):
+        return None, 0
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[position + 1:position + length]:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        return -1, length
+    return value, length
+
+
+class MatroskaOpusDemuxer(OpusDemuxer):
+    def __init__(self) -> None:
+        super().__init__()
+        self._tracks: list[dict[int, typing.Any]] = []
+        self._track: typing.Optional[int] = None
+        self._skip = 0
+
+    def feed(self, data: bytes) -> list[OpusPacket]:
+        packets: list[OpusPacket] = []
+        if self._skip:
+            # Drop the rest of an element we don't care about without buffering it
+            skipped = min(self._skip, len(data))
+            self._skip -= skipped
+            self._offset += skipped
+            data = data[skipped:]
+        self._buffer += data
+        while self._buffer:
+            element_id, id_length = _read_vint(self._buffer, 0, keep_marker=True)
+            if element_id is None:
+                break
+            size, size_length = _read_vint(self._buffer, id_length)
+            if size is None:
+                break
+            header_length = id_length + size_length
+            element_start = self._offset
+            if element_id in MATROSKA_MASTERS:
+                self._consume(header_length)
+                self._enter(element_id, element_start)
+                continue
+            if size == -1:
+                raise UnsupportedStreamError(f"Element {element_id:X} has an unknown size")
+            if element_id not in (TRACK_NUMBER, CODEC_ID, CODEC_PRIVATE, SIMPLE_BLOCK, BLOCK):
+                available = min(size, len(self._buffer) - header_length)
+                self._consume(header_length + available)
+                self._skip = size - available
+                continue
+            if len(self._buffer) < header_length + size:
+                break
+            body = bytes(self._buffer[header_length:header_length + size])
+            self._consume(header_length + size)
+            self._read_element(element_id, body, packets)
+        return packets
+
+    def _enter(self, element_id: int, element_start: int) -> None:
+        if element_id == TRACK_ENTRY:
+            self._tracks.append({})
+        elif element_id == CLUSTER:
+            if self.header_size is None:
+                self._select_track()
+                self.header_size = element_start
+            self._start_unit(element_start)
+
+    def _select_track(self) -> None:
+        for track in self._tracks:
+            if track.get(CODEC_ID) == "A_OPUS":
+                self._track = track.get(TRACK_NUMBER)
+                self.head = OpusHead.parse(track.get(CODEC_PRIVATE, b""))
+                return
+        raise UnsupportedStreamError("Stream has no Opus track")
+
+    def _read_element(self, element_id: int, body: bytes, packets: list[OpusPacket]) -> None:
+        match element_id:
+            case 0xD7:  # TRACK_NUMBER
+                if self._tracks:
+                    self._tracks[-1][TRACK_NUMBER] = int.from_bytes(body, "big")
+            case 0x86:  # CODEC_ID
+                if self._tracks:
+                    self._tracks[-1][CODEC_ID] = body.decode("ascii", "replace").rstrip("\x00")
+            case 0x63A2:  # CODEC_PRIVATE
+                if self._tracks:
+                    self._tracks[-1][CODEC_PRIVATE] = body
+            case 0xA3 | 0xA1:  # SIMPLE_BLOCK, BLOCK
+                if self.header_size is not None:
+                    for frame in self._read_block(body):
+                        packets.append(self._packet(frame, self.unit_start, self.unit_samples))
+
+    def _read_block(self, body: bytes) -> list[bytes]:
+        data = bytearray(body)
+        track, length = _read_vint(data, 0)
+        if track != self._track:
+            return []
+        position = length + 3  # Skip the relative timecode and flags
+        lacing = (data[length + 2] >> 1) & 0x3
+        if lacing == 0:
+            return [body[position:]]
+        count = data[position] + 1
+        position += 1
+        sizes: list[int] = []
+        match lacing:
+            case 1:  # Xiph lacing
+                for _ in range(count - 1):
+                    size = 0
+                    while data[position] == 255:
+                        size += 255
+                        position += 1
+                    size += data[position]
+                    position += 1
+                    sizes.append(size)
+            case 3:  # EBML lacing, sizes after the first are signed differences from the one before
+                size, length = _read_vint(data, position)
+                assert size is not None
+                position += length
+                sizes.append(size)
+                for _ in range(count - 2):
+                    difference, length = _read_vint(data, position)
+                    assert difference is not None
+                    position += length
+                    size += difference - ((1 << (7 * length - 1)) - 1)
+                    sizes.append(size)
+            case 2:  # Fixed size lacing
+                sizes = [(len(body) - position) // count] * (count - 1)
+        sizes.append(len(body) - position - sum(sizes))
+        frames = []
+        for size in sizes:
+            frames.append(body[position:position + size])
+            position += size
+        return frames
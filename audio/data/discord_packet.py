@@ -120,4 +120,8 @@ class RTPHeader:
             self.timestamp = 0
         return header
 
+    def skip(self, frames: int) -> None:
+        """Move the timestamp past frames that won't be sent, so the receiver knows they're missing"""
+        self.timestamp = (self.timestamp + 960 * frames) % 4294967296
+
 
@@ -23,6 +23,8 @@ ffi.cdef("""
     #define OPUS_SET_INBAND_FEC_REQUEST ...
     #define OPUS_SET_PACKET_LOSS_PERC_REQUEST ...
     #define OPUS_SET_SIGNAL_REQUEST ...
+    #define OPUS_SET_GAIN_REQUEST ...
+    #define OPUS_RESET_STATE ...
     
     #define OPUS_AUTO ...
     #define OPUS_SIGNAL_VOICE ...
@@ -58,6 +60,12 @@ ffi.cdef("""
     void opus_encoder_destroy(OpusEncoder * st);
     int opus_encoder_ctl ( OpusEncoder * st, int request, ...);
     
+    typedef ... OpusDecoder;
+    OpusDecoder* opus_decoder_create(opus_int32 Fs, int channels, int * error);
+    int opus_decode(OpusDecoder * st, const unsigned char * data, opus_int32 len, opus_int16 * pcm, int frame_size, int decode_fec);
+    void opus_decoder_destroy(OpusDecoder * st);
+    int opus_decoder_ctl(OpusDecoder * st, int request, ...);
+    
 """)
 
 ffi.set_source("_py_opus", """
@@ -42,6 +42,12 @@ class OpusEncodeError(enum.Enum):
 
 ENCODE_ERRORS = set([item.value for item in OpusEncodeError])
 
+# The longest an Opus packet can be, 120ms
+MAX_PACKET_SAMPLES = 5760
+
+# An Opus frame of silence, Discord expects five of these before we stop sending audio
+SILENCE_FRAME = b"\xf8\xff\xfe"
+
 
 class OpusSignal(enum.Enum):
     AUTO = lib.OPUS_AUTO
@@ -58,6 +64,7 @@ class OpusEncoder:
         self._opus_encoder_struct = lib.opus_encoder_create(self._sample_rate, self._channels,
                                                             application.value, error_code)
 
+        self.set_ctl(OpusEncoderSetCTL.COMPLEXITY, 10)
         self.set_ctl(OpusEncoderSetCTL.BITRATE, 128 * 1024)
         self.set_ctl(OpusEncoderSetCTL.INBAND_FEC, 1)
         self.set_ctl(OpusEncoderSetCTL.PACKET_LOSS_PERC, 15)
@@ -108,12 +115,70 @@ class OpusEncoder:
         return result
 
     def set_ctl(self, ctl: OpusEncoderSetCTL, setting: int):
-        setting_cdata = ffi.new("int[1]")
-        setting_cdata[0] = setting
-        lib.opus_encoder_ctl(self._opus_encoder_struct, ctl.value, setting_cdata)
+        # The setters take the value itself as an opus_int32, not a pointer to it
+        result = lib.opus_encoder_ctl(self._opus_encoder_struct, ctl.value, ffi.cast("opus_int32", setting))
+        if result != lib.OPUS_OK:
+            raise Exception(f"OpusEncoderCTL error {result} setting {ctl.name} to {setting}")
+
+    def close(self):
+        if self._opus_encoder_struct is not None:
+            lib.opus_encoder_destroy(self._opus_encoder_struct)
+            self._opus_encoder_struct = None
+
+    def __del__(self):
+        self.close()
+
+    @property
+    def channels(self) -> typing.Literal[1, 2]:
+        return self._channels
+
+
+class OpusDecodeError(Exception):
+    def __init__(self, code: int) -> None:
+        super().__init__(f"Opus decode error {code}")
+        self.code = code
+
+
+class OpusDecoder:
+    def __init__(self, sample_rate: typing.Literal[8000, 12000, 16000, 24000, 48000] = 48000,
+                 channels: typing.Literal[1, 2] = 2) -> None:
+        error_code = ffi.new("int *")
+        self._channels = channels
+        self._opus_decoder_struct = lib.opus_decoder_create(sample_rate, channels, error_code)
+        if error_code[0] != 0:
+            raise Exception(f"OpusDecoderCreate error {error_code[0]}")
+
+    def decode_into(self, packet: typing.Optional[bytes], pcm: np_typing.NDArray[np.int16],
+                    frame_size: typing.Optional[int] = None) -> int:
+        """
+        Decode a packet straight into an int16 array.
+
+        :param packet: The Opus packet, or None to conceal a lost one
+        :param frame_size: Samples per channel to conceal when the packet is lost, otherwise as many as fit in pcm
+        :return: The number of samples per channel decoded
+        """
+        output = ffi.cast("opus_int16 *", pcm.ctypes.data)
+        if packet is None:
+            result = lib.opus_decode(self._opus_decoder_struct, ffi.NULL, 0, output, frame_size, 0)
+        else:
+            result = lib.opus_decode(self._opus_decoder_struct, packet, len(packet), output,
+                                     len(pcm) // self._channels, 0)
+        if result < 0:
+            raise OpusDecodeError(result)
+        return result
+
+    def set_gain(self, gain: int) -> None:
+        """Set the output gain in Q7.8 dB, like the output gain in an Opus header"""
+        lib.opus_decoder_ctl(self._opus_decoder_struct, lib.OPUS_SET_GAIN_REQUEST, ffi.cast("opus_int32", gain))
+
+    def reset(self) -> None:
+        """Forget the decoder state, for when the next packet doesn't follow on from the last"""
+        lib.opus_decoder_ctl(self._opus_decoder_struct, lib.OPUS_RESET_STATE)
 
     def close(self):
-        lib.opus_encoder_destroy(self._opus_encoder_struct)
+        if self._opus_decoder_struct is not None:
+            lib.opus_decoder_destroy(self._opus_decoder_struct)
+            self._opus_decoder_struct = None
 
     def __del__(self):
         self.close()
@@ -0,0 +1,169 @@
+import asyncio
+import dataclasses
+import logging
+import mmap
+import struct
+import typing
+from pathlib import Path
+
+import numpy as np
+from numpy import typing as np_typing
+
+from audio.utils.constants import AUDIO_DATA_TYPE, SAMPLE_RATE
+
+logger = logging.getLogger(__name__)
+
+WAV_EXTENSIONS = {".wav", ".wave"}
+# Headerless files, assumed to already be 48kHz stereo s16le
+RAW_EXTENSIONS = {".raw", ".pcm", ".s16le"}
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+# Format tags and sample sizes _to_float can read
+SUPPORTED_FORMATS = {(WAVE_FORMAT_PCM, 8), (WAVE_FORMAT_PCM, 16), (WAVE_FORMAT_PCM, 24), (WAVE_FORMAT_PCM, 32),
+                     (WAVE_FORMAT_IEEE_FLOAT, 32), (WAVE_FORMAT_IEEE_FLOAT, 64)}
+
+
+class UnsupportedWavError(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class WavFormat:
+    format_tag: int
+    channels: int
+    sample_rate: int
+    bits: int
+    data_offset: int
+    data_size: int
+
+    def is_native(self) -> bool:
+        """Is this already the 48kHz stereo s16le the mixer uses?"""
+        return (self.format_tag == WAVE_FORMAT_PCM and self.bits == 16 and self.channels == 2
+                and self.sample_rate == SAMPLE_RATE and self.data_offset % AUDIO_DATA_TYPE.itemsize == 0)
+
+
+def parse_wav(data: typing.Union[bytes, mmap.mmap]) -> WavFormat:
+    """Find the format and the audio data in a RIFF WAVE file"""
+    if len(data) < 12 or data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise UnsupportedWavError("Not a RIFF WAVE file")
+    position = 12
+    fmt: typing.Optional[tuple[int, int, int, int]] = None
+    while position + 8 <= len(data):
+        chunk_id = data[position:position + 4]
+        size, = struct.unpack_from("<I", data, position + 4)
+        body = position + 8
+        if chunk_id == b"fmt ":
+            format_tag, channels, sample_rate, _, _, bits = struct.unpack_from("<HHIIHH", data, body)
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and size >= 40:
+                # The real format is the first two bytes of the sub format GUID
+                format_tag, = struct.unpack_from("<H", data, body + 24)
+            fmt = (format_tag, channels, sample_rate, bits)
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise UnsupportedWavError("Audio data comes before the format")
+            format_tag, channels, sample_rate, bits = fmt
+            if (format_tag, bits) not in SUPPORTED_FORMATS:
+                raise UnsupportedWavError(f"Unsupported sample format {format_tag} with {bits} bits")
+            if channels < 1 or sample_rate < 1:
+                raise UnsupportedWavError(f"Bad format with {channels} channels at {sample_rate}Hz")
+            # Streamed WAVs may not know their size, so don't trust it past the end of the file
+            size = min(size, len(data) - body)
+            return WavFormat(*fmt, data_offset=body, data_size=size)
+        # Chunks are padded to an even length
+        position = body + size + (size & 1)
+    raise UnsupportedWavError("No audio data")
+
+
+def _to_float(format: WavFormat, data: np_typing.NDArray[np.uint8]) -> np_typing.NDArray[np.float32]:
+    """Scale samples of any supported format to float32 in -1 to 1"""
+    match format.format_tag, format.bits:
+        case (0x0001, 8):  # WAVE_FORMAT_PCM, 8 bit is unsigned
+            return (data.astype(np.float32) - 128) / 128
+        case (0x0001, 16):
+            return data.view("<i2").astype(np.float32) / 32768
+        case (0x0001, 24):
+            triples = data[:len(data) - len(data) % 3].reshape(-1, 3).astype(np.int32)
+            samples = triples[:, 0] | (triples[:, 1] << 8) | (triples[:, 2] << 16)
+            samples = np.where(samples & 0x800000, samples - 0x1000000, samples)
+            return samples.astype(np.float32) / 8388608
+        case (0x0001, 32):
+            return data.view("<i4").astype(np.float32) / 2147483648
+        case (0x0003, 32):  # WAVE_FORMAT_IEEE_FLOAT
+            return data.view("<f4").astype(np.float32)
+        case (0x0003, 64):
+            return data.view("<f8").astype(np.float32)
+    raise UnsupportedWavError(f"Unsupported sample format {format.format_tag} with {format.bits} bits")
+
+
+def convert(format: WavFormat, data: np_typing.NDArray[np.uint8]) -> np_typing.NDArray[np.int16]:
+    """Convert audio data in any rate, layout and sample format to 48kHz stereo int16"""
+    block = format.bits // 8 * format.channels
+    data = data[:len(data) - len(data) % block]
+    samples = _to_float(format, data).reshape(-1, format.channels)
+    if format.channels == 1:
+        samples = np.repeat(samples, 2, axis=1)
+    elif format.channels > 2:
+        # Keep the front left and right
+        samples = samples[:, :2]
+    if format.sample_rate != SAMPLE_RATE and len(samples):
+        frames = len(samples) * SAMPLE_RATE // format.sample_rate
+        positions = np.arange(frames, dtype=np.float64) * (format.sample_rate / SAMPLE_RATE)
+        source_positions = np.arange(len(samples), dtype=np.float64)
+        samples = np.stack([np.interp(positions, source_positions, samples[:, channel]) for channel in range(2)],
+                           axis=1)
+    output = np.empty(samples.shape, dtype=AUDIO_DATA_TYPE)
+    np.clip(samples * 32768, -32768, 32767, out=samples)
+    np.copyto(output, samples, casting="unsafe")
+    return output.reshape(-1)
+
+
+def is_pcm_file(file: typing.Union[str, Path]) -> bool:
+    """Is this a local uncompressed file we can play without FFmpeg?"""
+    if isinstance(file, str) and file.startswith("http"):
+        return False
+    return Path(file).suffix.lower() in WAV_EXTENSIONS | RAW_EXTENSIONS
+
+
+def _map(path: Path) -> typing.Optional[mmap.mmap]:
+    with open(path, "rb") as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return None
+    mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped
+
+
+async def load_pcm_file(path: Path) -> typing.Optional[np_typing.NDArray[np.int16]]:
+    """
+    Map a WAV or raw PCM file into memory as 48kHz stereo int16.
+
+    If it's already in that format the result is a view straight into the map, so nothing is read until the mixer
+    gets to it. Other formats are converted all at once in a thread.
+
+    :return: The audio, or None if it isn't a file we can read, in which case FFmpeg should have a go
+    """
+    try:
+        mapped = _map(path)
+    except OSError as e:
+        logger.warning(f"Couldn't map {path} ({e})")
+        return None
+    if mapped is None:
+        return None
+    if path.suffix.lower() in RAW_EXTENSIONS:
+        usable = len(mapped) - len(mapped) % (2 * AUDIO_DATA_TYPE.itemsize)
+        return np.frombuffer(mapped, dtype=AUDIO_DATA_TYPE, count=usable // AUDIO_DATA_TYPE.itemsize)
+    try:
+        format = parse_wav(mapped)
+        if format.is_native():
+            frame = 2 * AUDIO_DATA_TYPE.itemsize
+            return np.frombuffer(mapped, dtype=AUDIO_DATA_TYPE, offset=format.data_offset,
+                                 count=(format.data_size - format.data_size % frame) // AUDIO_DATA_TYPE.itemsize)
+        data = np.frombuffer(mapped, dtype=np.uint8, offset=format.data_offset, count=format.data_size)
+        return await asyncio.get_running_loop().run_in_executor(None, convert, format, data)
+    except (UnsupportedWavError, struct.error) as e:
+        logger.info(f"Can't read {path} ourselves, leaving it to FFmpeg ({e})")
+        return None
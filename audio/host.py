@@ -1,5 +1,4 @@
 import asyncio
-import concurrent.futures
 import logging
 import multiprocessing.connection
 import traceback
@@ -14,6 +13,7 @@ from hikari.api import VoiceConnection as AbstractVoiceConnection, VoiceComponen
 
 from audio.connection.client import process_runtime
 from audio.connection.process_bridge import AbstractCommunicationBridge
+from audio.connection.supervisor import SupervisedProcess
 from audio.data.audio import AudioFile
 
 from audio.connection.server import MANAGER_PORT, manager
@@ -36,13 +36,17 @@ def _msg_to_event(message: typing.Any) -> events.Event:
 
 
 class VoiceConnection(BackgroundTasks, AbstractVoiceConnection):
-    _POOL = concurrent.futures.ProcessPoolExecutor()
+    # Run guilds in this many worker processes that each host many of them, rather than a process per guild
+    WORKERS: typing.Optional[int] = None
+    # Idle voice processes to keep started ahead of time when running a process per guild, so joins don't wait on one
+    WARM_PROCESSES = 2
 
     def __init__(self, job: asyncio.Future, on_close: typing.Callable[["VoiceConnection"], typing.Awaitable[None]],
                  channel_id: snowflakes.Snowflake, endpoint: str, guild_id: snowflakes.Snowflake, owner: VoiceComponent,
                  session_id: str, shard_id: int, token: str, user_id: snowflakes.Snowflake) -> None:
         super().__init__()
         self.job = job
+        self.process: typing.Optional[SupervisedProcess] = None  # Our process, unless we're sharing a worker's
         self.close_callback = on_close
 
         self._is_alive = True
@@ -72,11 +76,6 @@ class VoiceConnection(BackgroundTasks, AbstractVoiceConnection):
         """Here we wait for the coprocess to end. This should be the main way of exiting the connection."""
         try:
             await self.job
-        except concurrent.futures.process.BrokenProcessPool:
-            traceback.print_exc()
-            logger.info("Repairing process pool...")
-            self.__class__._POOL.shutdown()
-            self.__class__._POOL = concurrent.futures.ProcessPoolExecutor()
         except (KeyboardInterrupt, asyncio.CancelledError):
             pass
         finally:
@@ -99,20 +98,42 @@ class VoiceConnection(BackgroundTasks, AbstractVoiceConnection):
                          on_close: typing.Callable[["VoiceConnection"], typing.Awaitable[None]], owner: VoiceComponent,
                          session_id: str, shard_id: int, token: str, user_id: snowflakes.Snowflake,
                          **kwargs: typing.Any) -> Self:
-        loop = asyncio.get_running_loop()
         await manager.start_server()
 
         if not isinstance(owner, VoiceComponent):
             raise Exception("hikari is not configured to use Atsume's custom VoiceComponent class")
 
-        job: asyncio.Future = loop.run_in_executor(cls._POOL, process_runtime, channel_id, endpoint, guild_id, session_id,
-                                                   token, user_id, MANAGER_PORT)
+        job: asyncio.Future
+        process: typing.Optional[SupervisedProcess] = None
+        session = {"channel_id": int(channel_id), "endpoint": endpoint, "session_id": session_id, "token": token,
+                   "user_id": int(user_id)}
+        if cls.WORKERS:
+            job = await manager.worker_pool(cls.WORKERS).start_session(int(guild_id), session)
+        else:
+            group = f"voice-{guild_id}"
+            await manager.supervisor.wait_to_start(group)
+            if cls.WARM_PROCESSES:
+                process = await manager.warm_pool(cls.WARM_PROCESSES).take(int(guild_id), session)
+            if not process:
+                process = manager.supervisor.spawn(group, process_runtime, channel_id, endpoint, guild_id,
+                                                   session_id, token, user_id, MANAGER_PORT,
+                                                   manager.supervisor.config.heartbeat_interval)
+            job = process.job
         connection = cls(job, on_close, channel_id, endpoint, guild_id, owner, session_id, shard_id,
                          token, user_id)
+        connection.process = process
         await manager.add_listener(guild_id, connection)
         connection.start_background_task(connection.job_end())
         return connection
 
+    @classmethod
+    async def warm_up(cls) -> None:
+        """Start the warm voice processes, so even the first join doesn't have to wait for one"""
+        if cls.WORKERS or not cls.WARM_PROCESSES:
+            return
+        await manager.start_server()
+        manager.warm_pool(cls.WARM_PROCESSES).fill()
+
     async def _set_connection(self, connection: AbstractCommunicationBridge) -> None:
         self.client_connection = connection
         self._client_task = asyncio.Task(self.client_task())
@@ -122,8 +143,12 @@ class VoiceConnection(BackgroundTasks, AbstractVoiceConnection):
         try:
             while self._is_alive and self.client_connection:
                 data = await self.client_connection.read()
-                print("bot got", data)
                 j = json.loads(data.decode())
+                if "heartbeat" in j:
+                    if self.process:
+                        self.process.heartbeat(j["heartbeat"])
+                    continue
+                logger.debug(f"Bot got {data}")
                 if j.get("event", None):
                     event = _msg_to_event(j)
                     for handler in self._event_subscribers:
@@ -215,6 +240,24 @@ class VoiceConnection(BackgroundTasks, AbstractVoiceConnection):
     async def pause(self, channel: str):
         await self._send_message({"command": "pause", "channel": channel})
 
+    async def set_volume(self, channel: str, volume: float, seconds: float = 0, shape: str = "linear"):
+        await self._send_message({"command": "set_volume", "channel": channel, "volume": volume,
+                                  "seconds": seconds, "shape": shape})
+
+    async def fade(self, channel: str, volume: float, seconds: float, shape: str = "exponential"):
+        await self._send_message({"command": "fade", "channel": channel, "volume": volume,
+                                  "seconds": seconds, "shape": shape})
+
+    async def seek(self, channel: str, seconds: float):
+        await self._send_message({"command": "seek", "channel": channel, "seconds": seconds})
+
+    async def set_encoder_profile(self, profile: typing.Optional[dict] = None, channel: typing.Optional[str] = None):
+        """
+        Pin the encoder settings for this guild, or for while only the given channel is playing. Takes the fields of
+        an EncoderProfile, or None to go back to the default.
+        """
+        await self._send_message({"command": "set_encoder_profile", "profile": profile, "channel": channel})
+
     async def queue(self, channel: str, file: AudioFile):
         self._has_queue = True
         await self._send_message({"command": "queue", "channel": channel, "audio": file.as_dict()})
@@ -225,6 +268,13 @@ class VoiceConnection(BackgroundTasks, AbstractVoiceConnection):
         result = await self.await_callback(id)
         return result["state"]
 
+    async def preload_stats(self) -> dict:
+        """How the worker's downloads are doing: counts, bandwidth in bytes/s and memory use in bytes"""
+        id = self._get_id()
+        await self._send_message({"command": "preload_stats", "id": id})
+        result = await self.await_callback(id)
+        return result["stats"]
+
     async def queue_and_wait(self, channel: str, file: AudioFile):
         self._has_queue = True
         id = self._get_id()
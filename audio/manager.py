@@ -28,6 +28,10 @@ class VoiceComponent(BackgroundTasks, hikari.impl.VoiceComponentImpl):
         super().__init__(app)
         self._proxies: dict[hikari.snowflakes.Snowflake, weakref.WeakSet["VoiceConnectionProxy"]] = {}
         self._closing_connections: set[VoiceConnection] = set()
+        app.event_manager.subscribe(hikari.StartedEvent, self._on_started)
+
+    async def _on_started(self, event: hikari.StartedEvent) -> None:
+        await VoiceConnection.warm_up()
 
     async def connect_to(
             self,
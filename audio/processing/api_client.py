@@ -1,8 +1,9 @@
 import logging
 import typing
 from audio.utils.json import json
-from audio.data.audio import AudioFile
+from audio.data.audio import AudioFile, EncoderProfile
 from audio.data.events import Event
+from audio.processing.automation import RampShape
 
 if typing.TYPE_CHECKING:
     from audio.processing.manager import AudioManager
@@ -38,6 +39,20 @@ class APIClient:
                     audio_file = AudioFile(**data["audio"])
                     audio_file.async_file = await self.manager.files.open(audio_file)
                     await self.manager.pipeline.queue(data["channel"], audio_file)
+                case "set_volume":
+                    self.manager.pipeline.channels[data["channel"]].set_volume(
+                        data["volume"], data.get("seconds", 0), RampShape(data.get("shape", RampShape.LINEAR.value))
+                    )
+                case "fade":
+                    self.manager.pipeline.channels[data["channel"]].set_volume(
+                        data["volume"], data["seconds"], RampShape(data.get("shape", RampShape.EXPONENTIAL.value))
+                    )
+                case "seek":
+                    await self.manager.pipeline.channels[data["channel"]].seek(data["seconds"])
+                case "set_encoder_profile":
+                    # A channel's profile is used while it's the only channel playing, otherwise it's the guild's
+                    profile = EncoderProfile(**data["profile"]) if data.get("profile") else None
+                    self.manager.governor.pin(profile, data.get("channel"))
                 case "stop":
                     await self.manager.client.graceful_stop()
                 case "is_playing":
@@ -48,8 +63,18 @@ class APIClient:
                             "state": self.manager.pipeline.channels[data["channel"]].is_playing()
                         })
                     )
+                case "preload_stats":
+                    await self.manager.client.manager_connection.write(
+                        json.dumps({
+                            "command": "preload_stats",
+                            "id": data["id"],
+                            "stats": self.manager.files.stats()
+                        })
+                    )
                 case _:
                     logger.error(f"Unknown command \"{data['command']}\"")
         except KeyError as e:
             args = "\", \"".join(e.args)
             logger.error(f"Command \"{data['command']}\" missing properties \"{args}\"")
+        except (ValueError, TypeError) as e:
+            logger.error(f"Command \"{data['command']}\" has invalid properties: {e}")
@@ -1,22 +1,101 @@
 import asyncio
+import logging
+import math
+import os
+import tempfile
+import time
 import traceback
 import typing
 import weakref
-from io import BytesIO
 from pathlib import Path
 import aiohttp
 import aiofiles
-from audio.data.audio import AudioFile
+from audio.data.audio import AudioFile, DownloadCacheConfig, PreloadConfig
+from audio.processing.download_cache import DownloadCache
 from audio.utils.background_tasks import BackgroundTasks
+from audio.utils.hashing import url_hash
+from audio.utils.segmented_buffer import SegmentedBuffer
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadMemory:
+    """
+    Keeps the downloads every AsyncFileManager in the process holds in memory under one budget, so a worker
+    hosting many guilds doesn't get a budget for each of them.
+    """
+    def __init__(self, config: PreloadConfig) -> None:
+        self.budget = config.memory_budget
+        self.spill_path = config.spill_path
+        self.managers: weakref.WeakSet["AsyncFileManager"] = weakref.WeakSet()
+
+    def used(self) -> int:
+        return sum(manager.memory_used() for manager in self.managers)
+
+    def check(self):
+        """Spill downloads to disk, latest to play first, until the ones in memory fit in the budget"""
+        used = self.used()
+        if used <= self.budget:
+            return
+        buffered = []
+        for manager in self.managers:
+            order = manager.rank() if manager.rank else {}
+            buffered += [(order.get(file, math.inf), file) for file in manager._alive()
+                         if not file.closed and file.buffer is not None and file.buffer.held]
+        buffered.sort(key=lambda item: item[0], reverse=True)
+        for _, file in buffered:
+            if used <= self.budget:
+                break
+            used -= file.buffer.held
+            logger.info(f"Spilling {file} to disk")
+            try:
+                file.buffer.spill(tempfile.TemporaryFile(dir=self.spill_path))
+            except OSError:
+                traceback.print_exc()
+                return
 
 
 class AsyncFileManager(BackgroundTasks):
-    def __init__(self, cache_path: typing.Optional[Path] = None, max_preload: int = 3):
+    """
+    Opens AsyncFiles and decides which to download ahead of time.
+
+    Files are prefetched in the order they'll play across every channel, as long as there's bandwidth for another
+    download. Files that are about to play are urgent: they always start straight away, and prefetches hold off
+    while one is downloading, so the next track never waits behind one far down the queue. An urgent download that
+    goes stall_timeout without any data stops holding them back. Downloads held in memory are spilled to disk once
+    they go over a budget, latest to play first.
+    """
+    BANDWIDTH_WINDOW = 1  # Seconds to measure download speed over
+
+    def __init__(self, cache_path: typing.Optional[Path] = None, cache_budget: int = DownloadCacheConfig.budget,
+                 config: typing.Optional[PreloadConfig] = None,
+                 rank: typing.Optional[typing.Callable[[], dict["AsyncFile", float]]] = None,
+                 memory: typing.Optional[DownloadMemory] = None):
+        """
+        :param rank: Gets how many seconds until each queued file plays. Without it files are prefetched in the
+                     order they were opened.
+        :param memory: The memory budget for downloads, shared with other guilds in the process, otherwise we make
+                       our own
+        """
         super().__init__()
         self.cache_path = cache_path
-        self.max_preload = max_preload
-        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60*60*5))
+        self.cache: typing.Optional[DownloadCache] = None
+        if cache_path is not None:
+            try:
+                self.cache = DownloadCache(DownloadCacheConfig(cache_path, cache_budget))
+            except OSError:
+                logger.warning(f"Can't create the download cache at {cache_path}, only downloading into memory")
+        self.config = config or PreloadConfig()
+        self.rank = rank
+        self.memory = memory or DownloadMemory(self.config)
+        self.memory.managers.add(self)
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60*60*5,
+                                                                           sock_read=self.config.read_timeout))
         self.files = []
+        self.bandwidth: typing.Optional[float] = None  # Bytes/s all downloads together are getting
+        self._window_bytes = 0
+        self._window_start = time.monotonic()
+        self._changed = asyncio.Condition()  # Notified when a download starts or stops transferring
 
     async def open(self, audio_file: AudioFile):
         file = AsyncFile(self, audio_file)
@@ -27,24 +106,105 @@ class AsyncFileManager(BackgroundTasks):
     def _flush(self):
         self.files = [x for x in self.files if x() is not None]
 
-    async def preload(self):
-        # Start preloading extra files in queue if we can
-        current_downloads = 0
+    def _alive(self) -> list["AsyncFile"]:
         self._flush()
-        for f in self.files:
-            file = f()
-            if file.download_job is not None and not file.downloaded_file:
-                current_downloads += 1
-        if current_downloads < self.max_preload:
-            downloads_left = self.max_preload - current_downloads
-            for f in self.files:
-                if downloads_left == 0:
-                    break
-                file = f()
-                if file.download_job is None and not file.downloaded_file:
-                    print("Preloading", file)
+        return [file for file in (f() for f in self.files) if file is not None]
+
+    async def preload(self):
+        """Start prefetching the files that will play soonest, as far as the budgets allow"""
+        files = self._alive()
+        order = self.rank() if self.rank else None
+        prefetching = sum(1 for file in files if file.downloading and not file.urgent)
+        pending = []
+        for file in files:
+            if file.downloaded_file or file.closed:
+                continue
+            if order is not None:
+                if file not in order:
+                    # Not queued anywhere, so it's on its way out
+                    continue
+                if order[file] <= self.config.urgent_within:
                     await file.open()
-                    downloads_left -= 1
+                    continue
+            if file.download_job is None:
+                pending.append(file)
+        if order is not None:
+            pending.sort(key=order.__getitem__)
+        for file in pending:
+            if prefetching >= self.config.max_downloads or not self._can_prefetch():
+                break
+            logger.debug(f"Preloading {file}")
+            file.start()
+            prefetching += 1
+
+    def _can_prefetch(self) -> bool:
+        """Is there bandwidth for one more download?"""
+        transferring = sum(1 for file in self._alive() if file.transferring)
+        if not transferring or self.bandwidth is None:
+            return True
+        return self.bandwidth / (transferring + 1) >= self.config.min_rate
+
+    def record(self, size: int):
+        """Count bytes downloaded towards the bandwidth measurement"""
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed > self.BANDWIDTH_WINDOW * 5:
+            # Nothing was downloading for a while, start measuring again
+            self._window_start = now
+            self._window_bytes = size
+            return
+        self._window_bytes += size
+        if elapsed >= self.BANDWIDTH_WINDOW:
+            rate = self._window_bytes / elapsed
+            self.bandwidth = rate if self.bandwidth is None else self.bandwidth * 0.7 + rate * 0.3
+            self._window_start = now
+            self._window_bytes = 0
+
+    def urgent_busy(self) -> bool:
+        return any(file.urgent and file.transferring and not file.stalled for file in self._alive())
+
+    async def wait_for_urgent(self):
+        """Wait until no urgent files are downloading, or the ones that are have stalled"""
+        async with self._changed:
+            while self.urgent_busy():
+                try:
+                    # Stalling doesn't notify anyone, so check again every so often
+                    await asyncio.wait_for(self._changed.wait(), self.config.stall_timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def changed(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    def memory_used(self) -> int:
+        return sum(file.buffer.held for file in self._alive() if not file.closed and file.buffer is not None)
+
+    def check_memory(self):
+        self.memory.check()
+
+    def stats(self) -> dict[str, typing.Any]:
+        """The scheduler's state, for metrics"""
+        files = self._alive()
+        downloading = [file for file in files if file.downloading]
+        return {
+            "downloading": len(downloading),
+            "urgent": sum(1 for file in downloading if file.urgent),
+            "transferring": sum(1 for file in downloading if file.transferring),
+            "pending": sum(1 for file in files if file.download_job is None and not file.downloaded_file),
+            "bandwidth": int(self.bandwidth or 0),
+            "memory": self.memory_used(),
+            "process_memory": self.memory.used(),
+            "memory_budget": self.memory.budget,
+            "spilled": sum(1 for file in files if file.buffer is not None and file.buffer.spilled),
+        }
+
+    async def close(self):
+        for task in list(self._background_tasks):
+            task.cancel()
+        for file in self._alive():
+            await file.close()
+        await self.session.close()
 
     def __del__(self):
         for task in list(self._background_tasks):
@@ -53,91 +213,238 @@ class AsyncFileManager(BackgroundTasks):
 
 class AsyncFile:
     CHUNK_SIZE = 4096
-    BUFFER_THRESHOLD = 1024 * 1024
+    MAX_BUFFERED = 16 * 1024 * 1024  # Bytes downloaded ahead of the reader before the download waits for it
+    MAX_RESUMES = 5  # Times to pick an interrupted download back up with a Range request
+    FOLLOW_INTERVAL = 0.05  # Seconds between checks on a download another process is doing for us
 
     def __init__(self, manager: AsyncFileManager, audio_file: AudioFile):
         self.manager = manager
         self.file_path = audio_file.file
         self.cache_name = audio_file.cache_name
         self.title = audio_file.title
-        self.buffer = BytesIO()
-        self.buffers = [BytesIO()]
+        self.buffer: typing.Optional[SegmentedBuffer] = SegmentedBuffer()
         self.file = None
-        self.has_seeked_file = False
+        self.cache_file: typing.Optional[Path] = None  # Where the finished download is in the shared cache
         self.cursor = 0
-        self.size = 0
+        self.size = 0  # Bytes we have, in the buffer or the file
         self.downloaded_file = False  # Has file completely and fully downloaded?
+        self.failed = False  # Did the download stop early?
+        self.accepts_ranges = False  # Can we ask the server for part of the file?
         self.download_job: typing.Optional[asyncio.Task] = None
+        self.urgent = False  # Is it about to play? Prefetches make way for it
+        self.transferring = False  # Are bytes coming in right now, rather than waiting on the reader or others?
+        self.last_progress = time.monotonic()  # When data last came in, or transferring last changed
+        self.closed = False
 
         # Read needs to await the download start in order to potentially have data to read
         self.read = self._preload_read
         self._read_ready = asyncio.Event()   # Is ready to start reading?
+        self._grown = asyncio.Condition()  # Notified when a file being downloaded gets bigger
+        self._file_lock = asyncio.Lock()  # Held while reading the file, so it can't be swapped out mid-read
 
     async def open(self):
-        if not self.download_job:
+        """Start downloading, the file is about to play"""
+        if not self.urgent:
+            self.urgent = True
+            await self.manager.changed()
+        self.start()
+
+    def start(self):
+        if not self.download_job and not self.closed:
             self.download_job = asyncio.create_task(self._open())
 
+    @property
+    def downloading(self) -> bool:
+        return self.download_job is not None and not self.downloaded_file
+
+    @property
+    def stalled(self) -> bool:
+        """Is it supposed to be downloading, but hasn't had any data for a while?"""
+        return self.transferring and time.monotonic() - self.last_progress > self.manager.config.stall_timeout
+
+    async def _set_transferring(self, transferring: bool):
+        if transferring != self.transferring:
+            self.transferring = transferring
+            self.last_progress = time.monotonic()
+            await self.manager.changed()
+
     async def _open(self):
         try:
             if isinstance(self.file_path, str) and self.file_path.startswith("http"):
-                async with self.manager.session.get(self.file_path) as resp:
-                    self._read_ready.set()
-                    # Use file cache
-                    if self.cache_name and self.manager.cache_path:
-                        f = await aiofiles.open(self.manager.cache_path / self.cache_name, 'wb')
-                        await self._download_with_file(resp, f)
-                        await f.close()
-                        self.file = await aiofiles.open(self.manager.cache_path / self.cache_name, 'rb')
-                        self.buffer = None
-                    # Only read from memory
-                    else:
-                        await self._download_only_cache(resp)
+                # Use file cache
+                if self.manager.cache:
+                    self.buffer = None
+                    await self._open_cached(self.manager.cache)
+                # Only read from memory
+                else:
+                    await self._download()
             else:
                 file = self.file_path
                 if not isinstance(file, Path):
                     file = Path(file)
                 assert file.exists()
-                self.file = await aiofiles.open(file, 'rb')
                 self.buffer = None
+                await self._open_file(file)
+                self.size = os.fstat(self.file.fileno()).st_size
                 self._read_ready.set()
-            print("Download finished for", self)
+            logger.debug(f"Download finished for {self}")
         except asyncio.exceptions.CancelledError:
-            print("Cancelling download")
+            logger.debug(f"Cancelled the download of {self}")
+            self.failed = True
         except FileNotFoundError:
-            print(f"Error: {self.file_path} not found.")
+            logger.error(f"{self.file_path} not found")
+            self.failed = True
         except:
-            print(traceback.format_exc())
+            logger.exception(f"Download of {self} failed")
+            self.failed = True
         finally:
             self._read_ready.set()
-        self.manager.start_background_task(self.manager.preload())
         self.downloaded_file = True
+        await self._set_transferring(False)
+        self.manager.start_background_task(self.manager.preload())
+        if self.buffer is not None:
+            await self.buffer.close()
+        async with self._grown:
+            self._grown.notify_all()
+
+    async def _open_cached(self, cache: DownloadCache):
+        """Read the file from the shared cache, downloading it there unless another process already is"""
+        key = url_hash(self.file_path, self.cache_name)
+        while True:
+            path = cache.open_entry(key)
+            if path is not None:
+                logger.debug(f"Found {self} in the download cache")
+                await self._open_file(path)
+                self.size = os.fstat(self.file.fileno()).st_size
+                self.cache_file = path
+                self._read_ready.set()
+                return
+            lock = cache.lock(key)
+            if lock is None:
+                if await self._follow(cache, key):
+                    return
+                # Whoever was downloading it gave up, so have a go ourselves
+                continue
+            try:
+                if cache.open_entry(key) is not None:
+                    # It was finished between us looking and taking the lock
+                    continue
+                part = cache.part(key)
+                f = await aiofiles.open(part, 'wb', buffering=0)
+                try:
+                    await self._set_size(0)
+                    await self._open_file(part)
+                    await self._download(f)
+                finally:
+                    await f.close()
+                if not self.failed:
+                    self.cache_file = cache.commit(key)
+                # Otherwise leave the part file, the next one to download it starts it over
+                return
+            finally:
+                cache.unlock(lock)
+
+    async def _follow(self, cache: DownloadCache, key: str) -> bool:
+        """
+        Read a file another process is downloading as it grows.
+
+        :return: If it finished, or False if the download stopped and we should take over
+        """
+        try:
+            await self._open_file(cache.part(key))
+        except FileNotFoundError:
+            # They haven't started yet, or just finished
+            await asyncio.sleep(self.FOLLOW_INTERVAL)
+            return False
+        logger.debug(f"Following a download of {self} by another worker")
+        self._read_ready.set()
+        fd = self.file.fileno()
+        while True:
+            await self._set_size(os.fstat(fd).st_size)
+            if cache.is_entry(key, fd):
+                await self._set_size(os.fstat(fd).st_size)
+                self.cache_file = cache.entry(key)
+                return True
+            lock = cache.lock(key)
+            if lock is not None:
+                cache.unlock(lock)
+                # They stopped, unless they finished right after we looked
+                if not cache.is_entry(key, fd):
+                    return False
+                continue
+            await asyncio.sleep(self.FOLLOW_INTERVAL)
+
+    async def _open_file(self, path: Path):
+        async with self._file_lock:
+            if self.file:
+                await self.file.close()
+            self.file = await aiofiles.open(path, 'rb')
+            await self.file.seek(self.cursor)
+
+    async def _set_size(self, size: int):
+        self.size = size
+        async with self._grown:
+            self._grown.notify_all()
+
+    async def _download(self, f=None):
+        """Download the file, picking it back up from where it stopped with a Range request if it gets cut off"""
+        resumes = 0
+        while True:
+            headers = {"Range": f"bytes={self.size}-"} if self.size else None
+            try:
+                async with self.manager.session.get(self.file_path, headers=headers) as resp:
+                    if self.size and resp.status != 206:
+                        logger.warning(f"Server won't resume {self}, giving up at {self.size} bytes")
+                        self.failed = True
+                        return
+                    resp.raise_for_status()
+                    self.accepts_ranges = resp.status == 206 or resp.headers.get("Accept-Ranges") == "bytes"
+                    self._read_ready.set()
+                    await self._set_transferring(True)
+                    if f:
+                        await self._download_with_file(resp, f)
+                    else:
+                        await self._download_only_cache(resp)
+                return
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                resumes += 1
+                if not self.accepts_ranges or resumes > self.MAX_RESUMES:
+                    raise
+                logger.info(f"Download of {self} was interrupted ({e}), resuming from {self.size} bytes")
+                await asyncio.sleep(resumes)
 
     async def _download_with_file(self, resp, f):
         async for chunk in resp.content.iter_chunked(self.CHUNK_SIZE):
-            # print("Downloading chunk...", self.size)
+            self.last_progress = time.monotonic()
+            self.manager.record(len(chunk))
             await f.write(chunk)
-            self.buffer.write(chunk)
-            self.size += len(chunk)
-            # await asyncio.sleep(.1)
+            await self._set_size(self.size + len(chunk))
+            await self._make_way()
 
     async def _download_only_cache(self, resp):
         async for chunk in resp.content.iter_chunked(self.CHUNK_SIZE):
-            # print("Downloading chunk...", self.size, self.buffer.getbuffer().nbytes)
-            self.buffer.seek(self.buffer.getbuffer().nbytes)
-            self.buffer.write(chunk)
-            self.size += len(chunk)
-            # try:
-            #     assert self.size == self.buffer.getbuffer().nbytes
-            # except AssertionError as e:
-            #     print("WTF", len(chunk), self.size, self.buffer.getbuffer().nbytes)
-            #     self.size = self.buffer.getbuffer().nbytes
-
-    async def _write_to_buffer(self, chunk):
-        if len(self.buffers) == 1:
-            if self.buffers[0].getbuffer().nbytes > self.BUFFER_THRESHOLD:
-                self.buffers.append(BytesIO())
-        self.buffers[-1].write(chunk)
-        self.size += self.CHUNK_SIZE
+            self.last_progress = time.monotonic()
+            self.manager.record(len(chunk))
+            await self._write_to_buffer(chunk)
+            await self._make_way()
+
+    async def _write_to_buffer(self, chunk: bytes):
+        # Don't get too far ahead of the reader, a long track would otherwise end up entirely in memory.
+        # The server is left waiting while we do, so only if we can resume the download when it gives up on us.
+        if self.accepts_ranges and self.buffer.size - self.buffer.released > self.MAX_BUFFERED:
+            await self._set_transferring(False)
+            await self.buffer.wait_for_reader(self.MAX_BUFFERED)
+            await self._set_transferring(True)
+        await self.buffer.write(chunk)
+        self.size += len(chunk)
+        self.manager.check_memory()
+
+    async def _make_way(self):
+        """Hold a prefetch back while a file that's about to play is downloading"""
+        if not self.urgent and self.manager.urgent_busy():
+            await self._set_transferring(False)
+            await self.manager.wait_for_urgent()
+            await self._set_transferring(True)
 
     async def _preload_read(self, chunk: int):
         await self._read_ready.wait()
@@ -145,31 +452,47 @@ class AsyncFile:
         return await self._after_load_read(chunk)
 
     async def _after_load_read(self, chunk: int):
-        if self.buffer:
-            while self.buffer.getbuffer().nbytes - self.cursor < chunk and not self.downloaded_file:
-                # print("Waiting for chunk...")
-                await asyncio.sleep(.2)
-        if not self.file:
-            # print("Retrieving from buffer", self.cursor, self.buffer.getbuffer().nbytes, self.size)
-            self.buffer.seek(self.cursor)
-            data = self.buffer.read(chunk)
+        if self.buffer is not None:
+            # Wakes up as soon as the download gets far enough, or stops
+            await self.buffer.wait_for(self.cursor + chunk)
+            data = self.buffer.read(self.cursor, chunk)
+            await self.buffer.release(self.cursor + len(data))
+        elif self.file:
+            end = self.cursor + chunk
+            if self.size < end and not self.downloaded_file:
+                async with self._grown:
+                    await self._grown.wait_for(lambda: self.size >= end or self.downloaded_file)
+            async with self._file_lock:
+                data = await self.file.read(min(chunk, max(self.size - self.cursor, 0)))
         else:
-            if not self.has_seeked_file:
-                print("Transferring from buffer to file")
-                await self.file.seek(self.cursor)
-                self.has_seeked_file = True
-            data = await self.file.read(chunk)
+            # Didn't get as far as opening anything
+            data = b""
         self.cursor += len(data)
         return data
 
+    @property
+    def local_path(self) -> typing.Optional[Path]:
+        """A path to the whole file on disk, if there is one"""
+        if not (isinstance(self.file_path, str) and self.file_path.startswith("http")):
+            return Path(self.file_path)
+        if self.downloaded_file and not self.failed:
+            return self.cache_file
+        if self.download_job is None and self.manager.cache:
+            # Another worker may have downloaded it already
+            return self.manager.cache.open_entry(url_hash(self.file_path, self.cache_name))
+        return None
+
     def finished_reading(self):
         if self.downloaded_file:
             return self.cursor >= self.size
         return False
 
     async def close(self):
+        self.closed = True
         if self.download_job:
             self.download_job.cancel()
+        if self.buffer is not None:
+            self.buffer.discard()
         if self.file:
             await self.file.close()
 
@@ -179,3 +502,30 @@ class AsyncFile:
 
     def __repr__(self):
         return f"AsyncFile({self.title}, {self.file_path})"
+
+
+class PrefixedFile:
+    """Reads out bytes we already have before carrying on with the rest of an AsyncFile"""
+    def __init__(self, prefix: bytes, file: AsyncFile):
+        self.prefix = memoryview(prefix)
+        self.file = file
+
+    async def read(self, chunk: int) -> bytes:
+        if self.prefix:
+            data = bytes(self.prefix[:chunk])
+            self.prefix = self.prefix[chunk:]
+            return data
+        return await self.file.read(chunk)
+
+    def finished_reading(self) -> bool:
+        return not self.prefix and self.file.finished_reading()
+
+    @property
+    def failed(self) -> bool:
+        return self.file.failed
+
+    async def close(self) -> None:
+        await self.file.close()
+
+    def __repr__(self) -> str:
+        return f"PrefixedFile({len(self.prefix)}, {self.file})"
@@ -1,25 +1,126 @@
+import collections
+import enum
+import typing
+
 import numpy as np
 import numpy.typing as np_typing
-from audio.utils.constants import AUDIO_DATA_TYPE, SAMPLE_RATE
+from audio.utils.constants import SAMPLE_RATE
+
+# Exponential ramps can't start or end at silence, so they ramp to -60dB and snap to 0 on the last sample
+EXPONENTIAL_FLOOR = 0.001
+# Bytes of rendered curves kept around for reuse, a 10 second stereo curve alone is almost 4MB
+CURVE_CACHE_BUDGET = 16 * 1024 * 1024
+
+
+class RampShape(enum.Enum):
+    LINEAR = "linear"
+    EXPONENTIAL = "exponential"
+    EQUAL_POWER = "equal_power"
+
+
+class _CurveCache:
+    """Least recently used curves, bounded by their size rather than how many there are"""
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        self.size = 0
+        self.curves: collections.OrderedDict[tuple, np_typing.NDArray[np.float32]] = collections.OrderedDict()
+
+    def get(self, key: tuple) -> typing.Optional[np_typing.NDArray[np.float32]]:
+        curve = self.curves.get(key)
+        if curve is not None:
+            self.curves.move_to_end(key)
+        return curve
+
+    def put(self, key: tuple, curve: np_typing.NDArray[np.float32]) -> None:
+        # One long fade shouldn't push out every short one
+        if curve.nbytes > self.budget // 8:
+            return
+        self.curves[key] = curve
+        self.size += curve.nbytes
+        while self.size > self.budget:
+            _, evicted = self.curves.popitem(last=False)
+            self.size -= evicted.nbytes
+
+
+_cache = _CurveCache(CURVE_CACHE_BUDGET)
 
 
-class VolumeAutomation:
-    def __init__(self, channel, from_target: float, to_target: float, seconds: float) -> None:
-        self.channel = channel
+def gain_curve(from_target: float, to_target: float, length: int, shape: RampShape,
+               channels: int = 2) -> np_typing.NDArray[np.float32]:
+    """
+    Render a gain ramp once so reading it back is just slicing.
+
+    :param length: Length of the ramp in audio frames
+    :return: A read-only float32 curve with one gain per interleaved sample
+    """
+    key = (from_target, to_target, length, shape, channels)
+    curve = _cache.get(key)
+    if curve is None:
+        curve = _render_curve(from_target, to_target, length, shape, channels)
+        _cache.put(key, curve)
+    return curve
+
+
+def _render_curve(from_target: float, to_target: float, length: int, shape: RampShape,
+                  channels: int) -> np_typing.NDArray[np.float32]:
+    position = np.arange(1, length + 1, dtype=np.float64) / length
+    match shape:
+        case RampShape.LINEAR:
+            curve = from_target + (to_target - from_target) * position
+        case RampShape.EXPONENTIAL:
+            start = max(from_target, EXPONENTIAL_FLOOR)
+            end = max(to_target, EXPONENTIAL_FLOOR)
+            curve = start * np.power(end / start, position)
+            curve[-1] = to_target
+        case RampShape.EQUAL_POWER:
+            # Rising ramps follow sin and falling ramps follow cos so a fade in and a fade out sum to equal power
+            if to_target >= from_target:
+                curve = from_target + (to_target - from_target) * np.sin(position * (np.pi / 2))
+            else:
+                curve = from_target + (to_target - from_target) * (1 - np.cos(position * (np.pi / 2)))
+    curve = np.repeat(curve.astype(np.float32), channels)
+    curve.flags.writeable = False
+    return curve
+
+
+class GainRamp:
+    def __init__(self, from_target: float, to_target: float, seconds: float,
+                 shape: RampShape = RampShape.LINEAR, channels: int = 2) -> None:
         self.from_target = from_target
         self.to_target = to_target
-        self.samples = seconds * SAMPLE_RATE
+        self.shape = shape
+        # Round the targets so ramps between nearly the same volumes share a cached curve
+        self.curve = gain_curve(round(from_target, 4), round(to_target, 4), max(int(seconds * SAMPLE_RATE), 1),
+                                shape, channels)
         self.current = 0
+        self._tail: np_typing.NDArray[np.float32] = np.zeros(0, dtype=np.float32)
 
     def is_automating(self) -> bool:
-        return self.current < self.samples - 1
+        return self.current < len(self.curve)
 
-    def read(self, size: int) -> tuple[np_typing.NDArray[np.int16], bool]:
-        diff = self.to_target - self.from_target
-        arr: np_typing.NDArray[np.int16] = np.fromfunction(  # type: ignore
-            lambda x: diff * ((x + self.current) / self.samples) + self.from_target, shape=(size,),
-            dtype=AUDIO_DATA_TYPE)
-        self.current += size
+    @property
+    def gain(self) -> float:
+        """The gain the ramp is currently at"""
+        if self.current == 0:
+            return self.from_target
         if not self.is_automating():
-            self.channel.automation_complete()
-        return arr, self.is_automating()
+            return self.to_target
+        return float(self.curve[self.current - 1])
+
+    def read(self, size: int) -> tuple[np_typing.NDArray[np.float32], bool]:
+        """
+        Read the next size samples of the ramp.
+
+        :return: The gain curve for those samples (only valid until the next read) and whether the ramp continues
+        """
+        start = self.current
+        self.current += size
+        if self.current <= len(self.curve):
+            return self.curve[start:self.current], self.is_automating()
+        # The last block runs past the end of the curve so hold the final value for the rest of it
+        if len(self._tail) != size:
+            self._tail = np.zeros(size, dtype=np.float32)
+        remaining = max(len(self.curve) - start, 0)
+        self._tail[:remaining] = self.curve[start:]
+        self._tail[remaining:] = self.to_target
+        return self._tail, False
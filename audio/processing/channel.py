@@ -1,66 +1,175 @@
 import typing
+from pathlib import Path
 
 import numpy as np
 from numpy import typing as np_typing
 
-from audio.processing.automation import VolumeAutomation
-from audio.data.audio import AudioFile
+from audio.processing.automation import GainRamp, RampShape
+from audio.data.audio import AudioFile, AudioChannelConfig
+from audio.data.wav import is_pcm_file, load_pcm_file
 from audio.data.events import AudioChannelEndAutomationEvent, AudioChannelEndEvent, AudioChannelNextEvent, AudioChannelStartEvent
-from audio.processing.source import AsyncFFmpegAudio
-from audio.utils.constants import AUDIO_DATA_TYPE
+from audio.processing.mixer import DuckingEnvelope, MixBus
+from audio.processing.source import AsyncFFmpegAudio, AudioSource, CachedPCMSource, OpusPassthroughSource
+from audio.utils.constants import AUDIO_DATA_TYPE, SAMPLE_RATE
 
 if typing.TYPE_CHECKING:
     from audio.processing.process import AudioPipeline
 
+# Guess for how long files we don't know the length of are, when working out when later ones will play
+DEFAULT_DURATION = 180
+
 
 class AudioChannel:
-    def __init__(self, pipeline: "AudioPipeline", name: str) -> None:
+    def __init__(self, pipeline: "AudioPipeline", config: AudioChannelConfig) -> None:
         self.pipeline = pipeline
-        self.name = name
+        self.name = config.name
+        self.priority = config.priority
+        self.ducking = DuckingEnvelope(config)
+        self.crossfade = config.crossfade
+        self.crossfade_size = int(config.crossfade * SAMPLE_RATE) * 2 * AUDIO_DATA_TYPE.itemsize
+        # Buffer at least a crossfade's worth of audio so we know when to start it
+        self.buffer_size = max(self.crossfade_size, AudioSource.DEFAULT_BUFFER_SIZE)
+        self.prepare_ahead = config.prepare_ahead
         self._queue: list[AudioFile] = []
-        self.source: typing.Optional[AsyncFFmpegAudio] = None
-        self.automation: typing.Optional[VolumeAutomation] = None
+        self.source: typing.Optional[AudioSource] = None
+        self.next_source: typing.Optional[AudioSource] = None
+        self._next_reserved = 0  # Memory set aside in the pipeline's budget for next_source
+        self._preparing = False
+        self._crossfade: typing.Optional[tuple[GainRamp, GainRamp]] = None
+        self._crossfade_bus = MixBus(3840 // 2)
+        self._frames: list[np_typing.NDArray[np.int16]] = [np.zeros(0, dtype=AUDIO_DATA_TYPE)] * 2
+        self.automation: typing.Optional[GainRamp] = None
         self.volume: float = 1
+        self._block_gain: float = 1  # Gain of the file(s) in the block last read, if the crossfade didn't apply it
         self._pause = False
 
     def __repr__(self) -> str:
         return f"AudioChannel({self.source} {'paused' if self._pause else 'play'} {self._queue})"
 
-    def set_volume(self, volume: float, seconds: float = 0) -> None:
-        if seconds:
-            self.automation = VolumeAutomation(self, self.volume, volume, seconds)
+    def set_volume(self, volume: float, seconds: float = 0, shape: RampShape = RampShape.LINEAR) -> None:
+        # Start from wherever a running ramp currently is so interrupting it doesn't jump
+        current = self.automation.gain if self.automation else self.volume
+        if seconds > 0:
+            self.automation = GainRamp(current, volume, seconds, shape)
         else:
+            self.automation = None
             self.volume = volume
 
+    async def gain(self, samples: int, ducked: bool
+                   ) -> tuple[float, typing.Optional[np_typing.NDArray[np.float32]]]:
+        """
+        Advance this channel's volume automation and ducking by a block.
+
+        :return: A constant gain for the block and an optional per-sample envelope to apply with it
+        """
+        duck_gain, duck_envelope = self.ducking.process(ducked, samples)
+        duck_gain *= self._block_gain
+        if not self.automation:
+            return self.volume * duck_gain, duck_envelope
+
+        ramp, keep_automating = self.automation.read(samples)
+        if not keep_automating:
+            self.volume = self.automation.to_target
+            self.automation = None
+            await self.pipeline.manager.send_event(AudioChannelEndAutomationEvent(self.name))
+        if duck_envelope is None:
+            return duck_gain, ramp
+        # The ducking envelope is scratch space that belongs to us for this block, so multiply into it
+        np.multiply(duck_envelope, ramp, out=duck_envelope)
+        return duck_gain, duck_envelope
+
     async def read(self, size: int = 3840) -> typing.Optional[typing.Optional[np_typing.NDArray[np.int16]]]:
-        """Read audio data from the current audio source"""
+        """Read audio data from the current audio source. Volume and ducking are applied later by the mix bus."""
         if not self.source or self._pause:
             return None
 
-        data = await self.source.read(size)
-        should_shift = False
-        if not data:
+        if not self._crossfade and self._should_crossfade():
+            self._start_crossfade()
+
+        samples = size // AUDIO_DATA_TYPE.itemsize
+        arr = self.source.read(size)
+        if arr is None and not self._crossfade:
+            # The source is still buffering
             return None
-        if len(data) < size:
-            should_shift = True
-            data += bytes(size - len(data))
-        arr = np.frombuffer(data, dtype=AUDIO_DATA_TYPE)
-        if self.automation:
-            automation, keep_automating = self.automation.read(size)
-            combined = np.stack([arr, automation])
-            arr = np.multiply.reduce(combined, 0)
-            if not keep_automating:
-                self.volume = self.automation.to_target
-                self.automation = None
-                await self.pipeline.manager.send_event(AudioChannelEndAutomationEvent(self.name))
-        elif self.volume != 1:
-            arr = (arr * self.volume).astype(np.int16)
+        self._block_gain = self.source.gain
+        should_shift = arr is not None and len(arr) < samples
+        if should_shift and self.next_source and not self._crossfade:
+            # Gapless playback, finish the frame with the start of the next track
+            assert arr is not None
+            arr = self._join_frame(0, samples, arr, self.next_source.read(size - arr.nbytes))
+        elif arr is None or len(arr) < samples:
+            arr = self._join_frame(0, samples, arr)
+
+        if self._crossfade:
+            arr = self._read_crossfade(arr, size)
+            self._block_gain = 1
 
         if should_shift:
             await self.shift()
+        self._check_prepare()
 
         return arr
 
+    def can_passthrough(self) -> bool:
+        """Can this channel's Opus packets go straight to the sender, skipping the mixer and encoder?"""
+        return (isinstance(self.source, OpusPassthroughSource) and self.source.passthrough and not self._pause
+                and self.source.gain == 1 and self.volume == 1 and not self.automation and self.ducking.gain == 1
+                and not self._crossfade)
+
+    async def read_packet(self) -> typing.Optional[bytes]:
+        """Read the next Opus packet from a passthrough source"""
+        assert isinstance(self.source, OpusPassthroughSource)
+        packet = self.source.read_packet()
+        if packet is None and self.source.finished_decoding():
+            await self.shift()
+        return packet
+
+    def _join_frame(self, index: int, samples: int,
+                    *parts: typing.Optional[np_typing.NDArray[np.int16]]) -> np_typing.NDArray[np.int16]:
+        """Copy partial reads into one of our scratch frames, padding the rest with silence"""
+        if len(self._frames[index]) != samples:
+            self._frames[index] = np.zeros(samples, dtype=AUDIO_DATA_TYPE)
+        frame = self._frames[index]
+        position = 0
+        for part in parts:
+            if part is None:
+                continue
+            frame[position:position + len(part)] = part
+            position += len(part)
+        frame[position:] = 0
+        return frame
+
+    def _should_crossfade(self) -> bool:
+        # We can only tell how much of the track is left once FFmpeg has finished decoding all of it
+        return bool(self.crossfade and self.source and self.next_source and self.source.finished_decoding()
+                    and self.source.buffered() <= self.crossfade_size)
+
+    def _start_crossfade(self) -> None:
+        assert self.source is not None
+        seconds = self.source.buffered() / (SAMPLE_RATE * 2 * AUDIO_DATA_TYPE.itemsize)
+        if seconds <= 0:
+            return
+        self._crossfade = (GainRamp(1, 0, seconds, RampShape.EQUAL_POWER),
+                           GainRamp(0, 1, seconds, RampShape.EQUAL_POWER))
+
+    def _read_crossfade(self, outgoing: np_typing.NDArray[np.int16], size: int) -> np_typing.NDArray[np.int16]:
+        """Overlap the end of the current track with the start of the next one"""
+        assert self._crossfade is not None and self.next_source is not None
+        samples = size // AUDIO_DATA_TYPE.itemsize
+        incoming = self.next_source.read(size)
+        if incoming is None or len(incoming) < samples:
+            incoming = self._join_frame(1, samples, incoming)
+        fade_out, fade_in = self._crossfade
+        out_ramp, _ = fade_out.read(samples)
+        in_ramp, keep_fading = fade_in.read(samples)
+        self._crossfade_bus.resize(samples)
+        self._crossfade_bus.clear()
+        self._crossfade_bus.add(outgoing, self.source.gain if self.source else 1, out_ramp)
+        self._crossfade_bus.add(incoming, self.next_source.gain, in_ramp)
+        if not keep_fading:
+            self._crossfade = None
+        return self._crossfade_bus.mix()
+
     async def shift(self) -> None:
         """
         Pops the first AudioFile in the queue and advances it
@@ -68,32 +177,173 @@ class AudioChannel:
         if self.source:
             await self.source.close()
             self.source = None
+        self._crossfade = None
+        self.pipeline.update_active(self)
         if not self._queue:
             return
         audio_file = self._queue.pop(0)
         await self.pipeline.manager.send_event(AudioChannelEndEvent(self.name, audio_file.id))
+        # Everything behind it is playing sooner now
+        self.pipeline.manager.files.start_background_task(self.pipeline.manager.files.preload())
         if not self._queue:
+            await self._close_next()
             return
         await self.pipeline.manager.send_event(AudioChannelNextEvent(self.name, self._queue[0].id))
         await self.play()
 
+    async def seek(self, seconds: float) -> None:
+        """Jump to a time in the current AudioFile"""
+        if not self.source or not self._queue:
+            return
+        self._crossfade = None
+        if self.source.seek(seconds):
+            return
+        audio_file = self._queue[0]
+        async_file = audio_file.async_file
+        assert async_file is not None
+        # FFmpeg finds the time using the container's index. For a URL it makes HTTP Range requests to get there,
+        # rather than us downloading everything before it.
+        local_path = async_file.local_path
+        source = AsyncFFmpegAudio(async_file, self.buffer_size, duration=self._duration(audio_file),
+                                  input=f"file:{local_path}" if local_path else str(audio_file.file),
+                                  start_time=seconds)
+        source.gain = self.source.gain
+        await source.start()
+        if self._pause:
+            await source.pause()
+        old_source, self.source = self.source, source
+        # Reading from disk, the AsyncFile has to stay open so the file does too. Otherwise FFmpeg is fetching what
+        # it needs from the URL itself, so closing the AsyncFile cancels its download instead of getting it twice.
+        await old_source.close(keep_source=local_path is not None)
+
     def is_playing(self):
         """Is this channel currently playing?"""
         return self.source and not self._pause
 
+    def is_ducking(self) -> bool:
+        """Is this channel playing an AudioFile that should duck lower priority channels?"""
+        return bool(self.is_playing() and self._queue and self._queue[0].duck)
+
     async def stop(self) -> None:
         """Stops playback and clears the queue and pause state"""
         if self.source:
             await self.source.close()
             self.source = None
+        await self._close_next()
+        self._crossfade = None
         self._queue.clear()
         self._pause = False
+        self.pipeline.update_active(self)
 
     async def remove(self, audio_file: AudioFile) -> None:
         if self._queue[0] == audio_file:
             await self.shift()
         else:
+            next_changed = len(self._queue) > 1 and self._queue[1] == audio_file
             self._queue.remove(audio_file)
+            if next_changed:
+                await self._close_next()
+                self._check_prepare()
+
+    async def _open_source(self, audio_file: AudioFile) -> AudioSource:
+        async_file = audio_file.async_file
+        assert async_file is not None
+        source: AudioSource
+        pcm = await load_pcm_file(Path(audio_file.file)) if is_pcm_file(audio_file.file) else None
+        if pcm is not None:
+            # Uncompressed, so it plays straight out of the file
+            await async_file.close()
+            source = CachedPCMSource(pcm)
+        else:
+            source = await self._open_decoder(audio_file)
+        source.gain = audio_file.volume * await self.pipeline.manager.loudness.gain(audio_file)
+        return source
+
+    async def _open_decoder(self, audio_file: AudioFile) -> AudioSource:
+        async_file = audio_file.async_file
+        assert async_file is not None
+        cache = self.pipeline.manager.pcm_cache
+        key = await cache.key(audio_file)
+        pcm = cache.get(key) if key else None
+        recorder = cache.recorder(key) if key and pcm is None else None
+        if OpusPassthroughSource.supports(audio_file):
+            await async_file.open()
+            cached = CachedPCMSource(pcm) if pcm is not None else None
+            return OpusPassthroughSource(async_file, self.buffer_size, cached, recorder)
+        if pcm is not None:
+            # Already decoded, there's nothing to download or decode
+            await async_file.close()
+            return CachedPCMSource(pcm)
+        local_path = async_file.local_path
+        if local_path is not None:
+            # FFmpeg reads the file itself, so none of it has to pass through the event loop
+            await async_file.close()
+            return AsyncFFmpegAudio(async_file, self.buffer_size, recorder=recorder,
+                                    duration=self._duration(audio_file), input=f"file:{local_path}")
+        await async_file.open()
+        return AsyncFFmpegAudio(async_file, self.buffer_size, recorder=recorder, duration=self._duration(audio_file))
+
+    def play_times(self) -> list[tuple[AudioFile, float]]:
+        """Roughly how many seconds until each AudioFile in the queue starts playing"""
+        times = []
+        start = 0.0
+        for index, audio_file in enumerate(self._queue):
+            times.append((audio_file, start))
+            length = self.source.remaining() if index == 0 and self.source else self._duration(audio_file)
+            start += length if length is not None else DEFAULT_DURATION
+        return times
+
+    @staticmethod
+    def _duration(audio_file: AudioFile) -> typing.Optional[float]:
+        return audio_file.metadata.get("duration") if audio_file.metadata else None
+
+    def _check_prepare(self) -> None:
+        """
+        Start the next AudioFile in the queue decoding once the current one is within prepare_ahead of its end, so
+        it's already buffered when it's needed. If we can't tell how long is left, start it right away.
+        """
+        if self.next_source or self._preparing or len(self._queue) < 2 or not self.source:
+            return
+        remaining = self.source.remaining()
+        if remaining is not None and remaining > self.prepare_ahead:
+            return
+        if not self.pipeline.reserve(self.buffer_size):
+            # Other channels are using the budget, try again on a later block
+            return
+        self._next_reserved = self.buffer_size
+        self._preparing = True
+        self.pipeline.manager.start_background_task(self._prepare_next())
+
+    async def _prepare_next(self) -> None:
+        try:
+            audio_file = self._queue[1]
+            source = await self._open_source(audio_file)
+            if self.next_source or len(self._queue) < 2 or self._queue[1] is not audio_file or not self.source:
+                # The queue changed while we were opening it. The source hasn't started, and its file may belong
+                # to a source that has, so just drop it.
+                self._release_next()
+                return
+            await source.start()
+            self.next_source = source
+            # Cached and mapped audio doesn't need anything set aside
+            footprint = min(source.footprint, self._next_reserved)
+            self.pipeline.release(self._next_reserved - footprint)
+            self._next_reserved = footprint
+        except:
+            self._release_next()
+            raise
+        finally:
+            self._preparing = False
+
+    def _release_next(self) -> None:
+        self.pipeline.release(self._next_reserved)
+        self._next_reserved = 0
+
+    async def _close_next(self) -> None:
+        if self.next_source:
+            await self.next_source.close()
+            self.next_source = None
+        self._release_next()
 
     async def play(self) -> None:
         self._pause = False
@@ -105,23 +355,35 @@ class AudioChannel:
         # If we already have a source, we are probably already playing
         if self.source:
             await self.source.unpause()
+            if self.next_source:
+                await self.next_source.unpause()
+            self.pipeline.update_active(self)
             return
 
-        # Open an AsyncFile and open an AsyncFFmpegAudio with it
-        audio_file = self._queue[0]
-        async_file = audio_file.async_file
-        assert async_file is not None
-        await async_file.open()
-        source = AsyncFFmpegAudio(async_file)
-        await source.start()
-        self.source = source
+        if self.next_source:
+            # The next track was already started in the background
+            self.source = self.next_source
+            self.next_source = None
+            self._release_next()
+        else:
+            # Open a source for the AsyncFile, decoding it or reading it from the PCM cache
+            source = await self._open_source(self._queue[0])
+            await source.start()
+            self.source = source
+        self.pipeline.update_active(self)
         await self.pipeline.manager.send_event(AudioChannelStartEvent(self.name, self._queue[0].id))
+        self._check_prepare()
 
     async def pause(self):
         if self.source:
             await self.source.pause()
+        if self.next_source:
+            await self.next_source.pause()
         self._pause = True
+        self.pipeline.update_active(self)
 
     async def queue(self, audio_file: AudioFile):
         self._queue.append(audio_file)
-
+        # Get its loudness measured before it comes up if it hasn't been already
+        self.pipeline.manager.loudness.analyze(audio_file)
+        self._check_prepare()
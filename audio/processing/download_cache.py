@@ -0,0 +1,133 @@
+import fcntl
+import logging
+import os
+import traceback
+import typing
+from pathlib import Path
+
+from audio.data.audio import DownloadCacheConfig
+
+logger = logging.getLogger(__name__)
+
+PART_EXTENSION = ".part"
+LOCK_EXTENSION = ".lock"
+
+
+class DownloadCache:
+    """
+    A directory of downloaded files shared by every worker process, so a track queued in several guilds is only
+    fetched once.
+
+    Each file is named by a hash of its URL or cache name. Whoever takes the file's lock downloads it into a .part
+    file and renames it into place when it's done, anyone else who wants it meanwhile reads the .part file as it
+    grows. Least recently played files are deleted once the directory gets bigger than its budget.
+    """
+    def __init__(self, config: DownloadCacheConfig) -> None:
+        assert config.path is not None
+        self.config = config
+        self.path = config.path
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def entry(self, key: str) -> Path:
+        return self.path / key
+
+    def part(self, key: str) -> Path:
+        return self.path / f"{key}{PART_EXTENSION}"
+
+    def open_entry(self, key: str) -> typing.Optional[Path]:
+        """Get the finished download for a key if there is one, and mark it as recently played"""
+        path = self.entry(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def is_entry(self, key: str, fd: int) -> bool:
+        """Has the file fd is open on been finished and renamed into place?"""
+        try:
+            return os.stat(self.entry(key)).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            return False
+
+    def lock(self, key: str) -> typing.Optional[int]:
+        """Try to become the one downloading a key. Returns the lock to give to unlock, or None if it's taken."""
+        path = self.path / f"{key}{LOCK_EXTENSION}"
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            # Someone could have deleted the lock file between us opening and locking it
+            try:
+                if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    @staticmethod
+    def unlock(fd: int) -> None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def commit(self, key: str) -> typing.Optional[Path]:
+        """
+        The download finished, move it into place.
+
+        :return: Where it is now, or None if it's bigger than the whole budget and was deleted instead. Anyone with
+                 it open can still read it.
+        """
+        path = self.entry(key)
+        part = self.part(key)
+        if os.stat(part).st_size > self.config.budget:
+            logger.info(f"{key} is too big for the download cache, not keeping it")
+            os.unlink(part)
+            try:
+                os.unlink(self.path / f"{key}{LOCK_EXTENSION}")
+            except FileNotFoundError:
+                pass
+            return None
+        os.replace(part, path)
+        try:
+            self._evict(key)
+        except OSError:
+            traceback.print_exc()
+        return path
+
+    def _evict(self, keep: str) -> None:
+        """Delete least recently played files until we're within budget, other than keep, which was just added"""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(LOCK_EXTENSION):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.name))
+            total += stat.st_size
+        entries.sort()
+        for _, size, name in entries:
+            if total <= self.config.budget:
+                break
+            key = name.removesuffix(PART_EXTENSION)
+            if key == keep:
+                continue
+            lock = self.lock(key)
+            if lock is None:
+                # Still downloading
+                continue
+            try:
+                # Anyone still reading it keeps their open file after it's gone
+                os.unlink(self.path / name)
+                os.unlink(self.path / f"{key}{LOCK_EXTENSION}")
+            except FileNotFoundError:
+                pass
+            finally:
+                self.unlock(lock)
+            total -= size
+            logger.info(f"Evicted {name} from the download cache")
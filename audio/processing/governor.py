@@ -0,0 +1,130 @@
+import dataclasses
+import logging
+import typing
+
+from audio.data.audio import AudioConfig, EncoderProfile
+from audio.data.opus import OpusApplication, OpusEncoder, OpusEncoderBandwidth, OpusEncoderSetCTL, OpusSignal
+from audio.utils.stats import RollingAverage
+
+if typing.TYPE_CHECKING:
+    from audio.processing.manager import AudioManager
+
+logger = logging.getLogger(__name__)
+
+FRAME_LENGTH = 0.02
+MIN_BITRATE = 24000
+# Highest complexity and fraction of the profile's bitrate allowed at each level, the first is full quality
+LEVELS = [(10, 1.0), (8, 1.0), (6, 0.85), (4, 0.7), (2, 0.55), (0, 0.4)]
+
+
+class EncoderGovernor:
+    """
+    Picks the encoder settings, trading quality for speed when the worker is falling behind.
+
+    The settings come from an EncoderProfile, the guild's one or a channel's one while that channel is the only
+    thing playing. Either can be pinned at runtime. On top of that, the governor watches how much of each 20ms
+    frame goes into rendering it. If that gets too high, or the renderer runs dry, it steps complexity and bitrate
+    down a level, and steps back up once the load has stayed low for a while. Quality dropping a bit is a lot
+    better than the audio stuttering.
+    """
+    def __init__(self, manager: "AudioManager", config: AudioConfig) -> None:
+        self.manager = manager
+        self.config = config.governor
+        self.profile = config.encoder
+        self.channel_profiles: dict[str, EncoderProfile] = {channel.name: channel.encoder
+                                                           for channel in config.channels if channel.encoder}
+        self.level = 0
+        self.frame_cost = RollingAverage(max(int(self.config.interval / FRAME_LENGTH), 1), 0)
+        self._frames = 0
+        self._calm = 0.0  # Seconds the load has been low for
+        self._underruns = 0
+        # What the encoder was last set up with, so update() is nearly free when nothing has changed
+        self._applied_profile: typing.Optional[EncoderProfile] = None
+        self._applied_level = 0
+        self._application: typing.Optional[str] = None
+
+    def pin(self, profile: typing.Optional[EncoderProfile], channel: typing.Optional[str] = None) -> None:
+        """Set the guild's profile, or a channel's. None goes back to the default."""
+        if profile is not None:
+            self._validate(profile)
+        if channel is None:
+            self.profile = profile or EncoderProfile()
+        elif profile is None:
+            self.channel_profiles.pop(channel, None)
+        else:
+            self.channel_profiles[channel] = profile
+        # The same profile could have been pinned again after being changed
+        self._applied_profile = None
+        self.update()
+
+    def observe(self, frame_time: float, frames: int) -> None:
+        """Record how long the renderer took per frame for a block of frames"""
+        if not self.config.enabled:
+            return
+        self.frame_cost.add(frame_time)
+        self._frames += frames
+        if self._frames * FRAME_LENGTH < self.config.interval:
+            return
+        self._frames = 0
+
+        load = self.frame_cost.average() / FRAME_LENGTH
+        underruns = self.manager.renderer.underruns - self._underruns
+        self._underruns = self.manager.renderer.underruns
+        if (load > self.config.high_load or underruns) and self.level < len(LEVELS) - 1:
+            self.level += 1
+            self._calm = 0
+            logger.info(f"Encoder load is {load:.0%} with {underruns} underruns, lowering quality to level "
+                        f"{self.level}")
+        elif load < self.config.low_load and not underruns:
+            self._calm += self.config.interval
+            if self.level and self._calm >= self.config.recover_after:
+                self.level -= 1
+                self._calm = 0
+                logger.info(f"Encoder load is {load:.0%}, raising quality to level {self.level}")
+        else:
+            self._calm = 0
+        self.update()
+
+    @staticmethod
+    def _validate(profile: EncoderProfile) -> None:
+        for name, values in (("application", OpusApplication), ("bandwidth", OpusEncoderBandwidth),
+                             ("signal", OpusSignal)):
+            value = getattr(profile, name)
+            if value.upper() not in values.__members__:
+                raise ValueError(f"Unknown encoder {name} \"{value}\"")
+        if not 0 <= profile.complexity <= 10:
+            raise ValueError(f"Encoder complexity {profile.complexity} isn't between 0 and 10")
+
+    def current_profile(self) -> EncoderProfile:
+        active = self.manager.pipeline.active_channels
+        if len(active) == 1 and active[0].name in self.channel_profiles:
+            return self.channel_profiles[active[0].name]
+        return self.profile
+
+    def update(self) -> None:
+        """Apply the current profile and level to the encoder if they've changed, called for every rendered block"""
+        profile = self.current_profile()
+        if profile is self._applied_profile and self.level == self._applied_level:
+            return
+        max_complexity, bitrate_factor = LEVELS[self.level]
+        settings = dataclasses.replace(
+            profile,
+            complexity=min(profile.complexity, max_complexity),
+            bitrate=max(int(profile.bitrate * bitrate_factor), min(profile.bitrate, MIN_BITRATE))
+        )
+        if settings.application != self._application:
+            # The application can't be changed once an encoder has been used, so start a new one
+            application = OpusApplication[settings.application.upper()]
+            old_encoder = self.manager.encoder
+            self.manager.encoder = OpusEncoder(48000, old_encoder.channels, application)
+            old_encoder.close()
+        encoder = self.manager.encoder
+        encoder.set_ctl(OpusEncoderSetCTL.COMPLEXITY, settings.complexity)
+        encoder.set_ctl(OpusEncoderSetCTL.BITRATE, settings.bitrate)
+        encoder.set_ctl(OpusEncoderSetCTL.INBAND_FEC, int(settings.fec))
+        encoder.set_ctl(OpusEncoderSetCTL.PACKET_LOSS_PERC, settings.packet_loss)
+        encoder.set_ctl(OpusEncoderSetCTL.BANDWIDTH, OpusEncoderBandwidth[settings.bandwidth.upper()].value)
+        encoder.set_ctl(OpusEncoderSetCTL.SIGNAL, OpusSignal[settings.signal.upper()].value)
+        self._applied_profile = profile
+        self._applied_level = self.level
+        self._application = settings.application
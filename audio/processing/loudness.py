@@ -0,0 +1,169 @@
+import asyncio
+import dataclasses
+import logging
+import math
+import os
+import traceback
+import typing
+from pathlib import Path
+
+from audio.data.audio import AudioFile, LoudnessConfig
+from audio.utils.background_tasks import BackgroundTasks
+from audio.utils.hashing import content_hash
+from audio.utils.json import json
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True)
+class LoudnessMeasurement:
+    integrated: float  # LUFS
+    true_peak: float  # dBTP
+
+
+class LoudnessAnalyzer(BackgroundTasks):
+    """
+    Measures how loud files are once and remembers it, so playback can normalize them with a static gain.
+
+    This replaces running FFmpeg's loudnorm filter on every stream, which is expensive and holds back the first
+    few seconds of audio while it looks ahead. Measurements are stored by content hash, in memory and as small
+    JSON files that every worker can share. Files that haven't been measured yet play at their original level
+    while they're analyzed in the background, so that's usually only the first play of a file.
+    """
+    def __init__(self, config: LoudnessConfig) -> None:
+        super().__init__()
+        self.config = config
+        self._measurements: dict[str, typing.Optional[LoudnessMeasurement]] = {}
+        self._pending: set[str] = set()
+        self._failed: set[str] = set()  # Don't keep trying files FFmpeg can't measure
+        self._limit = asyncio.Semaphore(config.max_analyses)
+        if config.path is not None:
+            try:
+                config.path.mkdir(parents=True, exist_ok=True)
+            except OSError:
+                logger.warning(f"Can't create the loudness cache at {config.path}, only keeping it in memory")
+                config.path = None
+
+    def analyze(self, audio_file: AudioFile) -> None:
+        """Measure a file in the background if we don't know how loud it is yet"""
+        self.start_background_task(self.gain(audio_file))
+
+    async def gain(self, audio_file: AudioFile) -> float:
+        """
+        Get the linear gain that brings a file to the target loudness. It's 1 until the file has been measured.
+        """
+        key = await content_hash(audio_file)
+        if key is None:
+            return 1
+        if key not in self._measurements:
+            self._measurements[key] = self._load(key)
+        measurement = self._measurements[key]
+        if measurement is None:
+            if key not in self._pending and key not in self._failed:
+                self._pending.add(key)
+                self.start_background_task(self._analyze(key, audio_file))
+            return 1
+        return self._gain(measurement)
+
+    def _gain(self, measurement: LoudnessMeasurement) -> float:
+        if not math.isfinite(measurement.integrated):
+            # Silence, nothing to bring up
+            return 1
+        gain = self.config.target - measurement.integrated
+        if math.isfinite(measurement.true_peak):
+            gain = min(gain, self.config.true_peak - measurement.true_peak)
+        gain = min(gain, self.config.max_gain)
+        if abs(gain) <= self.config.tolerance:
+            return 1
+        return 10 ** (gain / 20)
+
+    def _path(self, key: str) -> typing.Optional[Path]:
+        if self.config.path is None:
+            return None
+        return self.config.path / f"{key}.json"
+
+    def _load(self, key: str) -> typing.Optional[LoudnessMeasurement]:
+        path = self._path(key)
+        if path is None:
+            return None
+        try:
+            data = json.loads(path.read_bytes())
+            return LoudnessMeasurement(float(data["integrated"]), float(data["true_peak"]))
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError, KeyError, ValueError, TypeError):
+            traceback.print_exc()
+            return None
+
+    def _store(self, key: str, measurement: LoudnessMeasurement) -> None:
+        self._measurements[key] = measurement
+        path = self._path(key)
+        if path is None:
+            return
+        # JSON can't hold infinity, so store those as strings
+        data = {"integrated": str(measurement.integrated), "true_peak": str(measurement.true_peak)}
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            temp_path.write_bytes(json.dumps(data))
+            os.replace(temp_path, path)
+        except OSError:
+            traceback.print_exc()
+
+    async def _input(self, audio_file: AudioFile) -> str:
+        """
+        Find what to give FFmpeg to measure. FFmpeg would download a URL all over again, so if we're downloading it
+        ourselves we wait for that to finish and measure the file on disk. Without a download cache there's nothing
+        on disk to measure, so FFmpeg gets the URL after all.
+        """
+        async_file = audio_file.async_file
+        if async_file is not None:
+            if async_file.download_job is not None and not async_file.download_job.done():
+                await asyncio.wait([async_file.download_job])
+            path = async_file.local_path
+            if path is not None:
+                return str(path)
+        return str(audio_file.file)
+
+    async def _analyze(self, key: str, audio_file: AudioFile) -> None:
+        try:
+            file = await self._input(audio_file)
+            async with self._limit:
+                try:
+                    measurement = await self._measure(file)
+                except OSError:
+                    traceback.print_exc()
+                    measurement = None
+            if measurement is None:
+                self._failed.add(key)
+                return
+            logger.info(f"Measured {audio_file.title or audio_file.file} at {measurement.integrated} LUFS, "
+                        f"{measurement.true_peak} dBTP")
+            self._store(key, measurement)
+        finally:
+            self._pending.discard(key)
+
+    async def _measure(self, file: str) -> typing.Optional[LoudnessMeasurement]:
+        # Run it at a lower priority so it doesn't hold up playback
+        args = ["nice", "-n", "10", "ffmpeg", "-hide_banner", "-nostats", "-i", file, "-vn",
+                "-filter:a", "loudnorm=I={}:TP={}:print_format=json".format(self.config.target,
+                                                                            self.config.true_peak),
+                "-f", "null", "-"]
+        process = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL,
+                                                       stdout=asyncio.subprocess.DEVNULL,
+                                                       stderr=asyncio.subprocess.PIPE)
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        if process.returncode != 0:
+            logger.warning(f"Couldn't measure the loudness of {file}")
+            return None
+        # loudnorm prints its measurements as a JSON object at the end of the log
+        text = stderr.decode(errors="replace")
+        try:
+            data = json.loads(text[text.rindex("{"):text.rindex("}") + 1])
+            return LoudnessMeasurement(float(data["input_i"]), float(data["input_tp"]))
+        except (ValueError, KeyError, json.JSONDecodeError):
+            logger.warning(f"Couldn't read the loudness measurement for {file}")
+            return None
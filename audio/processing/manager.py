@@ -1,19 +1,24 @@
 import asyncio
 import logging
-import time
 import traceback
 import typing
 
 import numpy as np
 from numpy import typing as np_typing
 
-from audio.processing.async_file import AsyncFileManager
+from audio.connection.sender import PacketSender, SenderStream
+from audio.processing.async_file import AsyncFileManager, DownloadMemory
+from audio.processing.governor import EncoderGovernor
+from audio.processing.loudness import LoudnessAnalyzer
+from audio.processing.pacing import FramePacer
+from audio.processing.pcm_cache import PCMCache
 from audio.utils.stats import RollingAverage
-from audio.data.opus import OpusEncoder, OpusApplication
-from audio.processing.process import AudioPipeline
-from audio.data.audio import AudioConfig, AudioChannelConfig
+from audio.data.opus import OpusEncoder, OpusApplication, SILENCE_FRAME
+from audio.processing.process import AudioPipeline, PrepareBudget
+from audio.data.audio import AudioConfig, default_audio_config
 from audio.data.events import Event
 from audio.processing.api_client import APIClient
+from audio.processing.render import FrameRenderer
 from audio.utils.background_tasks import BackgroundTasks
 from ..data import events
 
@@ -24,18 +29,40 @@ logger = logging.getLogger(__name__)
 
 
 class AudioManager(BackgroundTasks):
-    def __init__(self, client: "VoiceConnectionProcess"):
+    def __init__(self, client: "VoiceConnectionProcess", pcm_cache: typing.Optional[PCMCache] = None,
+                 loudness: typing.Optional[LoudnessAnalyzer] = None,
+                 prepare_budget: typing.Optional[PrepareBudget] = None,
+                 download_memory: typing.Optional[DownloadMemory] = None,
+                 sender: typing.Optional[PacketSender] = None, config: typing.Optional[AudioConfig] = None):
+        """
+        :param pcm_cache: A PCM cache shared with other guilds in the process, otherwise we make our own
+        :param loudness: A loudness analyzer shared with other guilds in the process, otherwise we make our own
+        :param prepare_budget: Memory for buffering next tracks shared with other guilds in the process
+        :param download_memory: Memory for downloads shared with other guilds in the process
+        :param sender: The process's packet sender thread, if pacing uses one, otherwise we make our own
+        :param config: The config the process's shared objects were made with, otherwise the default one
+        """
         super().__init__()
         self.client = client
         self.encoder = OpusEncoder(48000, 2, OpusApplication.AUDIO)
         self.frame_size = self.encoder.frame_length_to_samples(20)
-        self.config = AudioConfig([AudioChannelConfig("music", 2), AudioChannelConfig("sfx", 1)])
-        self.pipeline = AudioPipeline(self, self.config)
-        self.files = AsyncFileManager()
+        self.config = config or default_audio_config()
+        self.pipeline = AudioPipeline(self, self.config, prepare_budget)
+        self.files = AsyncFileManager(self.config.download_cache.path, self.config.download_cache.budget,
+                                      self.config.preload, self.pipeline.play_order, download_memory)
+        self.pcm_cache = pcm_cache or PCMCache(self.config.pcm_cache)
+        self.loudness = loudness or LoudnessAnalyzer(self.config.loudness)
         self.api_client = APIClient(self)
+        self.renderer = FrameRenderer(self, self.config.lookahead, self.config.render_block)
+        self.governor = EncoderGovernor(self, self.config)
+        self.governor.update()
+        self.pacer = FramePacer(self.config.pacing)
+        self._shared_sender = sender
+        self.sender: typing.Optional[SenderStream] = None
 
         self.encode_avg = RollingAverage(400, 0)
         self.target_avg = RollingAverage(400, 0)
+        self.speaking = False
         self._playback_task: typing.Optional[asyncio.Task] = None
         self._playback_task_running = False
         self._event_subscriptions: dict[
@@ -58,44 +85,89 @@ class AudioManager(BackgroundTasks):
             self._playback_task_running = True
             print("starting playback loop")
             count = 0
-            calc_avg = RollingAverage(400, 0)
-            target_avg = RollingAverage(400, 0)
-            loop_start = time.time()
-            # await self.client.set_speaking_state(False)
-            await self.client.set_speaking_state(True)
+            quiet_frames = 0
+            # Never less than the five frames of silence Discord wants before going quiet
+            hold_frames = max(round(self.config.speaking_hold / 0.02), 5)
+            self.renderer.start()
+            if self.config.pacing.sender_thread:
+                assert self.client.voice_socket is not None
+                sender = self._shared_sender or PacketSender()
+                self.sender = sender.stream(self.client.voice_socket.socket, self.pacer,
+                                            self.config.pacing.sender_queue)
+            self.pacer.reset()
             while not self.client.is_stopped and self._playback_task_running:
-                start = time.time()
-                pcm = await self.pipeline.read()
+                if self.sender:
+                    # The sender thread waits for the deadline, we just need to get the packet to it in time
+                    deadline, skip = self.pacer.next_frame()
+                else:
+                    try:
+                        skip = await self.pacer.wait()
+                    except asyncio.exceptions.CancelledError:
+                        break
+                for _ in range(skip):
+                    # Behind with the drop policy, throw away the frames that should have gone out already
+                    if not self.renderer.frames:
+                        break
+                    self.renderer.pop()
+                    self.client.rtp_header.skip(1)
+                # Frames are mixed and encoded ahead of time by the renderer, we only need to send them here
+                ready, opus_frame = self.renderer.pop()
                 packet = None
-                if pcm is not None:
-                    packet = await self.prepare_packet(pcm)
-                    calc_avg.add(time.time() - start)
-                total_offset = (count * 0.02) - (time.time() - loop_start)
-                total_wait = round(0.02 + total_offset, 3)
-                count += 1
-                if count % 250 == 1:
-                    print("current total offset", time.time() - loop_start,
-                          "avg frame calc time", calc_avg.average(), "send target delta", target_avg.average())
-                if total_wait > 0:
+                if opus_frame is not None:
+                    if not self.speaking:
+                        await self.set_speaking(True)
+                    quiet_frames = 0
+                    packet = await self._encrypt_audio(opus_frame)
+                elif self.speaking:
+                    # Send silence through short gaps rather than stopping, each change of speaking state is a
+                    # gateway message and clips the start of the audio that follows. An underrun while something
+                    # is playing is us being late, not the audio going quiet, so it doesn't count.
+                    if ready or not self.pipeline.active.is_set():
+                        quiet_frames += 1
+                    if quiet_frames < hold_frames:
+                        packet = await self._encrypt_audio(SILENCE_FRAME)
+                    else:
+                        await self.set_speaking(False)
+                elif not self.pipeline.active.is_set() and not self.renderer.frames:
+                    # Nothing is playing, sleep until a channel starts instead of ticking through silence
                     try:
-                        await asyncio.sleep(total_wait)
+                        await self.pipeline.active.wait()
                     except asyncio.exceptions.CancelledError:
                         break
+                    self.renderer.drop_silence()
+                    self.pacer.reset()
+                    continue
+                count += 1
+                if count % 250 == 1:
+                    logger.debug(f"Pacing {self.pacer.stats()}, average frame render time "
+                                 f"{self.renderer.render_avg.average()}, {self.renderer.buffered()} buffered, "
+                                 f"{self.renderer.underruns} underruns")
 
-                if count > 9000:  # 50 * 60 * 3 minutes
-                    count = 1
-                    loop_start = time.time()
-
-                if packet:
-                    target_avg.add(abs((count * 0.02) - (time.time() - loop_start)))
+                if packet and self.sender:
+                    await self.sender.send(deadline, packet)
+                elif packet:
                     await self.send_packet(packet)
+                    self.pacer.sent()
+                elif self.sender:
+                    # Nothing to send, but don't run ahead of the schedule
+                    await self.pacer.sleep_until(deadline)
 
         except asyncio.CancelledError:
             pass
         except:
             traceback.print_exc()
+        if self.sender:
+            self.sender.close()
+            if self.sender.sender is not self._shared_sender:
+                self.sender.sender.stop()
+            self.sender = None
+        await self.renderer.stop()
         logger.info("Exiting AudioManager playback task")
 
+    async def set_speaking(self, state: bool) -> None:
+        self.speaking = state
+        await self.client.set_speaking_state(state)
+
     async def prepare_packet(self, pcm: np_typing.NDArray[np.int16]) -> bytes:
         opus_frame = self.encoder.encode_numpy(pcm, self.frame_size)
         encrypted = await self._encrypt_audio(opus_frame)
@@ -123,6 +195,13 @@ class AudioManager(BackgroundTasks):
                 # Just cancel it then
                 self._playback_task.cancel()
 
+    async def close(self):
+        """Stop everything and let go of the channels' sources and the download session"""
+        await self.stop()
+        for channel in self.pipeline.channels.values():
+            await channel.stop()
+        await self.files.close()
+
     async def receive_api(self, message: str) -> None:
         await self.api_client.receive_api(message)
 
@@ -0,0 +1,117 @@
+import math
+import typing
+
+import numpy as np
+from numpy import typing as np_typing
+
+from audio.data.audio import AudioChannelConfig
+from audio.utils.constants import AUDIO_DATA_TYPE, AUDIO_DATA_TYPE_INFO, SAMPLE_RATE
+
+
+class MixBus:
+    """
+    Sums channel audio into a preallocated int32 accumulator and saturates it down into a reusable int16 buffer.
+
+    Nothing here allocates per frame, the returned output buffer is overwritten by the next mix so it needs to be
+    consumed (encoded) before mixing again.
+    """
+    def __init__(self, samples: int) -> None:
+        self.samples = 0
+        self._accumulator: np_typing.NDArray[np.int32] = np.zeros(0, dtype=np.int32)
+        self._scratch: np_typing.NDArray[np.float32] = np.zeros(0, dtype=np.float32)
+        self._output: np_typing.NDArray[np.int16] = np.zeros(0, dtype=AUDIO_DATA_TYPE)
+        self._channels = 0
+        self.resize(samples)
+
+    def resize(self, samples: int) -> None:
+        """Reallocate the buffers, only happens if the read size changes"""
+        if samples == self.samples:
+            return
+        self.samples = samples
+        self._accumulator = np.zeros(samples, dtype=np.int32)
+        self._scratch = np.zeros(samples, dtype=np.float32)
+        self._output = np.zeros(samples, dtype=AUDIO_DATA_TYPE)
+
+    def clear(self) -> None:
+        self._accumulator.fill(0)
+        self._channels = 0
+
+    def add(self, pcm: np_typing.NDArray[np.int16], gain: float = 1,
+            envelope: typing.Optional[np_typing.NDArray[np.float32]] = None) -> None:
+        """Accumulate a channel's audio with its gain and an optional per-sample gain envelope applied"""
+        self._channels += 1
+        if envelope is not None:
+            np.multiply(pcm, envelope, out=self._scratch, casting="unsafe")
+            if gain != 1:
+                np.multiply(self._scratch, gain, out=self._scratch)
+            np.add(self._accumulator, self._scratch, out=self._accumulator, casting="unsafe")
+        elif gain == 1:
+            np.add(self._accumulator, pcm, out=self._accumulator)
+        elif gain != 0:
+            np.multiply(pcm, gain, out=self._scratch, casting="unsafe")
+            np.add(self._accumulator, self._scratch, out=self._accumulator, casting="unsafe")
+
+    def mix(self) -> np_typing.NDArray[np.int16]:
+        """Clip the accumulated audio into the int16 range and return the output buffer"""
+        np.clip(self._accumulator, AUDIO_DATA_TYPE_INFO.min, AUDIO_DATA_TYPE_INFO.max, out=self._accumulator)
+        np.copyto(self._output, self._accumulator, casting="unsafe")
+        return self._output
+
+    def __len__(self) -> int:
+        return self._channels
+
+
+class DuckingEnvelope:
+    """
+    Sidechain gain envelope for a channel that can be ducked by a higher priority channel.
+
+    The envelope is a one-pole curve towards the target gain. Since the curve from any starting gain is
+    target + (start - target) * a^n, we can precompute a^n once per block size and render a whole block with
+    a multiply and an add instead of stepping through it sample by sample.
+    """
+    SETTLED = 1e-4
+
+    def __init__(self, config: AudioChannelConfig, samples: int = 1920, channels: int = 2) -> None:
+        self.duck_volume = config.duck_volume
+        self.attack = config.duck_attack
+        self.release = config.duck_release
+        self.channels = channels
+        self.gain = 1.0
+        self.samples = 0
+        self._attack_curve: np_typing.NDArray[np.float32] = np.zeros(0, dtype=np.float32)
+        self._release_curve: np_typing.NDArray[np.float32] = np.zeros(0, dtype=np.float32)
+        self._envelope: np_typing.NDArray[np.float32] = np.zeros(0, dtype=np.float32)
+        self.resize(samples)
+
+    def _curve(self, seconds: float) -> np_typing.NDArray[np.float32]:
+        # One power per audio frame, repeated for each interleaved sample in that frame
+        frames = np.repeat(np.arange(1, self.samples // self.channels + 1, dtype=np.float64), self.channels)
+        if seconds <= 0:
+            return np.zeros(self.samples, dtype=np.float32)
+        coefficient = math.exp(-1 / (seconds * SAMPLE_RATE))
+        return np.power(coefficient, frames).astype(np.float32)
+
+    def resize(self, samples: int) -> None:
+        if samples == self.samples:
+            return
+        self.samples = samples
+        self._attack_curve = self._curve(self.attack)
+        self._release_curve = self._curve(self.release)
+        self._envelope = np.zeros(samples, dtype=np.float32)
+
+    def process(self, ducked: bool, samples: int) -> tuple[float, typing.Optional[np_typing.NDArray[np.float32]]]:
+        """
+        Advance the envelope by a block.
+
+        :return: A constant gain for the block if the envelope has settled, otherwise the per-sample envelope
+        """
+        target = self.duck_volume if ducked else 1.0
+        if abs(self.gain - target) < self.SETTLED:
+            self.gain = target
+            return target, None
+        self.resize(samples)
+        curve = self._attack_curve if ducked else self._release_curve
+        np.multiply(curve, self.gain - target, out=self._envelope)
+        np.add(self._envelope, target, out=self._envelope)
+        self.gain = float(self._envelope[-1])
+        return 1, self._envelope
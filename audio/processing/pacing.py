@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+
+from audio.data.audio import PacingConfig
+from audio.utils.stats import RollingAverage
+
+logger = logging.getLogger(__name__)
+
+FRAME_NS = 20_000_000
+CATCH_UP_POLICIES = ("burst", "drop", "stretch")
+
+
+class FramePacer:
+    """
+    Decides when each 20ms frame is sent.
+
+    Every frame has an absolute deadline, the time pacing started plus its index times 20ms, counted in integer
+    nanoseconds on the monotonic clock. Waiting for a frame sleeps until its deadline instead of for a fixed time,
+    so the time sending takes doesn't add up, and changes to the wall clock don't affect it. Integers don't lose
+    precision, so there's never any need to start counting over.
+
+    When the loop falls more than a frame behind, the catch up policy decides what happens:
+    - burst sends the late frames back to back until it's caught up
+    - drop skips the late frames' audio
+    - stretch moves every deadline back by how late it is, so nothing is made up for
+    Burst and drop only make up for max_catch_up frames, anything later than that is stretched.
+    """
+    def __init__(self, config: PacingConfig) -> None:
+        if config.catch_up not in CATCH_UP_POLICIES:
+            raise ValueError(f"Unknown catch up policy \"{config.catch_up}\", expected one of {CATCH_UP_POLICIES}")
+        self.config = config
+        self._origin = time.monotonic_ns()
+        self._index = 0
+        self._deadline = self._origin
+        self.lateness = RollingAverage(250, 0)  # Seconds each packet was sent after its deadline
+        self.max_lateness = 0.0
+        self.late_packets = 0  # Sent more than a frame late
+        self.dropped = 0  # Frames skipped by the drop policy
+        self.stretched = 0.0  # Seconds the schedule was pushed back by
+
+    def reset(self) -> None:
+        """Start the schedule again from now, after a break in sending"""
+        self._origin = time.monotonic_ns()
+        self._index = 0
+
+    def next_frame(self) -> tuple[int, int]:
+        """
+        Work out when the next frame is due, catching up if we're behind.
+
+        :return: The frame's deadline in monotonic nanoseconds, and how many frames to skip to catch up, which is
+                 only ever more than 0 with the drop policy
+        """
+        deadline = self._origin + self._index * FRAME_NS
+        now = time.monotonic_ns()
+        behind = (now - deadline) // FRAME_NS
+        skip = 0
+        if behind > 0:
+            catch_up = min(behind, self.config.max_catch_up) if self.config.catch_up != "stretch" else 0
+            if behind > catch_up:
+                # Give up on the frames we won't make up for
+                shift = (behind - catch_up) * FRAME_NS
+                self._origin += shift
+                deadline += shift
+                self.stretched += shift / 1e9
+                if shift >= 50 * FRAME_NS:
+                    logger.warning(f"Playback fell {shift / 1e9:.2f}s behind, skipping ahead")
+            if self.config.catch_up == "drop":
+                skip = catch_up
+                self._index += skip
+                self.dropped += skip
+                deadline += skip * FRAME_NS
+        self._deadline = deadline
+        self._index += 1
+        return deadline, skip
+
+    async def wait(self) -> int:
+        """
+        Sleep until the next frame is due.
+
+        :return: How many frames to skip to catch up, only ever more than 0 with the drop policy
+        """
+        deadline, skip = self.next_frame()
+        await self.sleep_until(deadline)
+        return skip
+
+    @staticmethod
+    async def sleep_until(deadline: int) -> None:
+        now = time.monotonic_ns()
+        if now < deadline:
+            await asyncio.sleep((deadline - now) / 1e9)
+
+    def sent(self) -> None:
+        """Record how late the frame that was just sent went out"""
+        self.record(max(time.monotonic_ns() - self._deadline, 0) / 1e9)
+
+    def record(self, late: float) -> None:
+        """Record a packet being sent late seconds after its deadline"""
+        self.lateness.add(late)
+        self.max_lateness = max(self.max_lateness, late)
+        if late * 1e9 > FRAME_NS:
+            self.late_packets += 1
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "average_lateness": float(self.lateness.average()),
+            "max_lateness": self.max_lateness,
+            "late_packets": self.late_packets,
+            "dropped": self.dropped,
+            "stretched": self.stretched,
+        }
@@ -0,0 +1,260 @@
+import asyncio
+import collections
+import logging
+import mmap
+import os
+import traceback
+import typing
+from pathlib import Path
+
+import numpy as np
+from numpy import typing as np_typing
+
+from audio.data.audio import AudioFile, PCMCacheConfig
+from audio.utils.background_tasks import BackgroundTasks
+from audio.utils.constants import AUDIO_DATA_TYPE, SAMPLE_RATE
+from audio.utils.hashing import content_hash, params_hash
+
+logger = logging.getLogger(__name__)
+
+PCM_EXTENSION = ".pcm"
+FLUSH_SIZE = 1024 * 1024  # Bytes of PCM a recorder gathers before writing them to disk
+
+
+class PCMCache(BackgroundTasks):
+    """
+    Keeps decoded 48kHz stereo s16le PCM around so playing the same file again doesn't need FFmpeg.
+
+    Short clips are kept in memory up to a byte budget. Longer tracks are written out as raw PCM files once and
+    memory-mapped when they're played again, so the mixer reads straight out of the page cache. Entries are keyed
+    by a hash of the file's contents and the parameters it was decoded with.
+    """
+    def __init__(self, config: PCMCacheConfig) -> None:
+        super().__init__()
+        self.config = config
+        self.memory_max_size = int(config.memory_max_seconds * SAMPLE_RATE) * 2 * AUDIO_DATA_TYPE.itemsize
+        self._memory: collections.OrderedDict[str, np_typing.NDArray[np.int16]] = collections.OrderedDict()
+        self._hits: dict[str, int] = {}
+        self.memory_size = 0
+        if config.disk_path is not None:
+            try:
+                config.disk_path.mkdir(parents=True, exist_ok=True)
+            except OSError:
+                logger.warning(f"Can't create the PCM cache at {config.disk_path}, only caching in memory")
+                config.disk_path = None
+
+    async def key(self, audio_file: AudioFile) -> typing.Optional[str]:
+        content = await content_hash(audio_file)
+        if content is None:
+            return None
+        return f"{content}-{params_hash('s16le', SAMPLE_RATE, 2)}"
+
+    def get(self, key: str) -> typing.Optional[np_typing.NDArray[np.int16]]:
+        pcm = self._memory.get(key)
+        if pcm is not None:
+            self._memory.move_to_end(key)
+            self._hits[key] += 1
+            return pcm
+        return self._open_disk(key)
+
+    def recorder(self, key: str) -> "PCMRecorder":
+        return PCMRecorder(self, key)
+
+    def _disk_file(self, key: str) -> typing.Optional[Path]:
+        if self.config.disk_path is None:
+            return None
+        return self.config.disk_path / f"{key}{PCM_EXTENSION}"
+
+    def _open_disk(self, key: str) -> typing.Optional[np_typing.NDArray[np.int16]]:
+        path = self._disk_file(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Touch it so disk eviction sees it as recently played
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except OSError:
+            traceback.print_exc()
+            return None
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+        return np.frombuffer(mapped, dtype=AUDIO_DATA_TYPE)
+
+    def add_memory(self, key: str, pcm: np_typing.NDArray[np.int16]) -> None:
+        if pcm.nbytes > self.config.memory_budget or key in self._memory:
+            return
+        pcm.flags.writeable = False
+        self._memory[key] = pcm
+        self._hits[key] = 1
+        self.memory_size += pcm.nbytes
+        while self.memory_size > self.config.memory_budget:
+            self._evict_memory()
+        logger.info(f"Cached {pcm.nbytes} bytes of PCM in memory, {self.memory_size} bytes total")
+
+    def _evict_memory(self) -> None:
+        if self.config.memory_policy == "lfu":
+            # Least played first, then least recently played of those
+            key = min(self._memory, key=lambda k: self._hits[k])
+        else:
+            key = next(iter(self._memory))
+        self.memory_size -= self._memory.pop(key).nbytes
+        del self._hits[key]
+
+    def add_disk(self, key: str, temp_path: Path) -> None:
+        path = self._disk_file(key)
+        assert path is not None
+        os.replace(temp_path, path)
+        logger.info(f"Cached PCM on disk at {path}")
+        self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        assert self.config.disk_path is not None
+        entries = []
+        total = 0
+        for entry in os.scandir(self.config.disk_path):
+            if not entry.name.endswith(PCM_EXTENSION):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.config.disk_budget:
+                break
+            try:
+                # Anything still playing it keeps its mapping after the file is gone
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class PCMRecorder:
+    """
+    Collects the PCM a decoder produces so it can go into the cache once the whole file has been decoded.
+
+    Audio is held in memory until it gets longer than a clip that would be cached in memory, then it spills into
+    a temporary file that's moved into the disk tier when it's done. Recording happens on the event loop that
+    paces packets, so the file is written in a thread, a chunk at a time.
+    """
+    def __init__(self, cache: PCMCache, key: str) -> None:
+        self.cache = cache
+        self.key = key
+        self._data: typing.Optional[bytearray] = bytearray()  # Everything so far, or what's waiting to be written
+        self._spilled = False
+        self._fd: typing.Optional[int] = None
+        self._temp_path: typing.Optional[Path] = None
+        self._flush_task: typing.Optional[asyncio.Future] = None
+        self.done = False
+
+    def write(self, data: typing.Union[bytes, memoryview]) -> None:
+        if self.done:
+            return
+        assert self._data is not None
+        self._data += data
+        if self._spilled:
+            if len(self._data) >= FLUSH_SIZE:
+                self._flush()
+        elif len(self._data) > self.cache.memory_max_size:
+            self._spill()
+
+    def _spill(self) -> None:
+        path = self.cache._disk_file(self.key)
+        if path is None:
+            # Too long for memory and there's nowhere else to put it
+            self.abort()
+            return
+        self._temp_path = path.with_name(f"{path.name}.{os.getpid()}.{id(self)}.tmp")
+        self._spilled = True
+        self._flush()
+
+    def _flush(self) -> None:
+        """Hand what's been gathered to a thread to write out, once the last chunk is done"""
+        if self._flush_task:
+            if not self._flush_task.done():
+                return
+            if self._flush_task.exception():
+                logger.error(f"Couldn't write PCM to the cache: {self._flush_task.exception()}")
+                self.abort()
+                return
+        assert self._data is not None
+        data, self._data = self._data, bytearray()
+        self._flush_task = asyncio.get_running_loop().run_in_executor(None, self._write_out, data)
+
+    def _write_out(self, data: bytearray) -> None:
+        # Runs in a thread, only ever one at a time
+        if self._fd is None:
+            assert self._temp_path is not None
+            self._fd = os.open(self._temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]
+
+    def finish(self) -> None:
+        """The whole file was decoded, store it"""
+        if self.done:
+            return
+        self.done = True
+        if self._spilled:
+            self.cache.start_background_task(self._finish_disk())
+            return
+        if self._data:
+            self.cache.add_memory(self.key, np.frombuffer(self._data, dtype=AUDIO_DATA_TYPE))
+        self._data = None
+
+    async def _finish_disk(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            if self._flush_task:
+                await self._flush_task
+            assert self._data is not None and self._temp_path is not None
+            await loop.run_in_executor(None, self._write_out, self._data)
+            self._data = None
+            self._close()
+            await loop.run_in_executor(None, self.cache.add_disk, self.key, self._temp_path)
+            self._temp_path = None
+        except OSError:
+            traceback.print_exc()
+            self._data = None
+            self._close()
+            self._remove_temp()
+
+    def abort(self) -> None:
+        """Throw away what was recorded, the decode didn't finish"""
+        self.done = True
+        self._data = None
+        if self._flush_task and not self._flush_task.done():
+            # Clean up once the thread is done with the file
+            self.cache.start_background_task(self._discard())
+            return
+        self._close()
+        self._remove_temp()
+
+    async def _discard(self) -> None:
+        assert self._flush_task is not None
+        try:
+            await self._flush_task
+        except OSError:
+            pass
+        self._close()
+        self._remove_temp()
+
+    def _close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _remove_temp(self) -> None:
+        if self._temp_path is not None:
+            try:
+                os.unlink(self._temp_path)
+            except FileNotFoundError:
+                pass
+            self._temp_path = None
@@ -6,19 +6,65 @@ from audio.processing.source import AsyncFFmpegAudio
 from audio.data.audio import AudioConfig, AudioFile
 from audio.data.events import *
 from audio.processing.channel import AudioChannel
-from audio.utils.constants import AUDIO_DATA_TYPE_INFO
+from audio.processing.mixer import MixBus
 
 if typing.TYPE_CHECKING:
+    from audio.processing.async_file import AsyncFile
     from audio.processing.manager import AudioManager
 
 
+class PrepareBudget:
+    """
+    Memory set aside for channels buffering their next tracks. There's one for the whole process, so a worker
+    hosting many guilds stays within it however many of them are playing.
+    """
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        self.used = 0
+
+    def reserve(self, size: int) -> bool:
+        """Set aside memory for buffering a next track, if the budget allows it"""
+        if self.used + size > self.budget:
+            return False
+        self.used += size
+        return True
+
+    def release(self, size: int) -> None:
+        self.used = max(self.used - size, 0)
+
+
 class AudioPipeline:
-    def __init__(self, manager: "AudioManager", config: AudioConfig) -> None:
+    def __init__(self, manager: "AudioManager", config: AudioConfig,
+                 prepare_budget: typing.Optional[PrepareBudget] = None) -> None:
+        """
+        :param prepare_budget: Shared with other guilds in the process, otherwise we make our own
+        """
         self.manager = manager
         self.source: typing.Optional[AsyncFFmpegAudio] = None
         self.config = config
-        self.channels: dict[str, AudioChannel] = {channel.name: AudioChannel(self, channel.name)
+        self.channels: dict[str, AudioChannel] = {channel.name: AudioChannel(self, channel)
                                                   for channel in self.config.channels}
+        self.mix_bus = MixBus(3840 // 2)
+        # Only the channels in here get read each frame, AudioChannels keep it up to date as their state changes
+        self.active_channels: list[AudioChannel] = []
+        self.active = asyncio.Event()
+        self.prepare_budget = prepare_budget or PrepareBudget(config.prepare_budget)
+
+    def reserve(self, size: int) -> bool:
+        """Set aside memory for buffering a next track, if the budget allows it"""
+        return self.prepare_budget.reserve(size)
+
+    def release(self, size: int) -> None:
+        self.prepare_budget.release(size)
+
+    def play_order(self) -> dict["AsyncFile", float]:
+        """Roughly how many seconds until each queued file starts playing, on whichever channel plays it first"""
+        order: dict["AsyncFile", float] = {}
+        for channel in self.channels.values():
+            for audio_file, seconds in channel.play_times():
+                if audio_file.async_file is not None:
+                    order[audio_file.async_file] = min(order.get(audio_file.async_file, seconds), seconds)
+        return order
 
     async def queue(self, audio_channel: str, audio_file: AudioFile) -> None:
         await self.channels[audio_channel].queue(audio_file)
@@ -29,46 +75,65 @@ class AudioPipeline:
     async def pause(self, audio_channel: str):
         await self.channels[audio_channel].pause()
 
-    async def _update_play(self, unregister=True):
-        playing = False
-        for channel in self.channels.values():
-            if channel.is_playing():
-                playing = True
-                await self.manager.register_playback(self, self.voice_channel)
-                return
-        self._playing = False
-        if unregister and not self.stay_in_channel:
-            await self.manager.unregister_playback(self)
+    def update_active(self, channel: AudioChannel) -> None:
+        """Called by an AudioChannel whenever it might have started or stopped playing"""
+        if channel.is_playing():
+            if channel not in self.active_channels:
+                self.active_channels.append(channel)
+                # Keep the mix order stable
+                self.active_channels.sort(key=lambda c: c.priority)
+        elif channel in self.active_channels:
+            self.active_channels.remove(channel)
+        if self.active_channels:
+            self.active.set()
+        else:
+            self.active.clear()
+
+    async def read_packets(self, frames: int) -> typing.Optional[list[typing.Optional[bytes]]]:
+        """
+        If the only thing playing is an Opus file that doesn't need mixing, read its packets directly.
+
+        :return: None if the audio needs to be mixed, otherwise up to frames packets (None for a silent frame)
+        """
+        packets: list[typing.Optional[bytes]] = []
+        while len(packets) < frames and len(self.active_channels) == 1:
+            channel = self.active_channels[0]
+            if not channel.can_passthrough():
+                break
+            packets.append(await channel.read_packet())
+        return packets or None
 
     async def read(self, size: int = 3840) -> typing.Optional[np_typing.NDArray[np.int16]]:
-        # Await reads on all channels
-        channel_reads = [channel.read(size) for channel in self.channels.values()]
-        await_data = await asyncio.gather(*channel_reads)
-        audio_data = [data for data in await_data if data is not None]
+        if not self.active_channels:
+            return None
+        # Copy since a channel can go inactive while we're reading it
+        channels = list(self.active_channels)
+        if len(channels) == 1:
+            await_data = [await channels[0].read(size)]
+        else:
+            await_data = await asyncio.gather(*(channel.read(size) for channel in channels))
+        audio_data = [(data, channel) for data, channel in zip(await_data, channels) if data is not None]
 
         # If we don't have audio data, don't return anything
         if not audio_data:
             return None
 
-        # If we only have one channel, bypass the mix down
-        if len(audio_data) == 1:
-            return audio_data[0]
-
-        # Mix down the channels
-        final = np.stack(audio_data)
-        final = np.add(final, 0)
-        final = np.clip(final, a_min=AUDIO_DATA_TYPE_INFO.min, a_max=AUDIO_DATA_TYPE_INFO.max)
-        final = final.astype(np.int16)  # Todo: Is this necessary
-        return final
-
-
-
-
-
-
-
-
-
-
+        # The highest priority channel that is playing something marked to duck sets which channels get ducked
+        duck_priority = min((channel.priority for _, channel in audio_data if channel.is_ducking()), default=None)
+        samples = size // 2
+        mix = []
+        for data, channel in audio_data:
+            ducked = duck_priority is not None and duck_priority < channel.priority
+            gain, envelope = await channel.gain(samples, ducked)
+            mix.append((data, gain, envelope))
 
+        # If we only have one channel at unity gain, bypass the mix down
+        if len(mix) == 1 and mix[0][1] == 1 and mix[0][2] is None:
+            return mix[0][0]
 
+        # Mix down the channels
+        self.mix_bus.resize(samples)
+        self.mix_bus.clear()
+        for data, gain, envelope in mix:
+            self.mix_bus.add(data, gain, envelope)
+        return self.mix_bus.mix()
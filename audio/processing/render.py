@@ -0,0 +1,115 @@
+import asyncio
+import collections
+import logging
+import time
+import traceback
+import typing
+
+from audio.utils.stats import RollingAverage
+
+if typing.TYPE_CHECKING:
+    from audio.processing.manager import AudioManager
+
+logger = logging.getLogger(__name__)
+
+FRAME_LENGTH = 0.02
+MIN_LOOKAHEAD = 0.06
+MAX_LOOKAHEAD = 0.5
+
+
+class FrameRenderer:
+    """
+    Mixes and encodes audio ahead of the playback loop into a bounded queue of ready Opus frames.
+
+    Frames are rendered a block at a time so the per-call overhead of reading channels and mixing is shared
+    between several frames. A None in the queue is a frame of silence, either because nothing is playing or
+    because the mix is digitally silent, which we don't bother encoding.
+    """
+    def __init__(self, manager: "AudioManager", lookahead: float, block_frames: int) -> None:
+        self.manager = manager
+        lookahead = min(max(lookahead, MIN_LOOKAHEAD), MAX_LOOKAHEAD)
+        self.max_frames = round(lookahead / FRAME_LENGTH)
+        self.block_frames = max(min(block_frames, self.max_frames), 1)
+        self.frame_size = manager.frame_size
+        # Bytes of interleaved stereo int16 PCM per frame
+        self.frame_bytes = self.frame_size * manager.encoder.channels * 2
+        self.frames: collections.deque[typing.Optional[bytes]] = collections.deque()
+        self.render_avg = RollingAverage(400, 0)
+        self.underruns = 0
+        self._space = asyncio.Event()
+        self._running = False
+        self._task: typing.Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if not self._task:
+            self._running = True
+            self._task = asyncio.Task(self.render_task())
+
+    async def stop(self) -> None:
+        self._running = False
+        self._space.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def pop(self) -> tuple[bool, typing.Optional[bytes]]:
+        """
+        Take the next rendered frame.
+
+        :return: Whether a frame was ready in time and the Opus frame, if there was any audio
+        """
+        try:
+            frame = self.frames.popleft()
+        except IndexError:
+            self.underruns += 1
+            return False, None
+        if len(self.frames) <= self.max_frames - self.block_frames:
+            self._space.set()
+        return True, frame
+
+    def drop_silence(self) -> None:
+        """Skip past any silence at the front of the queue so audio starts right away when waking up"""
+        while self.frames and self.frames[0] is None:
+            self.frames.popleft()
+        self._space.set()
+
+    def buffered(self) -> float:
+        """Seconds of audio rendered ahead of the playback loop"""
+        return len(self.frames) * FRAME_LENGTH
+
+    async def render_task(self) -> None:
+        try:
+            while self._running:
+                if len(self.frames) > self.max_frames - self.block_frames:
+                    self._space.clear()
+                    await self._space.wait()
+                    continue
+                if not self.manager.pipeline.active.is_set():
+                    # Nothing is playing so there's nothing to render until a channel starts
+                    await self.manager.pipeline.active.wait()
+                    continue
+                start = time.perf_counter()
+                packets = await self.manager.pipeline.read_packets(self.block_frames)
+                if packets is not None:
+                    # Opus passed straight through from the file, tiny packets are just silence
+                    self.frames.extend(packet if packet and len(packet) > 3 else None for packet in packets)
+                    continue
+                pcm = await self.manager.pipeline.read(self.frame_bytes * self.block_frames)
+                if pcm is None:
+                    self.frames.extend([None] * self.block_frames)
+                else:
+                    self.manager.governor.update()
+                    samples = self.frame_size * self.manager.encoder.channels
+                    for i in range(self.block_frames):
+                        frame = pcm[i * samples:(i + 1) * samples]
+                        if frame.any():
+                            self.frames.append(self.manager.encoder.encode_numpy(frame, self.frame_size))
+                        else:
+                            self.frames.append(None)
+                    frame_time = (time.perf_counter() - start) / self.block_frames
+                    self.render_avg.add(frame_time)
+                    self.manager.governor.observe(frame_time, self.block_frames)
+        except asyncio.CancelledError:
+            pass
+        except:
+            traceback.print_exc()
@@ -1,39 +1,181 @@
+import abc
 import asyncio
-import io
+import collections
 import logging
 import signal
 import traceback
 import typing
 import os
-from .async_file import AsyncFile
+import re
+
+import numpy as np
+from numpy import typing as np_typing
+
+from .async_file import AsyncFile, PrefixedFile
+from audio.data.audio import AudioFile
+from audio.data.demux import OpusDemuxer, OpusPacket, UnsupportedStreamError
+from audio.data.opus import MAX_PACKET_SAMPLES, OpusDecodeError, OpusDecoder
+from audio.utils.constants import AUDIO_DATA_TYPE, SAMPLE_RATE
+from audio.utils.ring_buffer import PCMRingBuffer
+
+if typing.TYPE_CHECKING:
+    from audio.processing.pcm_cache import PCMRecorder
 
 logger = logging.getLogger(__name__)
 
+# Containers that might hold Opus we can send without decoding
+PASSTHROUGH_EXTENSIONS = {".opus", ".ogg", ".oga", ".webm", ".weba", ".mka"}
+FRAME_SAMPLES = 960
+BYTES_PER_SECOND = SAMPLE_RATE * 2 * AUDIO_DATA_TYPE.itemsize
+FFMPEG_DURATION = re.compile(rb"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+class AudioSource(abc.ABC):
+    """Something that provides 48kHz stereo PCM for an AudioChannel"""
+    DEFAULT_BUFFER_SIZE = 48000 * 2 * 2  # One second of audio
+    gain: float = 1  # Static gain for this file, from its volume and loudness normalization
+
+    @abc.abstractmethod
+    async def start(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    def read(self, size: int = 3840) -> typing.Optional[np_typing.NDArray[np.int16]]:
+        """
+        Read a frame of PCM. The data is only valid until the next read.
+
+        :return: None if audio isn't ready yet, otherwise the audio. Less audio than requested means the end of the
+        file has been reached.
+        """
+        pass
+
+    @abc.abstractmethod
+    def buffered(self) -> int:
+        """Number of bytes of decoded PCM ready to be read"""
+        pass
+
+    @abc.abstractmethod
+    def finished_decoding(self) -> bool:
+        """Has the whole file been decoded? If so, buffered() is all that's left."""
+        pass
+
+    def remaining(self) -> typing.Optional[float]:
+        """Seconds of audio left to play, if we know"""
+        if self.finished_decoding():
+            return self.buffered() / BYTES_PER_SECOND
+        return None
+
+    @property
+    def footprint(self) -> int:
+        """Bytes of memory this source buffers audio in"""
+        return 0
 
-class AsyncFFmpegAudio:
-    def __init__(self, source: AsyncFile) -> None:
+    def seek(self, seconds: float) -> bool:
+        """
+        Jump to a time in the file, if this source can do that itself.
+
+        :return: Whether it could, otherwise the channel has to start a new source at that time
+        """
+        return False
+
+    async def pause(self) -> None:
+        pass
+
+    async def unpause(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def close(self, keep_source: bool = False) -> None:
+        """
+        :param keep_source: Leave the file being read open, because another source is taking it over
+        """
+        pass
+
+
+class AsyncFFmpegAudio(AudioSource):
+    def __init__(self, source: typing.Union[AsyncFile, PrefixedFile],
+                 buffer_size: int = AudioSource.DEFAULT_BUFFER_SIZE, skip: int = 0,
+                 recorder: typing.Optional["PCMRecorder"] = None, duration: typing.Optional[float] = None,
+                 input: typing.Optional[str] = None, start_time: float = 0) -> None:
+        """
+        :param skip: Bytes of PCM to throw away from the start of the output
+        :param recorder: Copy everything FFmpeg outputs into this, for the PCM cache
+        :param duration: Length of the file in seconds if we already know, otherwise FFmpeg will tell us if it can
+        :param input: A path or URL for FFmpeg to open itself instead of piping in source. FFmpeg can seek in
+        these, making HTTP Range requests for URLs.
+        :param start_time: Seconds into the file to start from, only for an input FFmpeg opens itself
+        """
         self._source = source
+        self.duration = duration
+        self.input = input
+        self.start_time = start_time if input is not None else 0
+        self._position = 0  # Bytes of PCM read out
+        self._skip = skip
+        self._recorder = recorder
         self._process: typing.Optional[asyncio.subprocess.Process] = None
-        self._buffer = io.BytesIO()
+        self._buffer = PCMRingBuffer(buffer_size)
+        self._stdout: typing.Optional[int] = None
+        self._reading_stdout = False
+        self._started_output = False
+        self._eof = False
+        self._killed = False
+        self.underruns = 0
         self.read_task: typing.Optional[asyncio.Task] = None
+        self._stderr_task: typing.Optional[asyncio.Task] = None
+        self._finish_task: typing.Optional[asyncio.Task] = None
         self.pause_lock = None
-        self.read: typing.Callable[[int], typing.Coroutine[typing.Any, typing.Any, bytes]] = self._start_read
 
     async def start(self) -> None:
         if self._process:
             return
 
-        args = ["ffmpeg", "-i", "pipe:0", '-loglevel', 'quiet',
-                "-filter:a", "loudnorm", "-vn",
+        # Loudness is normalized with a static gain in the mixer, see LoudnessAnalyzer. We only keep FFmpeg's
+        # logging for the input's duration.
+        if self.input is not None:
+            # Seeking before the input lets FFmpeg jump there using the container's index
+            input_args = [*(["-ss", str(self.start_time)] if self.start_time else []), "-i", self.input]
+        else:
+            input_args = ["-i", "pipe:0"]
+        args = ["ffmpeg", "-hide_banner", "-nostats", *input_args, '-loglevel', 'info', "-vn",
                 '-f', 's16le', '-ar', '48000', '-ac', '2', "-"]
-        self._process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE,
-                                                             stdin=asyncio.subprocess.PIPE,
-                                                             start_new_session=True)
+        # FFmpeg writes into a plain pipe that we read straight into the ring buffer, rather than going
+        # through a StreamReader and getting a new bytes object back for every read
+        stdout, ffmpeg_stdout = os.pipe()
+        try:
+            stdin = asyncio.subprocess.PIPE if self.input is None else asyncio.subprocess.DEVNULL
+            self._process = await asyncio.create_subprocess_exec(*args, stdout=ffmpeg_stdout, stdin=stdin,
+                                                                 stderr=asyncio.subprocess.PIPE,
+                                                                 start_new_session=True)
+        except:
+            os.close(stdout)
+            raise
+        finally:
+            os.close(ffmpeg_stdout)
         if self._process is None:
             raise Exception("Oh dear, there's no process, why")
-        self.read_task = asyncio.Task(self._read_task())
+        os.set_blocking(stdout, False)
+        self._stdout = stdout
+        self._resume_stdout()
+        if self.input is None:
+            self.read_task = asyncio.Task(self._read_task())
+        self._stderr_task = asyncio.Task(self._stderr_reader(self._process))
         logger.info("Start was called on Audio Source")
 
+    async def _stderr_reader(self, process: asyncio.subprocess.Process) -> None:
+        """Pick the duration out of FFmpeg's log, and keep draining it so FFmpeg never blocks on it"""
+        assert process.stderr is not None
+        try:
+            async for line in process.stderr:
+                if self.duration is None:
+                    match = FFMPEG_DURATION.search(line)
+                    if match:
+                        hours, minutes, seconds = match.groups()
+                        self.duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        except asyncio.CancelledError:
+            pass
+        except:
+            traceback.print_exc()
+
     async def _read_task(self) -> None:
         logger.info(f"Starting pipe from AsyncFile to FFmpeg {self._source}")
         chunk_size = 1024 * 5
@@ -62,33 +204,96 @@ class AsyncFFmpegAudio:
         except:
             traceback.print_exc()
 
-    async def _start_read(self, size: int = 3840) -> bytes:
+    def _resume_stdout(self) -> None:
+        if self._stdout is not None and not self._reading_stdout:
+            asyncio.get_running_loop().add_reader(self._stdout, self._on_stdout)
+            self._reading_stdout = True
+
+    def _pause_stdout(self) -> None:
+        if self._stdout is not None and self._reading_stdout:
+            asyncio.get_running_loop().remove_reader(self._stdout)
+            self._reading_stdout = False
+
+    def _close_stdout(self) -> None:
+        self._pause_stdout()
+        if self._stdout is not None:
+            os.close(self._stdout)
+            self._stdout = None
+
+    def _on_stdout(self) -> None:
+        assert self._stdout is not None
+        views = self._buffer.writable()
+        if not views:
+            # The buffer is full, stop reading and let FFmpeg block on the pipe until the mixer catches up
+            self._pause_stdout()
+            return
         try:
-            if self._process is None:
-                raise Exception(f"{self.__class__.__name__} tried to read from the FFmpeg process before it started!")
-            if len(self._process.stdout._buffer) < size and self._process.returncode is None:
-                return bytes(size)
-            logger.info("File read started, swapping to read it")
-            self.read = self._main_read
-            return await self.read()
-        except AttributeError as e:
-            if self._process is None:
-                raise Exception(f"There was an attempt to read a {self.__class__.__name__} without starting it first.")
-            else:
-                raise e
-
-    async def _main_read(self, size: int = 3840) -> bytes:
-        # print("reading next chunk...")
-        assert self._process is not None
-        assert self._process.stdout is not None
-        data = await self._process.stdout.read(size)
-        if not data:
-            logger.info("Finished reading file, closing")
-            await self._process.wait()
-            self._process = None
-            return bytes(0)
+            size = os.readv(self._stdout, views)
+        except BlockingIOError:
+            return
+        if size == 0:
+            logger.info("FFmpeg finished writing, closing its output")
+            self._eof = True
+            self._close_stdout()
+            if self._recorder and self._process:
+                self._finish_task = asyncio.Task(self._finish_recording(self._process))
+            return
+        self._buffer.commit(size)
+        if self._recorder:
+            for view in views:
+                self._recorder.write(view[:size])
+                size -= len(view)
+                if size <= 0:
+                    break
+
+    async def _finish_recording(self, process: asyncio.subprocess.Process) -> None:
+        # Only cache the output if FFmpeg got the whole file and decoded all of it without problems. It may have
+        # been killed after it finished writing if the track was closed quickly, that's fine too.
+        assert self._recorder is not None
+        code = await process.wait()
+        if (code == 0 or self._killed) and not self._source.failed:
+            self._recorder.finish()
+        else:
+            self._recorder.abort()
+
+    def read(self, size: int = 3840) -> typing.Optional[np_typing.NDArray[np.int16]]:
+        if self._process is None and not self._eof:
+            raise Exception(f"There was an attempt to read a {self.__class__.__name__} without starting it first.")
+        while self._skip and self._buffer.fill:
+            skipped = self._buffer.read(min(self._skip, self._buffer.fill))
+            if not skipped.nbytes:
+                # Only part of a sample has come in
+                break
+            self._skip -= skipped.nbytes
+            self._resume_stdout()
+        if self._buffer.fill < size and not self._eof:
+            # Hold off until FFmpeg gives us the first whole frame. After that, running dry is an underrun.
+            if self._started_output:
+                self.underruns += 1
+            return None
+        if not self._started_output:
+            logger.info("File read started")
+            self._started_output = True
+        data = self._buffer.read(size)
+        self._position += data.nbytes
+        self._resume_stdout()
         return data
 
+    def buffered(self) -> int:
+        return self._buffer.fill
+
+    def finished_decoding(self) -> bool:
+        return self._eof
+
+    def remaining(self) -> typing.Optional[float]:
+        if self._eof or self.duration is None:
+            return super().remaining()
+        return max(self.duration - self.start_time - self._position / BYTES_PER_SECOND, 0)
+
+    @property
+    def footprint(self) -> int:
+        return self._buffer.capacity
+
     async def pause(self):
         if self.pause_lock:
             if not self.pause_lock.is_set():
@@ -119,19 +324,408 @@ class AsyncFFmpegAudio:
                 # print("Terminating...")
                 # IDK why it needs to be killed but terminating doesn't work. Maybe we need to communicate() and read
                 # out all of the data so it can terminate?
+                self._killed = self._process.returncode is None
                 self._process.kill()
             except ProcessLookupError:
                 pass
             self._process = None
 
-    async def close(self) -> None:
+    async def close(self, keep_source: bool = False) -> None:
+        if self._recorder and not self._eof:
+            self._recorder.abort()
         self._end_process()
+        self._close_stdout()
         if self.read_task:
             self.read_task.cancel()
-        await self._source.close()
+        if self._stderr_task:
+            self._stderr_task.cancel()
+        if self._finish_task:
+            # FFmpeg has been killed if it was still going, so this won't be long
+            await self._finish_task
+        if not keep_source:
+            await self._source.close()
 
     def __del__(self):
         print("Received delete, terminating...")
         self._end_process()
+        if self._stdout is not None:
+            os.close(self._stdout)
+        if self.read_task:
+            self.read_task.cancel()
+
+
+class CachedPCMSource(AudioSource):
+    """Plays PCM that's already been decoded, from memory or a memory-mapped file in the PCM cache"""
+    def __init__(self, pcm: np_typing.NDArray[np.int16]) -> None:
+        self._pcm = pcm
+        self._position = 0
+
+    async def start(self) -> None:
+        pass
+
+    def read(self, size: int = 3840) -> typing.Optional[np_typing.NDArray[np.int16]]:
+        # Views straight into the cached PCM, they stay valid for as long as anything needs them
+        samples = size // AUDIO_DATA_TYPE.itemsize
+        data = self._pcm[self._position:self._position + samples]
+        self._position += len(data)
+        return data
+
+    def set_position(self, position: int) -> None:
+        """Move to a position in bytes"""
+        self._position = min(position // AUDIO_DATA_TYPE.itemsize, len(self._pcm))
+
+    def seek(self, seconds: float) -> bool:
+        self.set_position(int(seconds * SAMPLE_RATE) * 2 * AUDIO_DATA_TYPE.itemsize)
+        return True
+
+    def buffered(self) -> int:
+        return (len(self._pcm) - self._position) * AUDIO_DATA_TYPE.itemsize
+
+    def finished_decoding(self) -> bool:
+        return True
+
+    async def close(self, keep_source: bool = False) -> None:
+        pass
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({len(self._pcm)})"
+
+
+class OpusPassthroughSource(AudioSource):
+    """
+    Demuxes Ogg and WebM Opus files so their packets can be sent as is, or decoded right here in the worker.
+
+    Packets get sent directly while the channel is the only thing playing at unity gain, skipping the Opus
+    encoder. When they need mixing they're decoded with libopus straight into our PCM buffer, so no FFmpeg
+    process is needed for these either. If the file is in the PCM cache we pick up from the same point in the
+    cached audio instead.
+
+    FFmpeg is only used for streams we can't demux or decode ourselves. It's started from the Ogg page or Matroska
+    cluster the next packet is in, fed the container header and the rest of the file.
+    """
+    MAX_PACKETS = 250  # Five seconds of packets
+    CHUNK_SIZE = 4096
+    PREROLL_PACKETS = 4  # Packets to warm the decoder up on when decoding doesn't start from the beginning
+
+    def __init__(self, source: AsyncFile, buffer_size: int = AudioSource.DEFAULT_BUFFER_SIZE,
+                 cached: typing.Optional[CachedPCMSource] = None,
+                 recorder: typing.Optional["PCMRecorder"] = None) -> None:
+        self._source = source
+        self.buffer_size = buffer_size
+        self._cached = cached
+        self._recorder = recorder
+        self._sent_samples = 0
+        self._demuxer: typing.Optional[OpusDemuxer] = None
+        self._packets: collections.deque[OpusPacket] = collections.deque()
+        self._packet_samples = 0  # Total duration of the packets in _packets
+        # Raw container bytes from the unit the next packet is in onwards, to restart decoding from if we need to
+        self._raw = bytearray()
+        self._raw_offset = 0
+        self._header = b""
+        self._passthrough = True
+        self._decodable = True  # Can libopus decode this stream?
+        self._decode_requested = False  # Have we given up on libopus and asked FFmpeg to decode the rest?
+        self._fallback: typing.Optional[AudioSource] = None
+        self._opus: typing.Optional[OpusDecoder] = None
+        # Decoded PCM waiting to be read is _pcm[_pcm_start:_pcm_end]
+        self._pcm: np_typing.NDArray[np.int16] = np.zeros(0, dtype=AUDIO_DATA_TYPE)
+        self._pcm_start = 0
+        self._pcm_end = 0
+        self._skip_samples = 0
+        self._recent: collections.deque[OpusPacket] = collections.deque(maxlen=self.PREROLL_PACKETS)
+        self._decoder_warm = True  # Has the decoder seen every packet before the next one?
+        self._recording = True  # Has every packet so far been decoded here, so the output is the whole file?
+        self._started_output = False
+        self._finished = False
+        self._space = asyncio.Event()
+        self.underruns = 0
+        self.read_task: typing.Optional[asyncio.Task] = None
+
+    @staticmethod
+    def supports(audio_file: AudioFile) -> bool:
+        path = str(audio_file.file).split("?")[0].lower()
+        return any(path.endswith(extension) for extension in PASSTHROUGH_EXTENSIONS)
+
+    async def start(self) -> None:
+        if not self.read_task:
+            self.read_task = asyncio.Task(self._demux_task())
+
+    async def _demux_task(self) -> None:
+        try:
+            while not self._decode_requested:
+                if len(self._packets) >= self.MAX_PACKETS:
+                    self._space.clear()
+                    await self._space.wait()
+                    continue
+                chunk = await self._source.read(self.CHUNK_SIZE)
+                if chunk:
+                    try:
+                        self._feed(chunk)
+                    except UnsupportedStreamError as e:
+                        logger.info(f"Can't demux {self._source}, decoding it with FFmpeg instead ({e})")
+                        self._passthrough = False
+                        self._decodable = False
+                        self._decode_requested = True
+                elif self._source.finished_reading():
+                    break
+            if self._decode_requested:
+                await self._start_ffmpeg()
+        except asyncio.CancelledError:
+            pass
+        except:
+            traceback.print_exc()
+        finally:
+            self._finished = True
+
+    def _feed(self, chunk: bytes) -> None:
+        self._raw += chunk
+        if self._demuxer is None:
+            self._demuxer = OpusDemuxer.for_stream(bytes(self._raw))
+            if self._demuxer is None:
+                raise UnsupportedStreamError("Not an Ogg or WebM file")
+        had_header = self._demuxer.header_size is not None
+        for packet in self._demuxer.feed(chunk):
+            # RTP timestamps always move forward by one 20ms frame, so anything else has to be decoded
+            if packet.samples != FRAME_SAMPLES:
+                self._passthrough = False
+            self._packets.append(packet)
+            self._packet_samples += packet.samples
+        if not had_header and self._demuxer.header_size is not None:
+            assert self._demuxer.head is not None
+            self._header = bytes(self._raw[:self._demuxer.header_size])
+            if self._demuxer.head.channels > 2 or self._demuxer.head.mapping_family != 0:
+                # Surround streams need the multistream decoder, leave those to FFmpeg
+                self._passthrough = False
+                self._decodable = False
+            elif self._demuxer.head.output_gain != 0:
+                # Sent as is it'd play at a different loudness than decoded, so the decoder has to apply the gain
+                self._passthrough = False
+        self._trim()
+
+    def _resume_point(self) -> tuple[int, int]:
+        """The unit to restart decoding from and how many samples into it the next packet is"""
+        if self._packets:
+            return self._packets[0].unit_start, self._packets[0].unit_samples
+        assert self._demuxer is not None
+        return self._demuxer.unit_start, self._demuxer.unit_samples
+
+    def _trim(self) -> None:
+        if not self._header:
+            return
+        start, _ = self._resume_point()
+        del self._raw[:start - self._raw_offset]
+        self._raw_offset = start
+
+    def _take_packet(self) -> OpusPacket:
+        packet = self._packets.popleft()
+        self._packet_samples -= packet.samples
+        self._recent.append(packet)
+        self._space.set()
+        self._trim()
+        return packet
+
+    async def _start_ffmpeg(self) -> None:
+        if self._header:
+            start, samples = self._resume_point()
+            prefix = self._header + self._raw[start - self._raw_offset:]
+        else:
+            # We never figured out the container, so decode everything we've read from the start
+            prefix, samples = bytes(self._raw), 0
+        self._packets.clear()
+        self._raw.clear()
+        # Decoding from the very start gets the whole file, so it can go into the PCM cache
+        fallback = AsyncFFmpegAudio(PrefixedFile(bytes(prefix), self._source), self.buffer_size,
+                                    skip=samples * 2 * 2,
+                                    recorder=None if self._started_output else self._recorder)
+        await fallback.start()
+        self._fallback = fallback
+
+    def _switch_to_cache(self) -> None:
+        assert self._cached is not None
+        self._decode_requested = True
         if self.read_task:
             self.read_task.cancel()
+        self._packets.clear()
+        self._raw.clear()
+        # Decoded audio has the pre-skip trimmed off the front, the packets we sent didn't
+        pre_skip = self._demuxer.head.pre_skip if self._demuxer and self._demuxer.head else 0
+        position = max(self._sent_samples - pre_skip, 0)
+        self._cached.set_position(position * 2 * AUDIO_DATA_TYPE.itemsize)
+        self._fallback = self._cached
+
+    def seek(self, seconds: float) -> bool:
+        if self._cached and not self._fallback:
+            self._switch_to_cache()
+        if self._fallback:
+            return self._fallback.seek(seconds)
+        return False
+
+    @property
+    def passthrough(self) -> bool:
+        """Can packets currently be sent straight from the file?"""
+        return self._passthrough and not self._decode_requested
+
+    def read_packet(self) -> typing.Optional[bytes]:
+        """Take the next Opus packet, or None if there isn't one ready"""
+        if not self._started_output and self._packets:
+            assert self._demuxer is not None and self._demuxer.head is not None
+            # The first pre_skip samples are the encoder warming up and aren't meant to be heard. We can only send
+            # whole packets, so drop the ones the pre-skip starts in.
+            while self._packets and self._sent_samples < self._demuxer.head.pre_skip:
+                self._sent_samples += self._take_packet().samples
+            if self._sent_samples:
+                self._started_output = True
+                self._decoder_warm = False
+                self._recording = False
+        if not self._packets:
+            return None
+        packet = self._take_packet()
+        self._started_output = True
+        self._sent_samples += packet.samples
+        # Anything decoded ahead is behind us now, and the decoder missed this packet
+        self._pcm_start = self._pcm_end
+        self._decoder_warm = False
+        self._recording = False
+        return packet.data
+
+    def read(self, size: int = 3840) -> typing.Optional[np_typing.NDArray[np.int16]]:
+        if self._fallback:
+            return self._fallback.read(size)
+        if self._cached and self._header:
+            self._switch_to_cache()
+            assert self._fallback is not None
+            return self._fallback.read(size)
+        if not self._header and not self._decode_requested:
+            if not self._finished:
+                # Still reading the start of the file
+                return None
+            self._decodable = False
+        if not self._decodable:
+            if not self._decode_requested:
+                self._decode_requested = True
+                self._space.set()
+                if self.read_task and self.read_task.done():
+                    self.read_task = asyncio.Task(self._start_ffmpeg())
+            return None
+        return self._decode(size)
+
+    def _decode(self, size: int) -> typing.Optional[np_typing.NDArray[np.int16]]:
+        assert self._demuxer is not None and self._demuxer.head is not None
+        samples = size // AUDIO_DATA_TYPE.itemsize
+        if self._opus is None:
+            self._opus = OpusDecoder(48000, 2)
+            self._opus.set_gain(self._demuxer.head.output_gain)
+            if not self._started_output:
+                self._skip_samples = self._demuxer.head.pre_skip * 2
+        if not self._decoder_warm:
+            self._preroll()
+
+        # Move what's left over from the last read to the front, then decode straight in after it
+        leftover = self._pcm_end - self._pcm_start
+        capacity = samples + MAX_PACKET_SAMPLES * 2 + self._skip_samples
+        if len(self._pcm) < capacity:
+            pcm = np.zeros(capacity, dtype=AUDIO_DATA_TYPE)
+            pcm[:leftover] = self._pcm[self._pcm_start:self._pcm_end]
+            self._pcm = pcm
+        elif self._pcm_start:
+            self._pcm[:leftover] = self._pcm[self._pcm_start:self._pcm_end]
+        self._pcm_start, self._pcm_end = 0, leftover
+        while self._pcm_end - self._pcm_start < samples and self._packets:
+            packet = self._take_packet()
+            try:
+                decoded = self._opus.decode_into(packet.data, self._pcm[self._pcm_end:])
+            except OpusDecodeError:
+                logger.warning(f"Corrupt packet in {self._source}, concealing it")
+                decoded = self._conceal(packet)
+            self._pcm_end += decoded * 2
+            if self._skip_samples:
+                skipped = min(self._skip_samples, self._pcm_end - self._pcm_start)
+                self._pcm_start += skipped
+                self._skip_samples -= skipped
+
+        available = self._pcm_end - self._pcm_start
+        ended = self._finished and not self._packets
+        if available < samples and not ended:
+            # Hold off until we have the first whole frame. After that, running dry is an underrun.
+            if self._started_output:
+                self.underruns += 1
+            return None
+        self._started_output = True
+        count = min(samples, available)
+        data = self._pcm[self._pcm_start:self._pcm_start + count]
+        self._pcm_start += count
+        if self._recorder and self._recording:
+            self._recorder.write(data.data)
+            if ended and self._pcm_start == self._pcm_end:
+                if self._source.failed:
+                    self._recorder.abort()
+                else:
+                    self._recorder.finish()
+        return data
+
+    def _conceal(self, packet: OpusPacket) -> int:
+        """Fill in for a corrupt packet, falling back to silence if the decoder can't"""
+        assert self._opus is not None
+        # The length comes from the same TOC byte as the rest of the packet, so it can be just as broken
+        samples = packet.samples if 0 < packet.samples <= MAX_PACKET_SAMPLES else FRAME_SAMPLES
+        try:
+            return self._opus.decode_into(None, self._pcm[self._pcm_end:], samples)
+        except OpusDecodeError:
+            self._pcm[self._pcm_end:self._pcm_end + samples * 2] = 0
+            return samples
+
+    def _preroll(self) -> None:
+        """Decode the last few packets and throw the audio away so the decoder state catches up"""
+        assert self._opus is not None
+        self._opus.reset()
+        scratch = np.zeros(MAX_PACKET_SAMPLES * 2, dtype=AUDIO_DATA_TYPE)
+        for packet in self._recent:
+            try:
+                self._opus.decode_into(packet.data, scratch)
+            except OpusDecodeError:
+                pass
+        self._decoder_warm = True
+
+    def buffered(self) -> int:
+        if self._fallback:
+            return self._fallback.buffered()
+        return (self._pcm_end - self._pcm_start + self._packet_samples * 2) * AUDIO_DATA_TYPE.itemsize
+
+    def finished_decoding(self) -> bool:
+        if self._fallback:
+            return self._fallback.finished_decoding()
+        return self._finished and not self._decode_requested
+
+    def remaining(self) -> typing.Optional[float]:
+        if self._fallback:
+            return self._fallback.remaining()
+        return super().remaining()
+
+    @property
+    def footprint(self) -> int:
+        if self._fallback:
+            return self._fallback.footprint
+        return self.buffer_size
+
+    async def pause(self) -> None:
+        if self._fallback:
+            await self._fallback.pause()
+
+    async def unpause(self) -> None:
+        if self._fallback:
+            await self._fallback.unpause()
+
+    async def close(self, keep_source: bool = False) -> None:
+        if self.read_task:
+            self.read_task.cancel()
+        if self._recorder and not self._recorder.done and not isinstance(self._fallback, AsyncFFmpegAudio):
+            self._recorder.abort()
+        if self._fallback:
+            await self._fallback.close(keep_source)
+        if self._opus:
+            self._opus.close()
+        if not keep_source:
+            await self._source.close()
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self._source})"
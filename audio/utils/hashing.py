@@ -0,0 +1,50 @@
+import asyncio
+import hashlib
+import typing
+from pathlib import Path
+
+from audio.data.audio import AudioFile
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Local file hashes, keyed by path, size and modification time so edited files get hashed again
+_file_hashes: dict[tuple[str, int, int], str] = {}
+
+
+def _hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def url_hash(url: str, cache_name: typing.Optional[str] = None) -> str:
+    """Hash identifying a remote file, by its cache name if it has one since URLs can change"""
+    return hashlib.sha256(f"url:{cache_name or url}".encode()).hexdigest()
+
+
+async def content_hash(audio_file: AudioFile) -> typing.Optional[str]:
+    """
+    Get a hash identifying the contents of an AudioFile.
+
+    Local files are hashed by their contents (in a thread, and only once per version of the file). Remote files
+    aren't downloaded yet, so they're identified by their cache name or URL instead.
+    """
+    file = audio_file.file
+    if isinstance(file, str) and file.startswith("http"):
+        return url_hash(file, audio_file.cache_name)
+    path = Path(file)
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    memo_key = (str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        _file_hashes[memo_key] = await asyncio.get_running_loop().run_in_executor(None, _hash_file, path)
+    return _file_hashes[memo_key]
+
+
+def params_hash(*params: typing.Any) -> str:
+    """Short hash of the parameters something was decoded with"""
+    return hashlib.sha256(repr(params).encode()).hexdigest()[:12]
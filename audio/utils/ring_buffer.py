@@ -0,0 +1,88 @@
+import numpy as np
+from numpy import typing as np_typing
+
+from audio.utils.constants import AUDIO_DATA_TYPE
+
+
+class PCMRingBuffer:
+    """
+    Fixed size int16 ring buffer that gets written into directly (readinto style) and read out as NumPy views.
+
+    A read hands back a view into the buffer, and that space isn't released to the writer until the next read,
+    so the view stays valid while the mixer uses it. Only a read that straddles the end of the buffer needs a
+    copy, which happens once per trip around the ring.
+    """
+    def __init__(self, capacity: int) -> None:
+        """
+        :param capacity: Size of the buffer in bytes
+        """
+        self.capacity = capacity - capacity % AUDIO_DATA_TYPE.itemsize
+        self._array: np_typing.NDArray[np.int16] = np.zeros(self.capacity // AUDIO_DATA_TYPE.itemsize,
+                                                            dtype=AUDIO_DATA_TYPE)
+        self._bytes = memoryview(self._array).cast("B")
+        self._scratch: np_typing.NDArray[np.int16] = np.zeros(0, dtype=AUDIO_DATA_TYPE)
+        self._read = 0
+        self._write = 0
+        self._fill = 0
+        self._held = 0  # Bytes handed out by the last read that the writer can't touch yet
+
+    @property
+    def fill(self) -> int:
+        """Number of unread bytes in the buffer"""
+        return self._fill
+
+    @property
+    def free(self) -> int:
+        return self.capacity - self._fill - self._held
+
+    def writable(self) -> list[memoryview]:
+        """Views of the free space in the buffer, in order, for something like os.readv to write into"""
+        free = self.free
+        if free == 0:
+            return []
+        end = self._write + free
+        if end <= self.capacity:
+            return [self._bytes[self._write:end]]
+        return [self._bytes[self._write:], self._bytes[:end - self.capacity]]
+
+    def commit(self, size: int) -> None:
+        """Mark size bytes written into the views from writable() as filled"""
+        self._write = (self._write + size) % self.capacity
+        self._fill += size
+
+    def write(self, data: bytes) -> int:
+        """Copy as much of data in as fits, returning how many bytes were written"""
+        written = 0
+        for view in self.writable():
+            count = min(len(view), len(data) - written)
+            view[:count] = data[written:written + count]
+            written += count
+        self.commit(written)
+        return written
+
+    def read(self, size: int) -> np_typing.NDArray[np.int16]:
+        """
+        Read up to size bytes, in whole samples. A trailing odd byte stays in the buffer until the rest of its sample
+        is written. The result is only valid until the next read.
+        """
+        self._held = 0
+        size = min(size, self._fill)
+        size -= size % AUDIO_DATA_TYPE.itemsize
+        start = self._read // AUDIO_DATA_TYPE.itemsize
+        samples = size // AUDIO_DATA_TYPE.itemsize
+        if self._read + size <= self.capacity:
+            data = self._array[start:start + samples]
+        else:
+            if len(self._scratch) < samples:
+                self._scratch = np.zeros(samples, dtype=AUDIO_DATA_TYPE)
+            data = self._scratch[:samples]
+            head = len(self._array) - start
+            data[:head] = self._array[start:]
+            data[head:] = self._array[:samples - head]
+        self._read = (self._read + size) % self.capacity
+        self._fill -= size
+        self._held = size
+        return data
+
+    def clear(self) -> None:
+        self._read = self._write = self._fill = self._held = 0
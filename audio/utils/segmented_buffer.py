@@ -0,0 +1,124 @@
+import asyncio
+import collections
+import os
+import typing
+
+
+class SegmentedBuffer:
+    """
+    A growing stream of bytes kept as a list of fixed size segments, so the ones that have been read can be let go.
+
+    Readers wait on a Condition and wake up as soon as the data they asked for arrives, and writers can wait for
+    readers to catch up so only so much is held in memory at once. If memory gets tight, it can be spilled into a
+    file, after which everything is written to and read from there instead.
+    """
+    SEGMENT_SIZE = 64 * 1024
+
+    def __init__(self, segment_size: int = SEGMENT_SIZE) -> None:
+        self.segment_size = segment_size
+        self._segments: collections.deque[bytearray] = collections.deque()
+        self._start = 0  # Stream offset of the first segment we still have
+        self.size = 0  # Bytes written in total
+        self.released = 0  # Everything before this has been read and can be dropped
+        self.closed = False
+        self.discarded = False
+        self._condition = asyncio.Condition()
+        self._spill: typing.Optional[typing.BinaryIO] = None
+
+    @property
+    def held(self) -> int:
+        """Bytes held in memory"""
+        if self._spill is not None or self.discarded:
+            return 0
+        return self.size - self._start
+
+    @property
+    def spilled(self) -> bool:
+        return self._spill is not None
+
+    def spill(self, file: typing.BinaryIO) -> None:
+        """Move what we're holding into file, and keep anything written from now on there too"""
+        if self.discarded:
+            file.close()
+            return
+        # Small writes and reads of a file that's in the page cache, it's not worth a thread
+        position = self._start
+        for segment in self._segments:
+            os.pwrite(file.fileno(), segment, position)
+            position += len(segment)
+        self._segments.clear()
+        self._spill = file
+
+    def discard(self) -> None:
+        """Let go of everything, including the spill file, anything written after this is dropped"""
+        self.discarded = True
+        self._segments.clear()
+        self._start = self.released = self.size
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    async def write(self, data: bytes) -> None:
+        if self.discarded:
+            return
+        view = memoryview(data)
+        if self._spill is not None:
+            os.pwrite(self._spill.fileno(), view, self.size)
+            view = view[len(view):]
+        while view:
+            if not self._segments or len(self._segments[-1]) >= self.segment_size:
+                self._segments.append(bytearray())
+            segment = self._segments[-1]
+            count = min(self.segment_size - len(segment), len(view))
+            segment += view[:count]
+            view = view[count:]
+        self.size += len(data)
+        async with self._condition:
+            self._condition.notify_all()
+
+    async def close(self) -> None:
+        """No more data is coming, wake up anyone still waiting for some"""
+        self.closed = True
+        async with self._condition:
+            self._condition.notify_all()
+
+    async def wait_for(self, end: int) -> None:
+        """Wait until the stream reaches end or is closed"""
+        if self.size >= end or self.closed:
+            return
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.size >= end or self.closed)
+
+    async def wait_for_reader(self, limit: int) -> None:
+        """Wait until no more than limit bytes are waiting to be read"""
+        if self.size - self.released <= limit or self.closed:
+            return
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.size - self.released <= limit or self.closed)
+
+    def read(self, offset: int, size: int) -> bytes:
+        """Copy out up to size bytes from offset, which has to be at or after the last release"""
+        if offset < self._start:
+            raise ValueError(f"Offset {offset} has already been released")
+        end = min(offset + size, self.size)
+        if self._spill is not None:
+            return os.pread(self._spill.fileno(), max(end - offset, 0), offset)
+        data = bytearray()
+        position = self._start
+        for segment in self._segments:
+            segment_end = position + len(segment)
+            if segment_end > offset:
+                data += segment[max(offset - position, 0):end - position]
+            if segment_end >= end:
+                break
+            position = segment_end
+        return bytes(data)
+
+    async def release(self, offset: int) -> None:
+        """Everything before offset has been read, drop the segments that are entirely behind it"""
+        self.released = max(self.released, offset)
+        while self._segments and self._start + len(self._segments[0]) <= self.released \
+                and len(self._segments[0]) >= self.segment_size:
+            self._start += len(self._segments.popleft())
+        async with self._condition:
+            self._condition.notify_all()
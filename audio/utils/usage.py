@@ -0,0 +1,35 @@
+import os
+import typing
+
+try:
+    import resource
+except ImportError:
+    resource = None  # type: ignore
+
+
+def _rss() -> int:
+    """The memory this process is using right now, in bytes"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is not None:
+        # Only the peak is available here, which is close enough for spotting a leak
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return 0
+
+
+def process_usage() -> dict[str, typing.Any]:
+    """
+    CPU time and memory used by this process, sent along with heartbeats.
+
+    CPU time includes the FFmpeg processes we've started once they've exited, ones that are still running only
+    count towards their own processes.
+    """
+    times = os.times()
+    return {
+        "pid": os.getpid(),
+        "cpu": times.user + times.system + times.children_user + times.children_system,
+        "rss": _rss(),
+    }